@@ -1,5 +1,198 @@
-from flask import request
-from flask_restplus import Resource, abort
+import os
+import time
+from urllib.parse import urlencode
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Response, request
+from flask_restplus import Resource, abort, inputs, reqparse
+from mongoengine import ValidationError
+
+from app import serializers
+from app.models import StatusEnum
+from app.notifications import get_pubsub
+
+
+# statuses a task does not leave unless it is run again
+FINISHED = [StatusEnum.SUCCESS.value, StatusEnum.ERROR.value]
+
+
+def object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise ValueError(f"'{value}' is not a valid cursor")
+
+
+list_parser = reqparse.RequestParser(bundle_errors=True)
+list_parser.add_argument('after', type=object_id, location='args', help='Return items following this _id')
+list_parser.add_argument(
+    'limit', type=inputs.int_range(1, int(os.getenv('PAGE_MAX_SIZE', 1000))),
+    default=int(os.getenv('PAGE_SIZE', 100)), location='args'
+)
+list_parser.add_argument('fields', type=str, location='args', help='Comma separated fields to return')
+
+task_list_parser = list_parser.copy()
+task_list_parser.add_argument('status', choices=[status.value for status in StatusEnum], location='args')
+task_list_parser.add_argument('created_from', type=inputs.datetime_from_iso8601, location='args')
+task_list_parser.add_argument('created_to', type=inputs.datetime_from_iso8601, location='args')
+
+
+def task_ids(value):
+    ids = [task_id for task_id in value.split(',') if task_id]
+    if not ids or len(ids) > int(os.getenv('PAGE_MAX_SIZE', 1000)):
+        raise ValueError(f"Give from 1 to {os.getenv('PAGE_MAX_SIZE', 1000)} comma separated task ids")
+    try:
+        return [ObjectId(task_id) for task_id in ids]
+    except (InvalidId, TypeError):
+        raise ValueError(f"'{value}' is not a list of task ids")
+
+
+# nginx cuts requests off after 60s of silence
+wait_parser = reqparse.RequestParser(bundle_errors=True)
+wait_parser.add_argument(
+    'timeout', type=inputs.int_range(0, int(os.getenv('LONG_POLL_MAX_TIMEOUT', 55))),
+    default=int(os.getenv('LONG_POLL_TIMEOUT', 30)), location='args', help='Seconds to wait for the tasks at most'
+)
+
+batch_wait_parser = wait_parser.copy()
+batch_wait_parser.add_argument('ids', type=task_ids, required=True, location='args', help='Comma separated task ids')
+
+batch_events_parser = reqparse.RequestParser(bundle_errors=True)
+batch_events_parser.add_argument('ids', type=task_ids, required=True, location='args', help='Comma separated task ids')
+
+
+def negotiate():
+    """ Return mimetype of the response, picked from the Accept header """
+    mimetypes = serializers.mimetypes()
+    return request.accept_mimetypes.best_match(mimetypes, mimetypes[0])
+
+
+def document_response(doc, status=200):
+    """ Send raw document (or list of them) as JSON or MessagePack """
+    mimetype = negotiate()
+    response = Response(serializers.encode(doc, mimetype), status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def paginated_response(queryset, args):
+    """ Stream page of the queryset ordered by _id, next page link is in Link and X-Next-Cursor headers """
+    # declared fields only - documents not migrated yet may still hold former inline text or arrays,
+    # heavy ones (task profile) only if asked for
+    excluded = getattr(queryset._document, 'list_excluded_fields', ())
+    fields = [field for field in queryset._document._fields if field not in excluded]
+    if args['fields']:
+        fields = [field for field in args['fields'].split(',') if field]
+        unknown = set(fields) - set(queryset._document._fields)
+        if unknown:
+            abort(400, message=f"Unknown fields: {', '.join(sorted(unknown))}")
+    queryset = queryset.only(*fields)
+
+    if args['after']:
+        queryset = queryset.filter(pk__gt=args['after'])
+    queryset = queryset.order_by('pk')
+
+    limit = args['limit']
+    headers = {}
+    # last _id of this page and whether anything follows it - index only query, items are not read twice
+    last_ids = list(queryset.skip(limit - 1).limit(2).scalar('id'))
+    if len(last_ids) == 2:
+        cursor = str(last_ids[0])
+        query = urlencode({**request.args.to_dict(), 'after': cursor})
+        headers['X-Next-Cursor'] = cursor
+        headers['Link'] = f'<{request.base_url}?{query}>; rel="next"'
+
+    mimetype = negotiate()
+    response = Response(
+        serializers.stream(queryset.limit(limit).as_pymongo(), mimetype), mimetype=mimetype, headers=headers
+    )
+    response.vary.add('Accept')
+    return response
+
+
+def filter_tasks(queryset, args):
+    """ Apply filters of task lists, each can be served by an index in _id order of pages """
+    if args['status']:
+        queryset = queryset.filter(status=args['status'])
+    # creation time is held in _id (to a second) - a range of it keeps pages in order of the index,
+    # while a date_created range would make the server sort all matching tasks for every page
+    if args['created_from']:
+        queryset = queryset.filter(pk__gte=ObjectId.from_datetime(args['created_from']))
+    if args['created_to']:
+        queryset = queryset.filter(pk__lt=ObjectId.from_datetime(args['created_to']))
+    return queryset
+
+
+def abort_invalid(error):
+    errors = error.to_dict()
+    field = 'callback_url' if 'callback_url' in errors else 'url'
+    abort(400, message=f"Invalid {field}: {errors.get(field, error.message)}")
+
+
+def pending_ids(model, ids):
+    """ Return ids of the tasks, which are not finished """
+    return {str(task_id) for task_id in model.objects(pk__in=ids, status__nin=FINISHED).scalar('id')}
+
+
+def wait_for_tasks(model, ids, timeout):
+    """ Block until the tasks are finished or timeout seconds pass - woken by status events of workers """
+    deadline = time.monotonic() + timeout
+    # statuses are read after subscribing, so a change made in between is not missed
+    with get_pubsub().subscribe(ids) as subscription:
+        pending = pending_ids(model, ids)
+        while pending:
+            event = subscription.get(deadline - time.monotonic())
+            if event is None:
+                return
+            if event['status'] in FINISHED:
+                pending.discard(event['task'])
+
+
+def server_sent_event(event, data):
+    return f'event: {event}\ndata: {serializers.dumps(data).decode()}\n\n'
+
+
+def event_stream(model, ids, subscription):
+    """ Yield current status of each task, then their status changes until all are finished """
+    deadline = time.monotonic() + float(os.getenv('SSE_MAX_DURATION', 300))
+    keepalive = float(os.getenv('SSE_KEEPALIVE', 15))
+
+    pending = set()
+    for doc in model.objects(pk__in=ids).only('status').as_pymongo():
+        task_id = str(doc['_id'])
+        if doc['status'] not in FINISHED:
+            pending.add(task_id)
+        yield server_sent_event('status', {'_id': task_id, 'status': doc['status']})
+
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            # the client reconnects and gets current statuses again
+            return
+        event = subscription.get(min(keepalive, remaining))
+        if event is None:
+            # comment, so proxies and clients see the connection is alive
+            yield ': keepalive\n\n'
+            continue
+        if event['status'] in FINISHED:
+            pending.discard(event['task'])
+        else:
+            pending.add(event['task'])
+        yield server_sent_event('status', {'_id': event['task'], 'status': event['status']})
+
+    yield server_sent_event('end', {})
+
+
+def events_response(model, ids):
+    """ Stream status changes of the tasks as Server-Sent Events """
+    subscription = get_pubsub().subscribe(ids)
+    response = Response(
+        event_stream(model, ids, subscription), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(subscription.close)
+    return response
 
 
 class Task(Resource):
@@ -8,9 +201,53 @@ class Task(Resource):
         """ Return models class """
         raise NotImplementedError
 
+    def get_document(self, tid):
+        return self.model.objects.get_or_404(pk=tid).to_mongo()
+
+    def get(self, *args, **kwargs):
+        return document_response(self.get_document(kwargs['tid']))
+
+
+class TaskWait(Task):
     def get(self, *args, **kwargs):
+        """ Long-poll - return the task once it is finished, or as it is after 'timeout' seconds """
         tid = kwargs['tid']
-        return self.model.objects.get_or_404(pk=tid).to_mongo()
+        args = wait_parser.parse_args()
+        doc = self.get_document(tid)
+        if doc['status'] not in FINISHED:
+            wait_for_tasks(self.model, [doc['_id']], args['timeout'])
+            doc = self.get_document(tid)
+        return document_response(doc)
+
+
+class TaskEvents(Task):
+    def get(self, *args, **kwargs):
+        return events_response(self.model, [self.get_document(kwargs['tid'])['_id']])
+
+
+class TaskBatchWait(Resource):
+    @property
+    def model(self):
+        """ Return models class """
+        raise NotImplementedError
+
+    def get(self):
+        """ Long-poll - return the tasks once all of them are finished, or as they are after 'timeout' seconds """
+        args = batch_wait_parser.parse_args()
+        wait_for_tasks(self.model, args['ids'], args['timeout'])
+        docs = self.model.objects(pk__in=args['ids']).only(*self.model._fields).order_by('pk').as_pymongo()
+        return document_response(list(docs))
+
+
+class TaskBatchEvents(Resource):
+    @property
+    def model(self):
+        """ Return models class """
+        raise NotImplementedError
+
+    def get(self):
+        args = batch_events_parser.parse_args()
+        return events_response(self.model, args['ids'])
 
 
 class TaskList(Resource):
@@ -29,15 +266,63 @@ class TaskList(Resource):
         raise NotImplementedError
 
     def get(self):
-        return self.queryset.as_pymongo()
+        args = task_list_parser.parse_args()
+        return paginated_response(filter_tasks(self.queryset, args), args)
 
     def post(self):
-        url = request.get_json().get('url')
+        data = request.get_json()
+        url = data.get('url')
         if not url:
             abort(400, message="Request need to contain 'url' parameter")
 
         # even if url is not unique, we want to download content is it can vary over time
-        task = self.model.objects.create(url=url)
+        # 'profile' - worker captures cProfile of the task into its profile,
+        # 'callback_url' - worker posts the task there once it is finished
+        task = self.model(url=url, capture_profile=bool(data.get('profile')), callback_url=data.get('callback_url'))
+        try:
+            task.save()
+        except ValidationError as e:
+            abort_invalid(e)
         self.celery_task.delay(task.to_json())
 
-        return task.to_mongo(), 201
+        return document_response(task.to_mongo(), 201)
+
+
+class TaskBatch(Resource):
+    @property
+    def model(self):
+        """ Return models class """
+        raise NotImplementedError
+
+    @property
+    def celery_task(self):
+        """ Return celery_tasks batch task function """
+        raise NotImplementedError
+
+    def post(self):
+        data = request.get_json() or {}
+        urls = data.get('urls')
+        if not urls or not isinstance(urls, list):
+            abort(400, message="Request need to contain 'urls' list parameter")
+
+        max_size = int(os.getenv('BATCH_MAX_SIZE', 10000))
+        if len(urls) > max_size:
+            abort(400, message=f"Request can contain at most {max_size} urls")
+
+        tasks = [
+            self.model(url=url, capture_profile=bool(data.get('profile')), callback_url=data.get('callback_url'))
+            for url in urls
+        ]
+        try:
+            for task in tasks:
+                task.validate()
+        except ValidationError as e:
+            abort_invalid(e)
+
+        self.model.objects.insert(tasks, load_bulk=False)
+
+        chunk_size = int(os.getenv('BATCH_CHUNK_SIZE', 100))
+        for start in range(0, len(tasks), chunk_size):
+            self.celery_task.delay([str(task.pk) for task in tasks[start:start + chunk_size]])
+
+        return document_response([task.to_mongo() for task in tasks], 201)
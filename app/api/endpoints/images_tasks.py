@@ -5,7 +5,9 @@ from werkzeug.utils import redirect
 
 from app import models
 from app.api import api
-from app.api.endpoints import Task, TaskList
+from app.api.endpoints import (
+    Task, TaskBatch, TaskBatchEvents, TaskBatchWait, TaskEvents, TaskList, TaskWait, list_parser, paginated_response
+)
 from app.models import StatusEnum
 
 
@@ -19,13 +21,21 @@ class ImagesTaskList(TaskList):
         return models.ImageTask
 
     @property
-    def queryset(self):
-        return super().queryset.exclude('images')
+    def celery_task(self):
+        from app import celery_tasks
+        return celery_tasks.execute_images_task
+
+
+@ns.route('/batch')
+class ImagesTaskBatch(TaskBatch):
+    @property
+    def model(self):
+        return models.ImageTask
 
     @property
     def celery_task(self):
         from app import celery_tasks
-        return celery_tasks.execute_images_task
+        return celery_tasks.execute_images_tasks
 
 
 @ns.route('/<string:tid>')
@@ -35,20 +45,48 @@ class ImagesTask(Task):
         return models.ImageTask
 
 
+@ns.route('/wait')
+class ImagesTaskBatchWait(TaskBatchWait):
+    @property
+    def model(self):
+        return models.ImageTask
+
+
+@ns.route('/events')
+class ImagesTaskBatchEvents(TaskBatchEvents):
+    @property
+    def model(self):
+        return models.ImageTask
+
+
+@ns.route('/<string:tid>/wait')
+class ImagesTaskWait(TaskWait):
+    @property
+    def model(self):
+        return models.ImageTask
+
+
+@ns.route('/<string:tid>/events')
+class ImagesTaskEvents(TaskEvents):
+    @property
+    def model(self):
+        return models.ImageTask
+
+
 @ns.route('/<string:tid>/images/')
 class ImagesTaskImagesList(Task):
     @property
     def model(self):
         return models.Image
 
-    @property
-    def queryset(self):
-        return super().queryset.exclude('tasks')
-
     def get(self, *args, **kwargs):
         tid = kwargs['tid']
-        images = self.model.objects.filter(tasks=tid)
-        return images.as_pymongo()
+        args = list_parser.parse_args()
+        try:
+            images = self.model.objects.filter(pk__in=models.ImageTaskLink.image_ids(tid))
+            return paginated_response(images, args)
+        except (InvalidId, ValidationError):
+            abort(404)
 
 
 @ns.route('/<string:tid>/images/<string:iid>')
@@ -60,7 +98,8 @@ class ImagesTaskImage(Task):
     def get(self, *args, **kwargs):
         tid, iid = kwargs['tid'], kwargs['iid']
         try:
-            image = self.model.objects.filter(pk=iid, tasks=tid, status=StatusEnum.SUCCESS).first_or_404()
+            models.ImageTaskLink.objects.filter(task=tid, image=iid).first_or_404()
+            image = self.model.objects.filter(pk=iid, status=StatusEnum.SUCCESS).first_or_404()
         except (InvalidId, ValidationError):
             abort(404)
         else:
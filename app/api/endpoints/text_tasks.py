@@ -1,8 +1,9 @@
+from flask import Response, request
 from flask_restplus import abort
 
-from app import models
+from app import models, utils
 from app.api import api
-from app.api.endpoints import TaskList, Task
+from app.api.endpoints import Task, TaskBatch, TaskBatchEvents, TaskBatchWait, TaskEvents, TaskList, TaskWait
 
 
 ns = api.namespace('text_tasks')
@@ -20,6 +21,18 @@ class TextTaskList(TaskList):
         return celery_tasks.execute_text_task
 
 
+@ns.route('/batch')
+class TextTaskBatch(TaskBatch):
+    @property
+    def model(self):
+        return models.TextTask
+
+    @property
+    def celery_task(self):
+        from app import celery_tasks
+        return celery_tasks.execute_text_tasks
+
+
 @ns.route('/<string:tid>')
 class TextTask(Task):
     @property
@@ -27,6 +40,34 @@ class TextTask(Task):
         return models.TextTask
 
 
+@ns.route('/wait')
+class TextTaskBatchWait(TaskBatchWait):
+    @property
+    def model(self):
+        return models.TextTask
+
+
+@ns.route('/events')
+class TextTaskBatchEvents(TaskBatchEvents):
+    @property
+    def model(self):
+        return models.TextTask
+
+
+@ns.route('/<string:tid>/wait')
+class TextTaskWait(TaskWait):
+    @property
+    def model(self):
+        return models.TextTask
+
+
+@ns.route('/<string:tid>/events')
+class TextTaskEvents(TaskEvents):
+    @property
+    def model(self):
+        return models.TextTask
+
+
 @ns.route('/<string:tid>/text')
 class TextTaskText(TextTask):
     @property
@@ -34,7 +75,23 @@ class TextTaskText(TextTask):
         return models.TextTask
 
     def get(self, *args, **kwargs):
-        text = super().get(*args, **kwargs).get('text')
-        if text is None:
+        text_hash = self.get_document(kwargs['tid']).get('text_hash')
+        if text_hash is None:
             abort(404)
-        return {'text': text}
+        content = models.TextContent.objects.get_or_404(pk=text_hash)
+
+        if request.accept_mimetypes.best_match(['application/json', 'text/plain'], 'application/json') != 'text/plain':
+            return {'text': content.text}
+
+        # plain text is sent as stored if the client takes gzip, ranges are then ranges of the gzipped bytes
+        if request.accept_encodings['gzip']:
+            response = Response(content.data, mimetype='text/plain', headers={'Content-Encoding': 'gzip'})
+            response.set_etag(f'{text_hash}-gzip')
+            length = len(content.data)
+        else:
+            response = Response(utils.iter_decompressed(content.data), mimetype='text/plain')
+            response.set_etag(text_hash)
+            response.headers['Content-Length'] = length = content.length
+        response.vary.add('Accept')
+        response.vary.add('Accept-Encoding')
+        return response.make_conditional(request, accept_ranges=True, complete_length=length)
@@ -1,8 +1,9 @@
 import os
 
-from flask import Flask, Blueprint
+from flask import Flask, Blueprint, Response
 from flask_mongoengine import MongoEngine
 
+from app import metrics, models
 from app.api import api
 from app.api.endpoints.images_tasks import ns as images_tasks_namespace
 from app.api.endpoints.text_tasks import ns as text_tasks_namespace
@@ -19,7 +20,8 @@ def get_config(testing=False):
     config = {
         'RESTPLUS_JSON': {'cls': MongoEngineObjectIdJSONEncoder},
         'MONGODB_SETTINGS': {
-            'host': 'mongodb://db:27017/semantive' if not testing else 'mongomock://localhost:27017',
+            'host': os.getenv('MONGODB_URI', 'mongodb://db:27017/semantive') if not testing
+                    else 'mongomock://localhost:27017',
             'connect': False,
         }
     }
@@ -40,6 +42,17 @@ def initialize_app(flask_app, testing=False):
     api.add_namespace(text_tasks_namespace)
     flask_app.register_blueprint(blueprint)
 
+    flask_app.before_request(metrics.start_request_timer)
+    flask_app.after_request(metrics.observe_request)
+    flask_app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+def metrics_view():
+    collector = metrics.TaskStatusCollector(
+        [models.TextTask, models.ImageTask], [status.value for status in models.StatusEnum]
+    )
+    return Response(metrics.exposition(collector), content_type=metrics.CONTENT_TYPE_LATEST)
+
 
 def main():
     app = create_app()
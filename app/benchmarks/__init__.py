@@ -0,0 +1,80 @@
+import os
+from contextlib import contextmanager
+from functools import wraps
+
+import mongomock
+from mongoengine import connect, disconnect
+from pymongo import monitoring
+
+
+# benchmarks run against mongomock by default, point them to a real server with
+# BENCH_MONGO_URI=mongodb://localhost:27017/benchmark
+MONGO_URI = os.getenv('BENCH_MONGO_URI', 'mongomock://localhost:27017/benchmark')
+
+# public mongomock collection methods which correspond to a single round-trip to a real server
+MONGOMOCK_OPERATIONS = [
+    'aggregate', 'bulk_write', 'count', 'count_documents', 'delete_many', 'delete_one', 'distinct',
+    'estimated_document_count', 'find', 'find_and_modify', 'find_one', 'find_one_and_delete',
+    'find_one_and_replace', 'find_one_and_update', 'insert', 'insert_many', 'insert_one', 'remove',
+    'replace_one', 'save', 'update', 'update_many', 'update_one',
+]
+
+
+class DBOpsCounter(monitoring.CommandListener):
+    """ Counts database round-trips - commands for a real server, outermost collection calls for mongomock """
+
+    def __init__(self):
+        self.count = 0
+        self._depth = 0
+
+    def started(self, event):
+        if event.command_name not in ('isMaster', 'hello', 'endSessions', 'ping'):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def wrap(self, method):
+        @wraps(method)
+        def inner(*args, **kwargs):
+            self._depth += 1
+            if self._depth == 1:
+                self.count += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._depth -= 1
+        return inner
+
+    @contextmanager
+    def measure(self):
+        """ Yield a dict, which gets 'ops' set to number of round-trips made inside the block """
+        result = {}
+        start = self.count
+        try:
+            yield result
+        finally:
+            result['ops'] = self.count - start
+
+
+_counter = DBOpsCounter()
+
+
+def connect_db():
+    """ Connect mongoengine for a benchmark run and return round-trips counter """
+    disconnect()
+    if MONGO_URI.startswith('mongomock://'):
+        # mongomock has no capped collections, status events of tasks go to subscribers of this process
+        os.environ.setdefault('TASK_EVENTS', 'local')
+        collection = mongomock.collection.Collection
+        for name in MONGOMOCK_OPERATIONS:
+            method = getattr(collection, name, None)
+            if method is not None and not hasattr(method, '__wrapped__'):
+                setattr(collection, name, _counter.wrap(method))
+        connect(host=MONGO_URI)
+    else:
+        connect(host=MONGO_URI, event_listeners=[_counter])
+    return _counter
@@ -0,0 +1,101 @@
+""" Database round-trips made by ImageTask.get_images per page, and size of the images documents
+    once many tasks linked them
+
+    python -m app.benchmarks.image_discovery --images 300 --unique 250 --repeat 20
+"""
+import argparse
+import time
+
+import bson
+
+from mongoengine import DoesNotExist
+
+from app import utils
+from app.benchmarks import connect_db
+from app.models import Image, ImageTask, ImageTaskLink, Page, StatusEnum
+from app.utils import get_url_from_src, run_with_asyncio
+
+
+class FakeResponse:
+    status = 200
+    headers = {}
+
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    async def text(self):
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, body):
+        self.body = body
+
+    async def get(self, url, **kwargs):
+        return FakeResponse(self.body)
+
+
+def synthetic_page(no_images, no_unique):
+    imgs = ''.join(
+        f'<img src="/static/img-{i % no_unique}.png" alt="image {i % no_unique}">' for i in range(no_images)
+    )
+    return f'<html><body>{imgs}</body></html>'
+
+
+async def legacy_get_images(task, session):
+    """ Per image get/create/push implementation used before bulk upserts and ImageTaskLink """
+    html = await task.get_html(session)
+    for html_image in utils.get_images_from_html(html):
+        html_image['src'] = get_url_from_src(html_image['src'], task.url)
+        try:
+            image = Image.objects.get(src=html_image['src'])
+        except DoesNotExist:
+            image = Image.objects.create(**html_image)
+        # the arrays are not declared in models anymore
+        Image._get_collection().update_one({'_id': image.id}, {'$push': {'tasks': task.id}})
+        ImageTask._get_collection().update_one({'_id': task.id}, {'$push': {'images': image.id}})
+
+
+def run(name, get_images, session, counter, repeat):
+    Image.drop_collection()
+    ImageTask.drop_collection()
+    ImageTaskLink.drop_collection()
+    Page.drop_collection()
+    Image.ensure_indexes()
+    ImageTaskLink.ensure_indexes()
+
+    rows = []
+    for attempt in range(repeat):
+        # first attempt discovers new images, following ones link already known images
+        task = ImageTask.objects.create(url='http://bench.local/', status=StatusEnum.IN_PROGRESS)
+        start = time.perf_counter()
+        with counter.measure() as measured:
+            run_with_asyncio(get_images)(task, session)
+        rows.append((measured['ops'], time.perf_counter() - start))
+
+    for attempt, (ops, elapsed) in enumerate(rows[:2]):
+        print(f'{name:<8} {"new" if attempt == 0 else "known":<6} round-trips: {ops:>6}   time: {elapsed * 1000:8.1f} ms')
+    # popular images are rewritten whole on every push, so the document size is written per task
+    sizes = [len(bson.BSON.encode(doc)) for doc in Image._get_collection().find()]
+    print(f'{name:<8} after {repeat} tasks largest image document: {max(sizes)} B')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=300, help='<img> tags on the page')
+    parser.add_argument('--unique', type=int, default=250, help='distinct srcs among them')
+    parser.add_argument('--repeat', type=int, default=2)
+    args = parser.parse_args()
+
+    counter = connect_db()
+    session = FakeSession(synthetic_page(args.images, args.unique))
+
+    run('before', legacy_get_images, session, counter, args.repeat)
+    run('after', ImageTask.get_images, session, counter, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
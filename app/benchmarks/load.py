@@ -0,0 +1,239 @@
+""" Load test of the api - replays a JSONL request log (or a synthetic mix of requests) at a target rate
+    and concurrency, reports latency percentiles and error rates per endpoint.
+
+    python -m app.benchmarks.load --rate 100 --duration 30 --concurrency 20
+    python -m app.benchmarks.load --log requests.jsonl --url http://127.0.0.1
+
+    Without --url the app is served in this process (one request at a time on mongomock, threaded with
+    BENCH_MONGO_URI) over seeded tasks, with celery dispatch going to an in-memory broker nobody consumes.
+    To size gunicorn workers run it against e.g.
+    CELERY_BROKER_URL=memory:// MONGODB_URI=mongodb://localhost:27017/load gunicorn -w 4 -b 127.0.0.1:5000 app.wsgi:app
+    with --url http://127.0.0.1:5000 --seed.
+
+    A line of the log is {"method": "POST", "path": "/api/text_tasks/", "json": {"url": "http://a.pl"}},
+    paths may contain {text_task}, {image_task} and {image} replaced with ids of seeded or submitted tasks.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+from contextlib import contextmanager
+
+import aiohttp
+from werkzeug.serving import make_server
+
+from app import celery_tasks
+from app.app import create_app
+from app.benchmarks import MONGO_URI, connect_db
+from app.benchmarks.queues import percentile
+from app.models import Image, ImageTask, ImageTaskLink, Page, StatusEnum, TextContent, TextTask
+
+
+# synthetic mix - (weight, method, path, json), status polling and lists dominate as in production
+MIX = [
+    (10, 'POST', '/api/text_tasks/', {'url': 'http://bench.local/text'}),
+    (5, 'POST', '/api/images_tasks/', {'url': 'http://bench.local/images'}),
+    (1, 'POST', '/api/text_tasks/batch', {'urls': [f'http://bench.local/batch/{i}' for i in range(20)]}),
+    (25, 'GET', '/api/text_tasks/{text_task}', None),
+    (15, 'GET', '/api/images_tasks/{image_task}', None),
+    (10, 'GET', '/api/text_tasks/?limit=100', None),
+    (5, 'GET', '/api/images_tasks/?status=success&limit=100', None),
+    (10, 'GET', '/api/images_tasks/{image_task}/images/', None),
+    (10, 'GET', '/api/images_tasks/{image_task}/images/{image}', None),
+    (9, 'GET', '/api/text_tasks/{text_task}/text', None),
+]
+
+OBJECT_ID = re.compile(r'/[0-9a-f]{24}(?=/|$)')
+# id nothing has, paths filled with it before any task is known get 404
+MISSING_ID = '0' * 24
+
+
+class Pool:
+    """ Ids the paths of requests are filled with, tasks submitted during the run join it """
+
+    def __init__(self, text_tasks=(), image_tasks=(), images=None):
+        self.text_tasks = list(text_tasks)
+        self.image_tasks = list(image_tasks)
+        # images of each image task
+        self.images = images or {}
+
+    def fill(self, rnd, path):
+        if '{image}' in path:
+            image_task = rnd.choice(list(self.images) or [MISSING_ID])
+            image = rnd.choice(self.images.get(image_task, [MISSING_ID]))
+            path = path.replace('{image_task}', image_task).replace('{image}', image)
+        if '{image_task}' in path:
+            path = path.replace('{image_task}', rnd.choice(self.image_tasks or [MISSING_ID]))
+        if '{text_task}' in path:
+            path = path.replace('{text_task}', rnd.choice(self.text_tasks or [MISSING_ID]))
+        return path
+
+    def add(self, path, body):
+        tasks = body if isinstance(body, list) else [body]
+        ids = [task['_id'] for task in tasks if isinstance(task, dict) and '_id' in task]
+        (self.image_tasks if path.startswith('/api/images_tasks') else self.text_tasks).extend(ids)
+
+
+def seed(tasks, images_per_task):
+    """ Store finished tasks (with text and images) the requests read, return their pool """
+    for model in (TextTask, TextContent, ImageTask, Image, ImageTaskLink, Page):
+        model.drop_collection()
+
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 200
+    content = TextContent.store(text)
+    TextTask.objects.insert([
+        TextTask(url=f'http://bench.local/text/{i}', status=StatusEnum.SUCCESS, **TextTask.text_fields(content))
+        for i in range(tasks)
+    ], load_bulk=False)
+
+    image_tasks = [ImageTask(url=f'http://bench.local/images/{i}', status=StatusEnum.SUCCESS) for i in range(tasks)]
+    ImageTask.objects.insert(image_tasks, load_bulk=False)
+    images = {}
+    for task in image_tasks:
+        srcs = {f'{task.url}/{i}.png': None for i in range(images_per_task)}
+        image_ids = Image.bulk_upsert(srcs)
+        Image.objects(pk__in=image_ids).update(
+            status=StatusEnum.SUCCESS, storage_url='/media/ab/cd/abcd.png', content_hash='abcd'
+        )
+        ImageTaskLink.bulk_link([(task.pk, image_id) for image_id in image_ids])
+        images[str(task.pk)] = [str(image_id) for image_id in image_ids]
+
+    return Pool([str(task_id) for task_id in TextTask.objects.scalar('id')], images, images)
+
+
+def load_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_requests(rnd, count):
+    weights = [weight for weight, *_ in MIX]
+    return [
+        {'method': method, 'path': path, 'json': body}
+        for _, method, path, body in rnd.choices(MIX, weights=weights, k=count)
+    ]
+
+
+def endpoint(method, path):
+    return f'{method} {OBJECT_ID.sub("/<id>", path.partition("?")[0])}'
+
+
+async def replay(base_url, requests, pool, rate, concurrency, rnd):
+    """ Send requests at the rate (open loop) with at most 'concurrency' in flight, return (endpoint, status,
+    latency) of each. Latency is measured from the time the request was due, so a stalled server
+    is not hidden by requests waiting for a free slot """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+
+    async def _send(session, due, request):
+        await asyncio.sleep(max(0.0, due - loop.time()))
+        async with semaphore:
+            path = pool.fill(rnd, request['path'])
+            try:
+                async with session.request(
+                        request['method'], base_url + path, json=request.get('json'), allow_redirects=False
+                ) as response:
+                    body = await response.read()
+                    status = response.status
+                if request['method'] == 'POST' and status == 201:
+                    pool.add(request['path'], json.loads(body))
+            except aiohttp.ClientError:
+                status = None
+            results.append((endpoint(request['method'], request['path']), status, loop.time() - due))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(
+            _send(session, start + i / rate, request) for i, request in enumerate(requests)
+        ))
+    return results, loop.time() - start
+
+
+def report(results, elapsed):
+    by_endpoint = {}
+    for name, status, latency in results:
+        by_endpoint.setdefault(name, []).append((status, latency))
+
+    print(
+        f'{"endpoint":<48} {"requests":>8} {"errors":>7} {"4xx":>7} '
+        f'{"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}'
+    )
+    for name, samples in sorted(by_endpoint.items()) + [('all', [(s, l) for _, s, l in results])]:
+        latencies = [latency for _, latency in samples]
+        # errors of the service - 4xx may be sent on purpose by the log (or unknown ids), they are shown apart
+        errors = sum(status is None or status >= 500 for status, _ in samples)
+        client_errors = sum(status is not None and 400 <= status < 500 for status, _ in samples)
+        print(
+            f'{name:<48} {len(samples):>8} {errors / len(samples):>7.1%} {client_errors / len(samples):>7.1%} '
+            f'{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.9) * 1000:>8.1f} '
+            f'{percentile(latencies, 0.99) * 1000:>8.1f} {max(latencies) * 1000:>8.1f}'
+        )
+    print(f'{len(results)} requests in {elapsed:.1f}s - {len(results) / elapsed:.1f} req/sec')
+
+
+@contextmanager
+def local_server():
+    """ Serve the app in a thread, with celery dispatch going to an in-memory broker, yield its url """
+    app = create_app(testing=True)
+    # after create_app, so models use the benchmark database
+    counter = connect_db()
+    celery_tasks.celery_app.conf.broker_url = 'memory://'
+    # mongomock is not thread safe
+    server = make_server('127.0.0.1', 0, app, threaded=not MONGO_URI.startswith('mongomock://'))
+    thread = threading.Thread(target=server.serve_forever, name='load-server', daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}', counter
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base url of a running service, the app is served in this process if not given')
+    parser.add_argument('--log', help='JSONL request log to replay (in a loop), synthetic mix if not given')
+    parser.add_argument('--rate', type=float, default=50, help='requests per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests in flight at most')
+    parser.add_argument('--seed', action='store_true', help='seed tasks of a --url service (through BENCH_MONGO_URI)')
+    parser.add_argument('--seed-tasks', type=int, default=200)
+    parser.add_argument('--images', type=int, default=5, help='images of each seeded image task')
+    parser.add_argument('--random-seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.random_seed)
+    count = int(args.rate * args.duration)
+    if args.log:
+        log = load_log(args.log)
+        requests = [log[i % len(log)] for i in range(count)]
+    else:
+        requests = synthetic_requests(rnd, count)
+
+    loop = asyncio.get_event_loop()
+    if args.url:
+        if args.seed:
+            connect_db()
+        pool = seed(args.seed_tasks, args.images) if args.seed else Pool()
+        results, elapsed = loop.run_until_complete(
+            replay(args.url.rstrip('/'), requests, pool, args.rate, args.concurrency, rnd)
+        )
+        report(results, elapsed)
+        return
+
+    with local_server() as (base_url, counter):
+        pool = seed(args.seed_tasks, args.images)
+        with counter.measure() as db:
+            results, elapsed = loop.run_until_complete(
+                replay(base_url, requests, pool, args.rate, args.concurrency, rnd)
+            )
+    report(results, elapsed)
+    print(f'db round-trips per request: {db["ops"] / len(results):.1f}')
+
+
+if __name__ == '__main__':
+    main()
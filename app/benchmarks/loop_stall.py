@@ -0,0 +1,80 @@
+""" Event loop stall time caused by status writes of concurrent image downloads - blocking vs. async data layer
+
+    python -m app.benchmarks.loop_stall --images 200 --db-latency 2
+"""
+import argparse
+import asyncio
+import time
+
+import mongomock
+
+from app.benchmarks import MONGO_URI, MONGOMOCK_OPERATIONS, connect_db
+from app.models import Image, StatusEnum
+
+
+def add_latency(seconds):
+    # mongomock answers in microseconds, real server round-trips take milliseconds
+    collection = mongomock.collection.Collection
+    for name in MONGOMOCK_OPERATIONS:
+        method = getattr(collection, name, None)
+        if method is None:
+            continue
+
+        def slow(*args, _method=method, **kwargs):
+            time.sleep(seconds)
+            return _method(*args, **kwargs)
+        setattr(collection, name, slow)
+
+
+async def download(image, blocking, network_time):
+    if blocking:
+        image.update(status=StatusEnum.IN_PROGRESS)
+        await asyncio.sleep(network_time)
+        image.update(status=StatusEnum.SUCCESS)
+    else:
+        await image.aupdate(status=StatusEnum.IN_PROGRESS)
+        await asyncio.sleep(network_time)
+        await image.aupdate(status=StatusEnum.SUCCESS)
+
+
+async def run(images, blocking, network_time, tick=0.001):
+    stalls = []
+
+    async def ticker():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            stalls.append(max(0.0, time.perf_counter() - start - tick))
+
+    ticking = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(download(image, blocking, network_time) for image in images))
+    elapsed = time.perf_counter() - start
+    ticking.cancel()
+    return elapsed, sum(stalls), max(stalls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--db-latency', type=float, default=2, help='ms added to each mongomock operation')
+    parser.add_argument('--network-time', type=float, default=50, help='ms of simulated download')
+    args = parser.parse_args()
+
+    connect_db()
+    if MONGO_URI.startswith('mongomock://'):
+        add_latency(args.db_latency / 1000)
+
+    loop = asyncio.get_event_loop()
+    for name, blocking in (('blocking', True), ('async', False)):
+        Image.drop_collection()
+        images = [Image.objects.create(src=f'http://bench.local/{i}.png') for i in range(args.images)]
+        elapsed, stalled, worst = loop.run_until_complete(run(images, blocking, args.network_time / 1000))
+        print(
+            f'{name:<9} wall: {elapsed * 1000:8.1f} ms   loop stalled: {stalled * 1000:8.1f} ms   '
+            f'longest stall: {worst * 1000:7.1f} ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
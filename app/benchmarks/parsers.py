@@ -0,0 +1,59 @@
+""" Compare html parser backends on large pages
+
+    python -m app.benchmarks.parsers                              # synthetic 1 MB page
+    python -m app.benchmarks.parsers page.html https://www.onet.pl  # saved or live pages
+"""
+import argparse
+import time
+import urllib.request
+
+from app import parsers
+from app.benchmarks.server import PARAGRAPH
+
+
+def synthetic_page(size):
+    block = PARAGRAPH + '<div class="teaser"><a href="/a"><img src="/img/a.png" alt="teaser"></a> <span>x</span></div>\n'
+    return f'<html><body>{block * (size // len(block))}<script>var x = 1;</script></body></html>'
+
+
+def load(source):
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source) as response:
+            return response.read().decode(response.headers.get_content_charset() or 'utf-8', errors='replace')
+    with open(source, encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def measure(func, html, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(html)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='*', help='html files or urls')
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='size of synthetic page')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pages = [(source, load(source)) for source in args.sources] or [('synthetic', synthetic_page(args.size))]
+    for source, html in pages:
+        print(f'{source} ({len(html) / 1024:.0f} kB)')
+        for name, backend in parsers.PARSERS.items():
+            html_parser = backend()
+            text = measure(html_parser.get_text, html, args.repeat)
+            images = measure(html_parser.get_images, html, args.repeat)
+            extract = measure(html_parser.extract, html, args.repeat)
+            print(
+                f'  {name:<12} text: {text * 1000:8.1f} ms   images: {images * 1000:8.1f} ms   '
+                f'text + images: {(text + images) * 1000:8.1f} ms   single pass: {extract * 1000:8.1f} ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
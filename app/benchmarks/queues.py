@@ -0,0 +1,112 @@
+""" Simulated latency of text tasks under a mixed load of text and image tasks -
+    one shared queue (celery defaults) vs. dedicated queues with late acks and prefetch of 1
+
+    python -m app.benchmarks.queues --workers 8 --text-workers 2 --duration 3600
+"""
+import argparse
+import heapq
+import random
+from collections import deque
+
+
+class Worker:
+    def __init__(self, queues, prefetch, acks_late):
+        self.queues = queues
+        self.prefetch = prefetch
+        self.acks_late = acks_late
+        self.reserved = deque()
+        self.busy = False
+
+    def wants(self):
+        # a worker reserves up to 'prefetch' unacknowledged messages, with late acks that includes the running one
+        return len(self.reserved) + (self.busy and self.acks_late) < self.prefetch
+
+
+def simulate(arrivals, workers, routes):
+    """ Run tasks (arrival time, kind, service time) through the workers, return latencies by kind """
+    broker = {queue: deque() for queue in set(routes.values())}
+    events = [(task[0], sequence, 'arrive', task) for sequence, task in enumerate(arrivals)]
+    heapq.heapify(events)
+    latencies = {kind: [] for kind in routes}
+    sequence = len(events)
+
+    def dispatch(now):
+        nonlocal sequence
+        for worker in workers:
+            while worker.wants():
+                # the oldest message among the queues the worker consumes
+                queues = [broker[queue] for queue in worker.queues if broker[queue]]
+                if not queues:
+                    break
+                worker.reserved.append(min(queues, key=lambda queue: queue[0][0]).popleft())
+            if not worker.busy and worker.reserved:
+                task = worker.reserved.popleft()
+                worker.busy = True
+                sequence += 1
+                heapq.heappush(events, (now + task[2], sequence, 'done', (worker, task)))
+
+    while events:
+        now, _, event, payload = heapq.heappop(events)
+        if event == 'arrive':
+            broker[routes[payload[1]]].append(payload)
+        else:
+            worker, task = payload
+            worker.busy = False
+            latencies[task[1]].append(now - task[0])
+        dispatch(now)
+    return latencies
+
+
+def generate(rnd, duration, rates, service_times):
+    arrivals = []
+    for kind, rate in rates.items():
+        now = rnd.expovariate(rate)
+        while now < duration:
+            arrivals.append((now, kind, rnd.expovariate(1 / service_times[kind])))
+            now += rnd.expovariate(rate)
+    return sorted(arrivals)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8, help='worker processes in total')
+    parser.add_argument('--text-workers', type=int, default=2, help='of them consuming the text queue')
+    parser.add_argument('--duration', type=float, default=3600, help='simulated seconds of submits')
+    parser.add_argument('--text-rate', type=float, default=2, help='text tasks per second')
+    parser.add_argument('--images-rate', type=float, default=0.1, help='image tasks per second')
+    parser.add_argument('--text-time', type=float, default=0.5, help='mean seconds of a text task')
+    parser.add_argument('--images-time', type=float, default=40, help='mean seconds of an image task')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    arrivals = generate(
+        random.Random(args.seed), args.duration, {'text': args.text_rate, 'images': args.images_rate},
+        {'text': args.text_time, 'images': args.images_time}
+    )
+    images_workers = args.workers - args.text_workers
+    scenarios = [
+        ('shared, prefetch 4', {'text': 'celery', 'images': 'celery'},
+         [Worker(['celery'], 4, False) for _ in range(args.workers)]),
+        ('shared, prefetch 1, late ack', {'text': 'celery', 'images': 'celery'},
+         [Worker(['celery'], 1, True) for _ in range(args.workers)]),
+        ('dedicated queues', {'text': 'text', 'images': 'images'},
+         [Worker(['text'], 1, True) for _ in range(args.text_workers)] +
+         [Worker(['images'], 1, True) for _ in range(images_workers)]),
+    ]
+
+    for name, routes, workers in scenarios:
+        latencies = simulate(arrivals, workers, routes)
+        text, images = latencies['text'], latencies['images']
+        print(
+            f'{name:<30} text p50: {percentile(text, 0.5):7.2f} s  p95: {percentile(text, 0.95):7.2f} s  '
+            f'p99: {percentile(text, 0.99):7.2f} s   images p50: {percentile(images, 0.5):7.1f} s'
+        )
+
+
+if __name__ == '__main__':
+    main()
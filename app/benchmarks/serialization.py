@@ -0,0 +1,101 @@
+""" Encoding of api responses - former encoders (flask-restplus JSON with MongoEngineObjectIdJSONEncoder for
+    single documents, bson.json_util for lists) against app.serializers with orjson, with the stdlib json fallback
+    and MessagePack, on a page of raw task and image documents
+
+    python -m app.benchmarks.serialization --docs 1000 --repeat 20
+"""
+import argparse
+import datetime
+import time
+from unittest import mock
+
+from bson import ObjectId, json_util
+from flask import json
+
+from app import serializers
+from app.utils import MongoEngineObjectIdJSONEncoder
+
+
+def text_task(i):
+    return {
+        '_id': ObjectId(), '_cls': 'TextTask', 'url': f'http://bench.local/text/{i}', 'status': 'success',
+        'date_created': datetime.datetime.utcnow(), 'capture_profile': False,
+        'text_hash': 'ab' * 32, 'text_size': 11400, 'text_preview': 'Lorem ipsum dolor sit amet, ' * 7,
+        'profile': {
+            'total': 0.412345, 'queued': 0.012345,
+            'phases': {name: {'time': 0.012345, 'count': 2} for name in ('page', 'page_fetch', 'parse', 'db')},
+            'counts': {'bytes': 51200},
+        },
+    }
+
+
+def image(i):
+    return {
+        '_id': ObjectId(), 'src': f'http://bench.local/images/{i}.png', 'name': f'image {i}', 'status': 'success',
+        'storage_url': '/media/ab/cd/abcd.png', 'content_hash': 'abcd' * 16, 'date_created': datetime.datetime.utcnow(),
+    }
+
+
+def former_list(docs):
+    return ''.join(['['] + [(',' if i else '') + json_util.dumps(doc) for i, doc in enumerate(docs)] + [']']).encode()
+
+
+def new_list(mimetype):
+    return lambda docs: b''.join(serializers.stream(iter(docs), mimetype))
+
+
+def each(encode):
+    # detail endpoint - one document per response
+    return lambda docs: [encode(doc) for doc in docs]
+
+
+def measure(func, docs, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(docs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=1000, help='documents of a page')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    no_orjson = mock.patch('app.serializers.orjson', None)
+    encoders = [
+        ('former', 'list', former_list, None),
+        ('orjson', 'list', new_list(serializers.JSON), None),
+        ('json', 'list', new_list(serializers.JSON), no_orjson),
+        ('msgpack', 'list', new_list(serializers.MSGPACK), None),
+        ('former', 'detail', each(lambda doc: json.dumps(doc, cls=MongoEngineObjectIdJSONEncoder).encode()), None),
+        ('orjson', 'detail', each(serializers.dumps), None),
+        ('json', 'detail', each(serializers.dumps), no_orjson),
+        ('msgpack', 'detail', each(serializers.packb), None),
+    ]
+    for kind, factory in (('text tasks', text_task), ('images', image)):
+        docs = [factory(i) for i in range(args.docs)]
+        print(f'{args.docs} {kind}')
+        baselines = {}
+        for name, endpoint, func, patch in encoders:
+            if patch is not None:
+                patch.start()
+            try:
+                elapsed = measure(func, docs, args.repeat)
+                encoded = func(docs)
+            finally:
+                if patch is not None:
+                    patch.stop()
+            size = len(encoded) if isinstance(encoded, bytes) else sum(map(len, encoded))
+            baselines.setdefault(endpoint, elapsed)
+            print(
+                f'  {endpoint:<7} {name:<8} {elapsed * 1000:8.2f} ms   {elapsed / args.docs * 1e6:6.1f} us/doc   '
+                f'{size / 1024:8.1f} kB   x{baselines[endpoint] / elapsed:5.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+""" Local web server serving synthetic pages and images for benchmarks """
+import asyncio
+import random
+import threading
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+PARAGRAPH = '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt.</p>\n'
+
+
+async def respond(request):
+    """ Wait for 'latency' seconds, fail with 500 for 'errors' fraction of requests """
+    latency = float(request.query.get('latency', 0))
+    errors = float(request.query.get('errors', 0))
+    if latency:
+        await asyncio.sleep(latency)
+    if errors and random.random() < errors:
+        raise web.HTTPInternalServerError()
+
+
+async def page(request):
+    images = int(request.query.get('images', 0))
+    size = int(request.query.get('size', 10 * 1024))
+    image_size = int(request.query.get('image_size', 1024))
+    await respond(request)
+
+    query = f'size={image_size}&latency={request.query.get("latency", 0)}&errors={request.query.get("errors", 0)}'
+    imgs = ''.join(
+        f'<img src="/img/{request.match_info["name"]}-{i}.png?{query}" alt="image {i}">\n' for i in range(images)
+    )
+    body = PARAGRAPH * max(1, size // len(PARAGRAPH))
+    html = f'<html><head><title>{request.match_info["name"]}</title></head><body>{body}{imgs}</body></html>'
+    return web.Response(text=html, content_type='text/html')
+
+
+async def image(request):
+    size = int(request.query.get('size', 1024))
+    await respond(request)
+    return web.Response(body=b'\x89PNG' + b'\0' * max(0, size - 4), content_type='image/png')
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/page/{name}', page)
+    app.router.add_get('/img/{name}', image)
+    return app
+
+
+async def start_server(host='127.0.0.1', port=0):
+    """ Start the server in the running loop, return (runner, base url) """
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
+
+
+@contextmanager
+def serve_in_thread():
+    """ Run the server in a thread with its own loop, so blocking code (celery task functions) can call it,
+    yield its base url """
+    loop = asyncio.new_event_loop()
+    started = {}
+    ready = threading.Event()
+
+    def _run():
+        asyncio.set_event_loop(loop)
+        started['runner'], started['base_url'] = loop.run_until_complete(start_server())
+        ready.set()
+        loop.run_forever()
+        loop.run_until_complete(started['runner'].cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=_run, name='bench-server', daemon=True)
+    thread.start()
+    ready.wait()
+    try:
+        yield started['base_url']
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
@@ -0,0 +1,65 @@
+""" Tasks/sec of back-to-back text tasks - fresh client session per task vs. worker process session
+
+    python -m app.benchmarks.session_reuse --tasks 200
+"""
+import argparse
+import asyncio
+import os
+import time
+from unittest import mock
+
+import aiohttp
+
+from app import worker
+from app.benchmarks import MONGO_URI, connect_db
+from app.benchmarks.server import start_server
+from app.models import Page, TextContent, TextTask
+
+
+def configure():
+    # every task fetches the page itself, localhost is not rate limited, mongomock is not thread safe
+    os.environ.update({
+        'SINGLEFLIGHT_LEASES': 'local', 'SINGLEFLIGHT_TTL': '0', 'HOST_RATE_LIMITS': 'local', 'HOST_RATE_LIMIT': '0',
+    })
+    if MONGO_URI.startswith('mongomock://'):
+        os.environ['DB_POOL_SIZE'] = '1'
+
+
+async def run_tasks(url, no_tasks, fresh_session):
+    # both runs start from an empty db, queries of mongomock slow down with number of documents
+    for model in (TextTask, Page, TextContent):
+        model.drop_collection()
+    tasks = [TextTask.objects.create(url=url) for _ in range(no_tasks)]
+
+    start = time.perf_counter()
+    for task in tasks:
+        if fresh_session:
+            # how Task.execute worked before - a new session (and connection pool) for every task
+            async with aiohttp.ClientSession() as session:
+                with mock.patch.object(worker, 'get_session', return_value=session):
+                    await task.execute()
+        else:
+            await task.execute()
+    return no_tasks / (time.perf_counter() - start)
+
+
+async def main(args):
+    runner, base_url = await start_server()
+    url = f'{base_url}/page/bench?size={args.page_size}&latency={args.latency}'
+    try:
+        for name, fresh_session in (('fresh session', True), ('worker session', False)):
+            rate = await run_tasks(url, args.tasks, fresh_session)
+            print(f'{name:<15} {rate:8.1f} tasks/sec')
+    finally:
+        await (await worker.get_session()).close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=10 * 1024)
+    parser.add_argument('--latency', type=float, default=0)
+    configure()
+    connect_db()
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
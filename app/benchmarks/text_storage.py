@@ -0,0 +1,83 @@
+""" Stored size of text tasks and time to read them - text inline in tasks vs. gzipped in TextContent
+
+    python -m app.benchmarks.text_storage --tasks 500 --size 100 --pages 100
+"""
+import argparse
+import random
+import time
+
+import bson
+
+from app import serializers
+from app.benchmarks import connect_db
+from app.manage import migrate_text
+from app.models import Page, StatusEnum, TextContent, TextTask
+
+
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore'.split()
+
+
+def synthetic_text(size, seed):
+    rnd = random.Random(seed)
+    words = [rnd.choice(WORDS) for _ in range(size // 6)]
+    return ' '.join(words)[:size]
+
+
+def stored_size():
+    return sum(len(bson.BSON.encode(doc)) for model in (TextTask, TextContent) for doc in model.objects.as_pymongo())
+
+
+def measure(name, page_size=100):
+    ids = TextTask.objects.scalar('id')
+
+    start = time.perf_counter()
+    after = None
+    while True:
+        # query of the list endpoint, which leaves the text out
+        query = {'_id': {'$gt': after}} if after else {}
+        docs = list(TextTask._get_collection().find(query, {'text': 0}).sort('_id').limit(page_size))
+        b''.join(serializers.stream(iter(docs), serializers.JSON))
+        if len(docs) < page_size:
+            break
+        after = docs[-1]['_id']
+    listed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    read_size = 0
+    for task_id in ids:
+        # task endpoint and reload() of workers, mongomock does not show the cost of reading big documents,
+        # so their size is given as well
+        read_size += len(bson.BSON.encode(TextTask.objects(pk=task_id).as_pymongo().first()))
+    read = time.perf_counter() - start
+
+    print(
+        f'{name:<8} stored: {stored_size() / 1024:9.1f} KB   list all: {listed * 1000:8.1f} ms   '
+        f'read each: {read * 1000:8.1f} ms   task document: {read_size / len(ids) / 1024:7.1f} KB'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=500)
+    parser.add_argument('--size', type=int, default=100, help='KB of text of a page')
+    parser.add_argument('--pages', type=int, default=100, help='distinct page texts among tasks')
+    args = parser.parse_args()
+
+    connect_db()
+    for model in (TextTask, TextContent, Page):
+        model.drop_collection()
+
+    texts = [synthetic_text(args.size * 1024, seed) for seed in range(args.pages)]
+    TextTask._get_collection().insert_many([
+        {'_cls': 'TextTask', 'url': f'http://bench.local/{i % args.pages}', 'status': StatusEnum.SUCCESS.value,
+         'text': texts[i % args.pages]}
+        for i in range(args.tasks)
+    ])
+
+    measure('inline')
+    migrate_text()
+    measure('gzipped')
+
+
+if __name__ == '__main__':
+    main()
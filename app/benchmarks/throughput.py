@@ -0,0 +1,186 @@
+""" End-to-end throughput of text and image tasks against the local synthetic server - tasks/sec, latency,
+    peak RSS and db round-trips per task. Tasks run through Task.execute directly and through celery task
+    functions (chunks of BATCH_CHUNK_SIZE, as a worker runs them).
+
+    python -m app.benchmarks.throughput --tasks 200 --images 10 --latency 0.05 --errors 0.01
+    python -m app.benchmarks.throughput --save-baseline app/benchmarks/baselines/throughput.json
+    python -m app.benchmarks.throughput --baseline app/benchmarks/baselines/throughput.json
+
+    Each scenario is run --repeat times and its median taken. With --baseline it exits with 1
+    if a scenario got worse than its baseline by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from app import celery_tasks, worker
+from app.benchmarks import MONGO_URI, connect_db
+from app.benchmarks.queues import percentile
+from app.benchmarks.server import serve_in_thread
+from app.models import Image, ImageTask, ImageTaskLink, Page, TaskException, TextContent, TextTask
+from app.utils import run_with_asyncio
+
+
+MODELS = {'text': TextTask, 'images': ImageTask}
+BATCH_FUNCTIONS = {'text': celery_tasks.execute_text_tasks, 'images': celery_tasks.execute_images_tasks}
+
+# lower is better for all of them but tasks/sec
+METRICS = ['tasks_per_sec', 'p50', 'p99', 'db_ops_per_task', 'peak_rss_mb']
+
+
+def configure(args, media_path):
+    # every task fetches its own page, localhost is not rate limited, mongomock is not thread safe
+    os.environ.update({
+        'MEDIA_PATH': media_path, 'SINGLEFLIGHT_LEASES': 'local', 'SINGLEFLIGHT_TTL': '0', 'HOST_RATE_LIMITS': 'local',
+        'HOST_RATE_LIMIT': '0',
+    })
+    if MONGO_URI.startswith('mongomock://'):
+        os.environ['DB_POOL_SIZE'] = '1'
+
+
+def create_tasks(kind, base_url, run, args):
+    query = (
+        f'size={args.page_size}&images={args.images if kind == "images" else 0}&image_size={args.image_size}'
+        f'&latency={args.latency}&errors={args.errors}'
+    )
+    tasks = [MODELS[kind](url=f'{base_url}/page/{run}-{i}?{query}') for i in range(args.tasks)]
+    MODELS[kind].objects.insert(tasks, load_bulk=False)
+    return tasks
+
+
+async def execute_all(tasks, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def _execute(task):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await task.execute()
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+    results = await asyncio.gather(*(_execute(task) for task in tasks), return_exceptions=True)
+    return latencies, sum(isinstance(result, Exception) for result in results)
+
+
+def run_celery(kind, tasks, concurrency):
+    for start in range(0, len(tasks), concurrency):
+        try:
+            BATCH_FUNCTIONS[kind]([str(task.pk) for task in tasks[start:start + concurrency]])
+        except TaskException:
+            # failed tasks are counted by their status
+            pass
+    # wall time of each task is in its profile
+    latencies = [task['profile']['total'] for task in MODELS[kind].objects.as_pymongo() if task.get('profile')]
+    failed = MODELS[kind].objects(status='error').count()
+    return latencies, failed
+
+
+def run_scenario(kind, driver, base_url, args, counter):
+    for model in (TextTask, TextContent, ImageTask, Image, ImageTaskLink, Page):
+        model.drop_collection()
+    tasks = create_tasks(kind, base_url, f'{kind}-{driver}', args)
+
+    with counter.measure() as db:
+        start = time.perf_counter()
+        if driver == 'execute':
+            latencies, failed = run_with_asyncio(execute_all)(tasks, args.concurrency)
+        else:
+            latencies, failed = run_celery(kind, tasks, args.concurrency)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'tasks_per_sec': round(len(tasks) / elapsed, 2),
+        'p50': round(percentile(latencies, 0.5), 4),
+        'p99': round(percentile(latencies, 0.99), 4),
+        'db_ops_per_task': round(db['ops'] / len(tasks), 2),
+        # of the whole process so far - scenarios run in order of the table
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'failed': failed,
+    }
+
+
+def median_result(runs):
+    result = {metric: statistics.median(run[metric] for run in runs) for metric in METRICS}
+    result['failed'] = max(run['failed'] for run in runs)
+    return result
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        expected = baseline.get('results', {}).get(name)
+        if expected is None:
+            continue
+        for metric in METRICS:
+            value, reference = result[metric], expected[metric]
+            worse = value < reference * (1 - tolerance) if metric == 'tasks_per_sec' \
+                else value > reference * (1 + tolerance)
+            if worse:
+                found.append(f'{name} {metric}: {value} (baseline {reference})')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=20, help='tasks running at once (celery chunk size)')
+    parser.add_argument('--page-size', type=int, default=50 * 1024)
+    parser.add_argument('--images', type=int, default=5, help='images on a page of image tasks')
+    parser.add_argument('--image-size', type=int, default=20 * 1024)
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the server waits before responding')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of requests failing with 500')
+    parser.add_argument('--kinds', default='text,images')
+    parser.add_argument('--drivers', default='execute,celery')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each scenario, median is reported')
+    parser.add_argument('--baseline', help='compare with results saved in this file')
+    parser.add_argument('--save-baseline', help='save results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative change against baseline')
+    args = parser.parse_args()
+
+    counter = connect_db()
+    results = {}
+    with tempfile.TemporaryDirectory() as media_path, serve_in_thread() as base_url:
+        configure(args, media_path)
+        try:
+            for kind in args.kinds.split(','):
+                for driver in args.drivers.split(','):
+                    name = f'{kind}/{driver}'
+                    runs = [run_scenario(kind, driver, base_url, args, counter) for _ in range(args.repeat)]
+                    results[name] = result = median_result(runs)
+                    print(
+                        f'{name:<16} {result["tasks_per_sec"]:8.1f} tasks/sec   p50: {result["p50"] * 1000:8.1f} ms   '
+                        f'p99: {result["p99"] * 1000:8.1f} ms   db ops/task: {result["db_ops_per_task"]:6.1f}   '
+                        f'peak RSS: {result["peak_rss_mb"]:7.1f} MB   failed: {result["failed"]}'
+                    )
+        finally:
+            worker.shutdown_worker_process()
+
+    params = {key: value for key, value in vars(args).items() if key not in ('baseline', 'save_baseline', 'tolerance')}
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or '.', exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(f'Parameters differ from the baseline ones: {baseline.get("params")}')
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
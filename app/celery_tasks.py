@@ -1,21 +1,69 @@
+import asyncio
+import logging
+import os
+
 from celery import Celery
+from kombu import Queue
 
-from app.models import ImageTask, TextTask
+from app import metrics
+from app.models import ImageTask, TaskException, TextTask
 from app.utils import run_with_asyncio
 
 
-celery_app = Celery('celery_tasks', broker='amqp://broker')
+celery_app = Celery('celery_tasks', broker=os.getenv('CELERY_BROKER_URL', 'amqp://broker'))
+
+MAX_PRIORITY = 9
+
+celery_app.conf.update(
+    # cheap text tasks do not wait behind image tasks downloading hundreds of files, workers of each queue scale apart
+    task_queues=[
+        Queue('text', routing_key='text', queue_arguments={'x-max-priority': MAX_PRIORITY}),
+        Queue('images', routing_key='images', queue_arguments={'x-max-priority': MAX_PRIORITY}),
+    ],
+    # single url submits go before chunks of batches
+    task_routes={
+        'app.celery_tasks.execute_text_task': {'queue': 'text', 'routing_key': 'text', 'priority': 6},
+        'app.celery_tasks.execute_text_tasks': {'queue': 'text', 'routing_key': 'text', 'priority': 3},
+        'app.celery_tasks.execute_images_task': {'queue': 'images', 'routing_key': 'images', 'priority': 6},
+        'app.celery_tasks.execute_images_tasks': {'queue': 'images', 'routing_key': 'images', 'priority': 3},
+    },
+    # tasks run long - a worker reserves only the task it starts, a task of a crashed worker is delivered again
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_prefetch_multiplier=1,
+)
+
+
+async def execute_many(tasks):
+    # a chunk of tasks shares one loop run - and the worker's session and download scheduler
+    results = await asyncio.gather(*(task.run() for task in tasks), return_exceptions=True)
+
+    failed = [(task, result) for task, result in zip(tasks, results) if isinstance(result, Exception)]
+    for task, result in failed:
+        logging.error(f"Task {task.id} failed: {result!r}")
+    if failed:
+        raise TaskException(f'{len(failed)} of {len(tasks)} tasks failed')
 
 
 @celery_app.task
 def execute_images_task(json_task):
     task = ImageTask.from_json(json_task)
     task.reload()
-    run_with_asyncio(task.execute)()
+    run_with_asyncio(metrics.track_loop_lag(task.run))()
+
+
+@celery_app.task
+def execute_images_tasks(task_ids):
+    run_with_asyncio(metrics.track_loop_lag(execute_many))(list(ImageTask.objects(pk__in=task_ids)))
 
 
 @celery_app.task
 def execute_text_task(json_task):
     task = TextTask.from_json(json_task)
     task.reload()
-    run_with_asyncio(task.execute)()
+    run_with_asyncio(metrics.track_loop_lag(task.run))()
+
+
+@celery_app.task
+def execute_text_tasks(task_ids):
+    run_with_asyncio(metrics.track_loop_lag(execute_many))(list(TextTask.objects(pk__in=task_ids)))
@@ -1,6 +1,15 @@
+from celery.signals import worker_process_init, worker_process_shutdown, worker_ready, worker_shutdown
 from mongoengine import connect
 
+from app import metrics, worker
 from app.celery_tasks import *  #  noqa
 
 
 connect(db='semantive', host='db')
+
+worker_process_init.connect(worker.init_worker_process)
+worker_process_shutdown.connect(worker.shutdown_worker_process)
+worker_shutdown.connect(worker.shutdown_worker_process)
+
+worker_ready.connect(metrics.start_worker_server)
+worker_process_shutdown.connect(metrics.mark_process_dead)
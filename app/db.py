@@ -0,0 +1,39 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from app import metrics, profiling
+
+
+_executor = None
+
+
+def get_db_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=int(os.getenv('DB_POOL_SIZE', 8)), thread_name_prefix='db')
+    return _executor
+
+
+def shutdown_db_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = None
+
+
+async def run(func, *args, **kwargs):
+    """ Run blocking database call in a thread, so the event loop keeps serving other coroutines meanwhile """
+    with profiling.phase('db', metrics.DB):
+        return await asyncio.get_event_loop().run_in_executor(get_db_executor(), partial(func, *args, **kwargs))
+
+
+class AsyncDocumentMixin:
+    """ Non-blocking variants of document methods used by worker coroutines """
+
+    async def aupdate(self, **kwargs):
+        return await run(self.update, **kwargs)
+
+    async def areload(self, *fields, **kwargs):
+        return await run(self.reload, *fields, **kwargs)
@@ -0,0 +1,10 @@
+#!/bin/sh
+set -e
+
+# metric files of the former run of the container are removed before any process of this run writes there
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+exec "$@"
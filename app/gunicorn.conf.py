@@ -0,0 +1,12 @@
+import os
+
+from app import metrics
+
+
+# long-polls and event streams hold a thread for as long as they wait
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+
+
+def child_exit(server, worker):
+    metrics.mark_process_dead(worker.pid)
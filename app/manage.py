@@ -0,0 +1,97 @@
+""" Maintenance commands, run them in the app image:
+
+    python -m app.manage migrate-media
+    python -m app.manage sync-indexes
+    python -m app.manage migrate-image-links
+    python -m app.manage migrate-text
+"""
+import argparse
+import logging
+import os
+
+from mongoengine import connect
+
+from app import utils
+from app.models import Image, ImageTask, ImageTaskLink, Page, TextContent, TextTask
+
+
+def migrate_media():
+    """ Move files of the flat, url named media directory into content addressed storage """
+    media_path = utils.get_media_path()
+    for name in sorted(os.listdir(media_path)):
+        path = os.path.join(media_path, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+
+        content_hash = utils.file_hash(path)
+        storage_url = utils.link_to_storage(path, content_hash, utils.get_storage_ext(name))
+        updated = Image.objects(storage_url=f'/media/{name}').update(storage_url=storage_url, content_hash=content_hash)
+        # removed only after images point to the new location, so an interrupted migration can be run again
+        os.unlink(path)
+        logging.info(f'Moved /media/{name} to {storage_url} ({updated} images)')
+
+
+def sync_indexes():
+    """ Create indexes declared in models meta and drop the ones no longer declared, run it on deploy """
+    for model in (Page, ImageTask, TextTask, TextContent, Image, ImageTaskLink):
+        model.ensure_indexes()
+        declared = [[(field, int(direction)) for field, direction in index] for index in model.list_indexes()]
+        collection = model._get_collection()
+        for name, info in collection.index_information().items():
+            if name != '_id_' and [(field, int(direction)) for field, direction in info['key']] not in declared:
+                collection.drop_index(name)
+                logging.info(f'Dropped index {name} of {collection.name}')
+
+
+def migrate_image_links():
+    """ Move Image.tasks and ImageTask.images arrays into ImageTaskLink collection """
+    images = Image._get_collection()
+    for doc in images.find({'tasks': {'$exists': True}}, {'tasks': 1}):
+        ImageTaskLink.bulk_link([(task_id, doc['_id']) for task_id in doc['tasks']])
+        # dropped only after links are written, so an interrupted migration can be run again
+        images.update_one({'_id': doc['_id']}, {'$unset': {'tasks': ''}})
+
+    tasks = ImageTask._get_collection()
+    for doc in tasks.find({'images': {'$exists': True}}, {'images': 1}):
+        ImageTaskLink.bulk_link([(doc['_id'], image_id) for image_id in doc['images']])
+        tasks.update_one({'_id': doc['_id']}, {'$unset': {'images': ''}})
+    logging.info(f'Linked images and tasks, {ImageTaskLink.objects.count()} links')
+
+
+def migrate_text():
+    """ Move text stored inline in TextTask and Page documents into TextContent """
+    tasks = TextTask._get_collection()
+    for doc in tasks.find({'text': {'$exists': True}}, {'text': 1}):
+        update = {'$unset': {'text': ''}}
+        if doc['text'] is not None:
+            update['$set'] = TextTask.text_fields(TextContent.store(doc['text']))
+        tasks.update_one({'_id': doc['_id']}, update)
+
+    pages = Page._get_collection()
+    for doc in pages.find({'text': {'$exists': True}}, {'text': 1}):
+        update = {'$unset': {'text': ''}}
+        if doc['text'] is not None:
+            update['$set'] = {'text_hash': TextContent.store(doc['text']).content_hash}
+        pages.update_one({'_id': doc['_id']}, update)
+    logging.info(f'Moved text, {TextContent.objects.count()} distinct texts')
+
+
+COMMANDS = {
+    'migrate-media': migrate_media,
+    'sync-indexes': sync_indexes,
+    'migrate-image-links': migrate_image_links,
+    'migrate-text': migrate_text,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=COMMANDS)
+    args = parser.parse_args()
+
+    connect(db=os.getenv('MONGODB_DB', 'semantive'), host=os.getenv('MONGODB_HOST', 'db'))
+    COMMANDS[args.command]()
+
+
+if __name__ == '__main__':
+    main()
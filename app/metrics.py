@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+from functools import wraps
+
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+
+
+def prepare_multiprocess_dir():
+    """ Create PROMETHEUS_MULTIPROC_DIR, metrics open their files in it as soon as they are created (on import).
+    Files of the former run are removed by the image entrypoint, before any process of this run writes there """
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        os.makedirs(path, exist_ok=True)
+
+
+prepare_multiprocess_dir()
+
+# metrics of gunicorn and celery pool processes are aggregated from files in PROMETHEUS_MULTIPROC_DIR
+SECONDS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PHASE_SECONDS = Histogram(
+    'task_phase_duration_seconds', 'Duration of a phase of task execution', ['phase'], buckets=SECONDS_BUCKETS
+)
+DOWNLOADED_BYTES = Counter('downloaded_bytes', 'Bytes of pages and images downloaded', ['kind'])
+TASKS_FINISHED = Counter('tasks_finished', 'Tasks executed by the worker', ['type', 'status'])
+QUEUE_LAG_SECONDS = Histogram(
+    'task_queue_lag_seconds', 'Time from submit of a task until a worker starts it', ['type'], buckets=SECONDS_BUCKETS
+)
+LOOP_LAG_SECONDS = Histogram(
+    'event_loop_lag_seconds', 'Delay of event loop callbacks behind their schedule',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Latency of api requests (until the first byte of a streamed body)',
+    ['endpoint', 'method', 'status'], buckets=SECONDS_BUCKETS
+)
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    'host_rate_limit_wait_seconds', 'Time requests waited for their turn of the rate limit of their host',
+    buckets=SECONDS_BUCKETS
+)
+# labelled only with hosts, which got throttled - not with every host a task met
+THROTTLED_REQUESTS = Counter('host_throttled_requests', 'Requests delayed by the rate limit of their host', ['host'])
+THROTTLED_SECONDS = Counter('host_throttled_seconds', 'Time delayed requests to the host waited', ['host'])
+RETRY_AFTER_PAUSES = Counter('host_retry_after_pauses', 'Pauses of requests to the host asked by Retry-After', ['host'])
+# summed over live pool processes, each has its own download scheduler
+DOWNLOADS_IN_FLIGHT = Gauge('image_downloads_in_flight', 'Image downloads running', multiprocess_mode='livesum')
+DOWNLOADS_QUEUED = Gauge(
+    'image_downloads_queued', 'Image downloads waiting for a slot of the download scheduler', multiprocess_mode='livesum'
+)
+
+# children of hot paths are resolved once
+PAGE_FETCH = PHASE_SECONDS.labels('page_fetch')
+PARSE = PHASE_SECONDS.labels('parse')
+DB = PHASE_SECONDS.labels('db')
+IMAGE_DOWNLOAD = PHASE_SECONDS.labels('image_download')
+PAGE_BYTES = DOWNLOADED_BYTES.labels('page')
+IMAGE_BYTES = DOWNLOADED_BYTES.labels('image')
+
+
+async def _sample_loop_lag(interval):
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - interval))
+
+
+def track_loop_lag(async_func):
+    """ Sample lag of the event loop (every LOOP_LAG_INTERVAL seconds) while the coroutine function runs """
+    @wraps(async_func)
+    async def inner(*args, **kwargs):
+        sampler = asyncio.ensure_future(_sample_loop_lag(float(os.getenv('LOOP_LAG_INTERVAL', 0.5))))
+        try:
+            return await async_func(*args, **kwargs)
+        finally:
+            sampler.cancel()
+            await asyncio.gather(sampler, return_exceptions=True)
+    return inner
+
+
+class TaskStatusCollector:
+    """ Number of tasks of each status, counted (on the status index) when metrics are scraped """
+
+    def __init__(self, models, statuses):
+        self.models = models
+        self.statuses = statuses
+
+    def collect(self):
+        family = GaugeMetricFamily('tasks', 'Tasks by type and status', labels=['type', 'status'])
+        for model in self.models:
+            for status in self.statuses:
+                family.add_metric([model.__name__, status], model.objects(status=status).count())
+        yield family
+
+
+def get_registry():
+    """ Return registry of metrics of all processes, or of this one if PROMETHEUS_MULTIPROC_DIR is not set """
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def exposition(*collectors):
+    registry = CollectorRegistry(auto_describe=False)
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(get_registry()) + generate_latest(registry)
+
+
+def mark_process_dead(pid=None, **kwargs):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def start_worker_server(**kwargs):
+    """ Serve metrics of the celery worker and its pool processes on WORKER_METRICS_PORT """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        start_http_server(int(os.getenv('WORKER_METRICS_PORT', 9100)), registry=get_registry())
+
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.labels(request.endpoint or 'unknown', request.method, response.status_code).observe(
+            time.perf_counter() - started
+        )
+    return response
@@ -1,16 +1,24 @@
 import asyncio
+import contextlib
+import hashlib
 import logging
+import os
 from enum import Enum
 
 import aiohttp
 from app.fields import StringEnumField
 from flask_mongoengine import Document
-from mongoengine import DoesNotExist
+from mongoengine.errors import ValidationError
 from mongoengine.fields import *
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import datetime
 
-from app import utils
-from app.utils import ParsingException, get_url_from_src
+from app import db, metrics, notifications, profiling, ratelimit, resilience, utils, worker
+from app.db import AsyncDocumentMixin
+from app.scheduler import get_download_scheduler
+from app.singleflight import get_singleflight
+from app.utils import ParsingException, StorageLimitExceeded, get_url_from_src
 
 FORMAT = '%(asctime)-15s %(levelname)-10s %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -27,128 +35,514 @@ class TaskException(Exception):
     pass
 
 
-class Task(Document):
+class Page(Document):
+    """ Validators and parse results of the last fetch of an url, reused when the page has not changed """
+    url = StringField(required=True, unique=True)
+    etag = StringField(required=False)
+    last_modified = StringField(required=False)
+    body_hash = StringField(required=False)
+    text_hash = StringField(required=False)
+    images = ListField(DictField(), default=None)
+    date_fetched = DateTimeField(default=datetime.datetime.utcnow)
+
+    # documents written before TextContent may still hold inline 'text'
+    meta = {'strict': False}
+
+    @classmethod
+    def for_url(cls, url):
+        return cls.objects(url=url).first() or cls(url=url)
+
+    def is_fresh(self, field):
+        """ Whether the field holds a parse result of a fetch recent enough to be reused without asking the server """
+        ttl = float(os.getenv('SINGLEFLIGHT_TTL', 10))
+        return self[field] is not None and self.date_fetched > datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def refresh(self, headers, html):
+        """ Take validators of a fetched page, return True if its body is the same as cached one """
+        body_hash = hashlib.sha256(html.encode()).hexdigest()
+        unchanged = body_hash == self.body_hash
+        if not unchanged:
+            self.text_hash = None
+            self.images = None
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+        self.body_hash = body_hash
+        self.date_fetched = datetime.datetime.utcnow()
+        return unchanged
+
+    def store(self, **results):
+        for field, value in results.items():
+            self[field] = value
+        # upsert - other task could have cached the url meanwhile
+        self.__class__.objects(url=self.url).update_one(
+            upsert=True, **{f'set__{field}': self[field] for field in (
+                'etag', 'last_modified', 'body_hash', 'text_hash', 'images', 'date_fetched'
+            )}
+        )
+
+
+class TextContent(Document):
+    """ Gzipped text extracted from a page, kept out of task documents and shared by tasks of the same text """
+    content_hash = StringField(primary_key=True)
+    length = IntField(required=True)
+    preview = StringField(required=False)
+    data = BinaryField(required=True)
+    date_created = DateTimeField(default=datetime.datetime.utcnow)
+
+    @classmethod
+    def store(cls, text):
+        """ Save text unless the same one is stored already, return it without data """
+        encoded = text.encode()
+        content = cls(
+            content_hash=hashlib.sha256(encoded).hexdigest(), length=len(encoded),
+            preview=text[:utils.get_text_preview_size()]
+        )
+        cls.objects(pk=content.content_hash).update_one(
+            upsert=True, set_on_insert__length=content.length, set_on_insert__preview=content.preview,
+            set_on_insert__data=utils.compress_text(text), set_on_insert__date_created=content.date_created
+        )
+        return content
+
+    @classmethod
+    def summary(cls, content_hash):
+        return cls.objects.exclude('data').get(pk=content_hash)
+
+    @property
+    def text(self):
+        return utils.decompress_text(self.data)
+
+
+class Task(AsyncDocumentMixin, Document):
     url = URLField(required=True)
     status = StringEnumField(enum=StatusEnum, required=True, default=StatusEnum.WAITING)
     date_created = DateTimeField(default=datetime.datetime.utcnow)
+    # time spent in phases of the last run, with top functions of cProfile if it was asked for on submit
+    profile = DictField(required=False, default=None)
+    capture_profile = BooleanField(default=False)
+    # the finished task is posted there
+    callback_url = URLField(required=False)
+
+    meta = {
+        'allow_inheritance': True,
+        'abstract': True,
+        # list endpoint filters, pages are always ordered by _id - creation time is filtered on _id itself
+        'indexes': [('status', '_id')],
+    }
+
+    # field of Page caching parse result of the task type
+    cached_field = None
+    # heavy fields list pages leave out unless they are asked for with ?fields=
+    list_excluded_fields = ('profile',)
+
+    async def aupdate(self, **kwargs):
+        result = await super().aupdate(**kwargs)
+        if 'status' in kwargs:
+            # clients waiting for the task (long-poll, event streams) are woken up
+            await db.run(notifications.get_pubsub().publish, notifications.status_event(self, kwargs['status']))
+        return result
+
+    async def get_html(self, session: aiohttp.ClientSession, page=None):
+        """ Return html of the page, None if it has not changed since parse result was cached in page """
+        cached = page is not None and page[self.cached_field] is not None
+        try:
+            with profiling.phase('page_fetch', metrics.PAGE_FETCH):
+                response, html = await resilience.call(
+                    utils.get_host(self.url), self._load_html, session, page.conditional_headers() if cached else None
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError):
+            logging.exception(f"Exception occurred when opening {self.url}")
+            raise
+
+        if html is None or (page is not None and page.refresh(response.headers, html) and cached):
+            return None
+        return html
+
+    async def _load_html(self, session, headers):
+        response = await ratelimit.get(session, self.url, headers=headers)
+        if headers and response.status == 304:
+            return response, None
+        response.raise_for_status()
+        html = await response.text()
+        profiling.count('bytes', len(html.encode()), metrics.PAGE_BYTES)
+        return response, html
+
+    async def get_page_result(self, session):
+        """ Return parse result of the page for the task type. Tasks of the same url and type running meanwhile
+        share one fetch and parse, sets ERROR status if it failed """
+        try:
+            # includes waiting for the fetch of other task
+            with profiling.phase('page'):
+                return await get_singleflight().run(
+                    f'{self.__class__.__name__}:{self.url}', self._fetch_page_result, session
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, ParsingException):
+            await self.aupdate(status=StatusEnum.ERROR)
+            raise
 
-    meta = {'allow_inheritance': True, 'abstract': True}
+    async def _fetch_page_result(self, session):
+        page = await db.run(Page.for_url, self.url)
+        # other task has just fetched the page (maybe in other worker, while we waited for the lease)
+        if page.is_fresh(self.cached_field):
+            return await self.cached_result(page)
+
+        html = await self.get_html(session, page)
+        if html is None:
+            # revalidated, following tasks can reuse it for a while
+            page.date_fetched = datetime.datetime.utcnow()
+            await db.run(page.store)
+            return await self.cached_result(page)
+        return await self.parse_page(html, page)
+
+    async def cached_result(self, page):
+        raise NotImplementedError
 
-    async def get_html(self, session: aiohttp.ClientSession):
+    async def parse_page(self, html, page):
+        """ Parse html once for text and images and cache both in page, tasks of either type reuse them
+        while the page does not change. Return result of the task type """
         try:
-            response = await session.get(self.url)
-            response.raise_for_status()
-            return await response.text()
-        except (aiohttp.ClientError, UnicodeError):
-            logging.exception(f"Exception occurred when opening {self.url}")
-            self.update(status=StatusEnum.ERROR)
+            parsed = await utils.run_parser(utils.extract_from_html, html)
+        except ParsingException:
+            logging.exception(f"Could not parse {self.url}")
             raise
+        content = await db.run(TextContent.store, parsed['text'])
+        await db.run(page.store, text_hash=content.content_hash, images=parsed['images'])
+        return self.page_result(content, parsed['images'])
+
+    def page_result(self, content, images):
+        raise NotImplementedError
 
     async def execute(self):
         raise NotImplementedError
 
+    async def run(self):
+        """ Execute the task and save time spent in its phases to 'profile' """
+        task_type = self.__class__.__name__
+        queued = (datetime.datetime.utcnow() - self.date_created).total_seconds()
+        metrics.QUEUE_LAG_SECONDS.labels(task_type).observe(queued)
+
+        profile = profiling.TaskProfile(queued)
+        # phases timed in coroutines of the task go to its profile
+        profiling.current_profile.set(profile)
+        capture = profiling.capture(profile) if profiling.should_capture(self.capture_profile) \
+            else contextlib.nullcontext()
+        try:
+            with capture:
+                await self.execute_within_deadline()
+        except Exception:
+            metrics.TASKS_FINISHED.labels(task_type, StatusEnum.ERROR.value).inc()
+            raise
+        else:
+            metrics.TASKS_FINISHED.labels(task_type, StatusEnum.SUCCESS.value).inc()
+        finally:
+            await self.aupdate(profile=profile.to_dict())
+            if self.callback_url:
+                await self.send_callback()
+
+    async def send_callback(self):
+        """ Post the finished task to its callback url, a failed delivery does not fail the task """
+        try:
+            await self.areload()
+            await notifications.send_webhook(await worker.get_session(), self.callback_url, self.to_mongo())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logging.exception(f"Could not post task {self.id} to {self.callback_url}")
+
+    async def execute_within_deadline(self):
+        """ Execute the task, cancel it and set ERROR status if it does not finish within TASK_DEADLINE seconds """
+        deadline = float(os.getenv('TASK_DEADLINE', 600))
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            await asyncio.wait_for(self.execute(), deadline or None)
+        except asyncio.TimeoutError:
+            if not deadline or loop.time() - started < deadline:
+                # timeout of a request, which has set the status already
+                raise
+            logging.error(f"Task {self.id} exceeded its deadline of {deadline:.0f}s")
+            await self.aupdate(status=StatusEnum.ERROR)
+            raise TaskException(f'Task {self.id} exceeded its deadline')
+
 
 class ImageTask(Task):
-    images = ListField(ReferenceField('Image'))
+    # images found on the page are linked with ImageTaskLink, documents written before may still hold 'images' array
+    meta = {'strict': False}
+
+    cached_field = 'images'
+
+    def linked_images(self):
+        return list(Image.objects(pk__in=ImageTaskLink.image_ids(self.id)))
+
+    async def cached_result(self, page):
+        return page.images
+
+    def page_result(self, content, images):
+        return images
 
     async def get_images(self, session):
-        html = await self.get_html(session)
-        try:
-            html_images = utils.get_images_from_html(html)
-        except ParsingException:
-            self.update(status=StatusEnum.ERROR)
-            raise
+        html_images = await self.get_page_result(session)
 
+        # dedupe in memory - a page often repeats the same image (icons, spacers), first occurrence wins
+        images = {}
         for html_image in html_images:
-            html_image['src'] = get_url_from_src(html_image['src'], self.url)
             try:
-                image = Image.objects.get(src=html_image['src'])
-            except DoesNotExist:
-                image = Image.objects.create(**html_image)
+                src = get_url_from_src(html_image['src'], self.url)
+            except ValueError:
+                # data: and javascript: srcs, broken urls - other images of the page are still downloaded
+                logging.warning(f"Skipped image {html_image['src'][:128]!r} of task {self.id}, it has no url")
+                continue
+            images.setdefault(src, html_image.get('name'))
+
+        if not images:
+            return
 
-            # if we had downloaded the image before or it is in progress by other task, still attach it to this task
-            # we will skip download later on
-            image.update(push__tasks=self.id)
-            self.update(push__images=image.id)
+        # if we had downloaded the image before or it is in progress by other task, still attach it to this task
+        # we will skip download later on
+        image_ids = await db.run(Image.bulk_upsert, images)
+        await db.run(ImageTaskLink.bulk_link, [(self.id, image_id) for image_id in image_ids])
 
     async def download_images(self, session):
-        self.reload()
+        images = await db.run(self.linked_images)
 
-        # ERROR - if an image download had not succeeded before - retry
         # SUCCESS - if image had been already downloaded - skip
-        # IN PROGRESS - if image is being downloaded by other task,
-        #       let the other task to manage its status - skip
-        coros = [
-            image.download_image(self, session) for image in self.images
-            if image.status in [StatusEnum.WAITING, StatusEnum.ERROR]
-        ]
+        # WAITING, ERROR - download it, ERROR of a former attempt is retried
+        # IN PROGRESS - wait until the task (maybe of other worker) holding its lease finishes,
+        #       take it over if the lease expires
+        coros = [image.fetch(self, session) for image in images if image.status != StatusEnum.SUCCESS]
+        profiling.count('images_skipped', len(images) - len(coros))
         results = await asyncio.gather(*coros, return_exceptions=True)
+        for result in results:
+            profiling.count(
+                'images_failed' if isinstance(result, Exception) else 'images_downloaded' if result else 'images_skipped'
+            )
 
         if any(isinstance(result, Exception) for result in results):
-            self.update(status=StatusEnum.ERROR)
+            await self.aupdate(status=StatusEnum.ERROR)
             raise TaskException(f'Could not download some of images')
 
-        self.update(status=StatusEnum.SUCCESS)
+        await self.aupdate(status=StatusEnum.SUCCESS)
 
     async def execute(self):
-        self.update(status=StatusEnum.IN_PROGRESS)
+        await self.aupdate(status=StatusEnum.IN_PROGRESS)
 
-        async with aiohttp.ClientSession() as session:
-            await self.get_images(session)
-            await self.download_images(session)
+        session = await worker.get_session()
+        await self.get_images(session)
+        await self.download_images(session)
 
 
 class TextTask(Task):
-    text = StringField(required=False)
+    # text itself is in TextContent, documents written before may still hold inline 'text'
+    text_hash = StringField(required=False)
+    text_size = IntField(required=False)
+    text_preview = StringField(required=False)
 
-    async def get_text(self, session: aiohttp.ClientSession):
-        html = await self.get_html(session)
+    meta = {'strict': False}
 
-        try:
-            text = utils.get_text_from_html(html)
-        except ParsingException:
-            logging.exception(f"Could not parse {self.url}")
-            self.update(status=StatusEnum.ERROR)
-            raise
+    cached_field = 'text_hash'
+
+    @staticmethod
+    def text_fields(content):
+        return {'text_hash': content.content_hash, 'text_size': content.length, 'text_preview': content.preview}
 
-        self.update(text=text, status=StatusEnum.SUCCESS)
+    def load_text(self):
+        if self.text_hash:
+            return TextContent.objects.get(pk=self.text_hash).text
+
+    async def cached_result(self, page):
+        return await db.run(TextContent.summary, page.text_hash)
+
+    def page_result(self, content, images):
+        return content
+
+    async def get_text(self, session: aiohttp.ClientSession):
+        content = await self.get_page_result(session)
+        await self.aupdate(**self.text_fields(content), status=StatusEnum.SUCCESS)
 
     async def execute(self):
-        self.update(status=StatusEnum.IN_PROGRESS)
+        await self.aupdate(status=StatusEnum.IN_PROGRESS)
 
-        async with aiohttp.ClientSession() as session:
-            await self.get_text(session)
+        session = await worker.get_session()
+        await self.get_text(session)
 
 
-class Image(Document):
+class Image(AsyncDocumentMixin, Document):
     src = URLField(required=True, unique=True)
     name = StringField(max_length=128, required=False)
     status = StringEnumField(enum=StatusEnum, required=True, default=StatusEnum.WAITING)
-    storage_url = StringField(required=False, regex=r'\/media\/[a-z0-9\.\-\_]*')
+    storage_url = StringField(required=False, regex=r'\/media\/[a-z0-9\.\-\_\/]*')
+    content_hash = StringField(required=False)
     date_created = DateTimeField(default=datetime.datetime.utcnow)
-    tasks = ListField(ReferenceField(ImageTask))
+    # worker downloading the image, it renews the lease until the download is done
+    lease_owner = StringField(required=False)
+    lease_expires = DateTimeField(required=False)
+
+    # documents written before ImageTaskLink may still hold 'tasks' array
+    meta = {'indexes': ['content_hash'], 'strict': False}
+
+    @classmethod
+    def bulk_upsert(cls, images):
+        """ Create missing images ({src: name}) in one bulk write, return ids of them in the given order -
+        images, which are not valid, are skipped """
+        max_name_length = cls._fields['name'].max_length
+        requests = []
+        valid = []
+        for src, name in images.items():
+            # alt texts can be of any length, the name is only a label of the image
+            image = cls(src=src, name=name[:max_name_length] if name else name)
+            try:
+                image.validate()
+            except ValidationError as e:
+                logging.warning(f"Skipped image {src[:128]!r}: {e}")
+                continue
+            valid.append(src)
+            on_insert = image.to_mongo().to_dict()
+            on_insert.pop('src')
+            # existing images are not written to at all
+            requests.append(UpdateOne({'src': src}, {'$setOnInsert': on_insert}, upsert=True))
+        bulk_upsert(cls._get_collection(), requests)
+
+        ids = {doc['src']: doc['_id'] for doc in cls.objects(src__in=valid).only('src').as_pymongo()}
+        return [ids[src] for src in valid]
+
+    def claim(self, owner, lease_time):
+        """ Take download of the image, unless it is done or other worker holds a valid lease of it,
+        return True if taken """
+        now = datetime.datetime.utcnow()
+        claimable = {'$or': [
+            {'status': {'$in': [StatusEnum.WAITING.value, StatusEnum.ERROR.value]}},
+            # IN PROGRESS without a lease was left by a worker of former version
+            {'status': StatusEnum.IN_PROGRESS.value, 'lease_expires': {'$not': {'$gt': now}}},
+        ]}
+        image = self.__class__.objects(pk=self.pk, __raw__=claimable).modify(
+            new=True, set__status=StatusEnum.IN_PROGRESS, set__lease_owner=owner,
+            set__lease_expires=now + datetime.timedelta(seconds=lease_time)
+        )
+        for field in ('status', 'lease_owner', 'lease_expires'):
+            self[field] = getattr(image or self, field)
+        return image is not None
+
+    def renew(self, owner, lease_time):
+        """ Extend the lease, return False if it was taken over meanwhile """
+        lease_expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_time)
+        return bool(self.__class__.objects(pk=self.pk, lease_owner=owner).update(set__lease_expires=lease_expires))
+
+    async def fetch(self, task, session):
+        """ Download the image unless it is downloaded already, wait for a download in progress,
+        return True if it was downloaded by this call """
+        owner = worker.get_worker_id()
+        lease_time = float(os.getenv('IMAGE_LEASE_TIME', 60))
+        poll_interval = float(os.getenv('IMAGE_POLL_INTERVAL', 1))
+
+        while not await db.run(self.claim, owner, lease_time):
+            await self.areload('status', 'lease_owner', 'lease_expires')
+            if self.status == StatusEnum.SUCCESS:
+                return False
+            await asyncio.sleep(poll_interval)
+
+        renewal = asyncio.ensure_future(self._renew_lease(owner, lease_time))
+        try:
+            await get_download_scheduler().run(utils.get_host(self.src), self.download_image, task, session, owner)
+        except asyncio.CancelledError:
+            # task ran out of its deadline, the download can be taken at once instead of when the lease expires
+            await self.finish(owner, status=StatusEnum.ERROR)
+            raise
+        finally:
+            renewal.cancel()
+        return True
+
+    async def _renew_lease(self, owner, lease_time):
+        while True:
+            await asyncio.sleep(lease_time / 3)
+            if not await db.run(self.renew, owner, lease_time):
+                # expired while the worker was stalled, the other download will write the same content
+                logging.warning(f"Lease of image {self.src} was taken over")
+                return
+
+    async def finish(self, owner, **fields):
+        """ Set result of the download and drop its lease, return False if the lease was taken over meanwhile -
+        the result is left to the worker holding it """
+        finished = await db.run(
+            self.__class__.objects(pk=self.pk, lease_owner=owner).update,
+            unset__lease_owner=True, unset__lease_expires=True, **fields
+        )
+        if not finished:
+            logging.warning(f"Lease of image {self.src} was taken over, its result is not saved")
+        return bool(finished)
+
+    async def download_image(self, task, session, owner):
+        try:
+            with profiling.phase('image_download', metrics.IMAGE_DOWNLOAD):
+                content_hash, storage_url = await resilience.call(utils.get_host(self.src), self._download, session)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logging.exception(f"Exception occurred during {self.src} download for task {task.id}")
+            await self.finish(owner, status=StatusEnum.ERROR)
+            raise
+        except StorageLimitExceeded:
+            logging.exception(f"Image {self.src} is too big to download for task {task.id}")
+            await self.finish(owner, status=StatusEnum.ERROR)
+            raise
+        except OSError:
+            logging.exception(f"Cannot open file to save image")
+            await self.finish(owner, status=StatusEnum.ERROR)
+            raise
 
-    async def download_image(self, task, session):
-        self.update(status=StatusEnum.IN_PROGRESS)
+        await self.finish(owner, storage_url=storage_url, content_hash=content_hash, status=StatusEnum.SUCCESS)
 
+    async def _download(self, session):
+        max_size = utils.get_max_image_size()
+        response = await ratelimit.get(session, self.src)
         try:
-            response = await session.get(self.src)
             response.raise_for_status()
-            content = await response.read()
-        except (aiohttp.ClientError, UnicodeError):
-            logging.exception(f"Exception occurred during {self.src} download for task {task.id}")
-            self.update(status=StatusEnum.ERROR)
+            utils.check_content_length(response.content_length, max_size)
+            chunks = profiling.count_bytes(
+                response.content.iter_chunked(utils.get_download_chunk_size()), metrics.IMAGE_BYTES
+            )
+            return await utils.write_to_storage(chunks, max_size, utils.get_storage_ext(self.src))
+        except StorageLimitExceeded:
+            # do not drain the rest of the body, drop the connection instead
+            response.close()
             raise
 
-        storage_path, storage_url = utils.get_storage_path_and_url(self.src)
-        try:
 
-            utils.write_to_storage(storage_path, content)
-        except FileExistsError:
-            pass
-        except OSError:
-            logging.exception(f"Cannot open file to save image")
-            self.update(status=StatusEnum.ERROR)
-            raise
+class ImageTaskLink(Document):
+    """ Image found on the page of a task. Kept apart from both, so a popular image does not grow with every task """
+    task = ReferenceField(ImageTask, required=True)
+    image = ReferenceField(Image, required=True)
+    date_created = DateTimeField(default=datetime.datetime.utcnow)
+
+    meta = {'indexes': [{'fields': ('task', 'image'), 'unique': True}, ('image', 'task')]}
+
+    @classmethod
+    def bulk_link(cls, links):
+        """ Insert missing (task id, image id) links in one bulk write """
+        requests = [
+            UpdateOne({'task': task_id, 'image': image_id},
+                      {'$setOnInsert': {'date_created': datetime.datetime.utcnow()}}, upsert=True)
+            for task_id, image_id in links
+        ]
+        bulk_upsert(cls._get_collection(), requests)
 
-        self.update(storage_url=storage_url, status=StatusEnum.SUCCESS)
+    @classmethod
+    def image_ids(cls, task_id):
+        return [link['image'] for link in cls.objects(task=task_id).only('image').as_pymongo()]
+
+
+def bulk_upsert(collection, requests):
+    """ Run upserts matching on unique index in one unordered bulk write """
+    while requests:
+        try:
+            collection.bulk_write(requests, ordered=False)
+            break
+        except BulkWriteError as e:
+            # other worker inserted the same document between our match and insert (unique index),
+            # the document exists now, so replaying the failed upserts just matches it
+            errors = e.details['writeErrors']
+            if any(error['code'] != 11000 for error in errors):
+                raise
+            requests = [requests[error['index']] for error in errors]
@@ -0,0 +1,199 @@
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import threading
+import time
+
+import aiohttp
+from bson import Timestamp
+from mongoengine.connection import get_db
+from pymongo import CursorType, DESCENDING
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+from app import resilience, serializers, utils
+
+
+class Subscription:
+    """ Status events of a set of tasks, received since the subscription was made """
+
+    def __init__(self, pubsub, task_ids):
+        self.pubsub = pubsub
+        self.task_ids = {str(task_id) for task_id in task_ids}
+        self._events = queue.Queue()
+
+    def put(self, event):
+        self._events.put(event)
+
+    def get(self, timeout=None):
+        """ Return the next event, None if none came within timeout seconds """
+        try:
+            return self._events.get(timeout=max(0.0, timeout) if timeout is not None else None)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalPubSub:
+    """ Events published in this process only, stand-in for MongoPubSub in tests and single process setups """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        """ Hand the event to subscriptions of its task """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(event['task'], ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, task_ids):
+        subscription = Subscription(self, task_ids)
+        with self._lock:
+            for task_id in subscription.task_ids:
+                self._subscriptions.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for task_id in subscription.task_ids:
+                subscriptions = self._subscriptions.get(task_id, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self._subscriptions.pop(task_id, None)
+
+
+class MongoPubSub(LocalPubSub):
+    """
+    Events of all processes, written to a capped collection. Each api process tails it with a single cursor
+    (in a thread started by the first subscription) and hands events to its subscriptions, so waiting clients
+    do not read the database.
+
+    Events are read in order of 'ts' timestamps, which the server sets on insert - ObjectIds are made by clients
+    and are not ordered across processes.
+    """
+
+    def __init__(self, collection_name='task_events', size=None, poll_interval=None):
+        super().__init__()
+        self.collection_name = collection_name
+        self.size = size or int(os.getenv('TASK_EVENTS_SIZE', 16 * 1024 * 1024))
+        self.poll_interval = poll_interval or float(os.getenv('TASK_EVENTS_POLL_INTERVAL', 1))
+        self._collection_ready = False
+        self._tailer = None
+        self._tailer_lock = threading.Lock()
+        # 'ts' of the last event read by the tailer
+        self._after = None
+
+    @property
+    def collection(self):
+        return get_db()[self.collection_name]
+
+    def ensure_collection(self):
+        # a plain collection would be created by the first insert, it has to be capped for tailing
+        if not self._collection_ready:
+            try:
+                get_db().create_collection(self.collection_name, capped=True, size=self.size)
+            except CollectionInvalid:
+                # exists already
+                self._after = self.last_ts()
+            self._collection_ready = True
+
+    def stamp(self, event):
+        # the server replaces an empty timestamp of a top level field with its current one (servers before 5.0
+        # only in the first two fields - _id is the first)
+        return {'ts': Timestamp(0, 0), **event}
+
+    def publish(self, event):
+        self.ensure_collection()
+        self.collection.insert_one(self.stamp(event))
+
+    def subscribe(self, task_ids):
+        self.start()
+        return super().subscribe(task_ids)
+
+    def start(self):
+        with self._tailer_lock:
+            if self._tailer is None:
+                # position is taken before the subscriber reads statuses of its tasks, so an event published
+                # after that read is not missed - former events are not of interest
+                self.ensure_collection()
+                self._after = self.last_ts()
+            if self._tailer is None or not self._tailer.is_alive():
+                self._tailer = threading.Thread(target=self._tail, name='task-events', daemon=True)
+                self._tailer.start()
+
+    def last_ts(self):
+        event = self.collection.find_one({}, ['ts'], sort=[('$natural', DESCENDING)])
+        return event['ts'] if event else None
+
+    def read(self, after):
+        """ Return cursor of events following the 'after' timestamp, it waits for new events at its end """
+        query = {'ts': {'$gt': after}} if after is not None else {}
+        return self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+
+    def _tail(self):
+        while True:
+            try:
+                self.ensure_collection()
+                cursor = self.read(self._after)
+                while cursor.alive:
+                    for event in cursor:
+                        self._after = event['ts']
+                        self.dispatch(event)
+            except PyMongoError:
+                logging.exception(f"Tailing of {self.collection_name} failed")
+            # the cursor dies on an empty collection, or when it fell behind the capped collection
+            time.sleep(self.poll_interval)
+
+
+def status_event(task, status):
+    return {'task': str(task.id), 'type': task.__class__.__name__, 'status': getattr(status, 'value', status)}
+
+
+def sign(body):
+    """ Return X-Signature header of a webhook body, HMAC-SHA256 with WEBHOOK_SECRET """
+    secret = os.getenv('WEBHOOK_SECRET')
+    if not secret:
+        return {}
+    return {'X-Signature': 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()}
+
+
+async def send_webhook(session, url, doc):
+    """ POST the task document to its callback url, transient failures are retried as other requests """
+    body = serializers.dumps(doc)
+    headers = {'Content-Type': serializers.JSON, **sign(body)}
+
+    async def _post():
+        timeout = aiohttp.ClientTimeout(total=float(os.getenv('WEBHOOK_TIMEOUT', 10)))
+        response = await session.post(url, data=body, headers=headers, timeout=timeout)
+        response.release()
+        response.raise_for_status()
+
+    await resilience.call(utils.get_host(url), _post)
+
+
+_pubsub = None
+
+
+def get_pubsub():
+    """ Return pub/sub of task status events shared by the process, TASK_EVENTS=local|mongo """
+    global _pubsub
+    if _pubsub is None:
+        kind = os.getenv('TASK_EVENTS', 'mongo')
+        if kind not in ('local', 'mongo'):
+            raise ValueError(f"Unknown TASK_EVENTS '{kind}'")
+        _pubsub = MongoPubSub() if kind == 'mongo' else LocalPubSub()
+    return _pubsub
@@ -0,0 +1,117 @@
+import os
+import re
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+
+class HTMLParser:
+    """ Parser backend extracting text and images from html, selected with HTML_PARSER """
+    name = None
+    # exceptions raised by the backend on malformed input
+    errors = ()
+
+    def parse(self, html):
+        raise NotImplementedError
+
+    def images(self, document):
+        raise NotImplementedError
+
+    def text(self, document):
+        """ Return text of the document, strips script and style elements - modifies the document """
+        raise NotImplementedError
+
+    def get_text(self, html):
+        return self.text(self.parse(html))
+
+    def get_images(self, html):
+        return self.images(self.parse(html))
+
+    def extract(self, html):
+        """ Return text and images of the html from a single parse """
+        document = self.parse(html)
+        images = self.images(document)
+        return {'text': self.text(document), 'images': images}
+
+
+def join_lines(text):
+    return '\n'.join(line for line in text.splitlines() if line)
+
+
+class SoupParser(HTMLParser):
+    name = 'html.parser'
+
+    def parse(self, html):
+        return BeautifulSoup(html, 'html.parser')
+
+    def images(self, document):
+        return [{'src': img['src'], 'name': img.get('alt')} for img in document.find_all('img') if img.get('src')]
+
+    def text(self, document):
+        # kill all script and style elements (from stack overflow)
+        for tag in document(["script", "style"]):
+            tag.decompose()  # rip it out
+        return join_lines(document.get_text())
+
+
+class LxmlParser(HTMLParser):
+    """ libxml2 based backend, gives the same results as html.parser one, several times faster """
+    name = 'lxml'
+    errors = (etree.LxmlError,) if lxml else ()
+
+    ASCII_SPACES = str.maketrans('', '', ' \n\t\x0c\r')
+    # libxml2 refuses str input declaring its encoding (XHTML pages), the text is decoded already
+    XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+    def parse(self, html):
+        if lxml is None:
+            raise RuntimeError("'lxml' parser requires lxml package to be installed")
+        # libxml2 refuses empty documents, html.parser gives an empty one
+        html = self.XML_DECLARATION.sub('', html, count=1)
+        return lxml.html.document_fromstring(html if html.strip() else '<html></html>')
+
+    def images(self, document):
+        return [{'src': img.get('src'), 'name': img.get('alt')} for img in document.iter('img') if img.get('src')]
+
+    def _string(self, string, preserve_whitespace):
+        # BeautifulSoup collapses whitespace only strings (outside of <pre> and <textarea>),
+        # do the same, so the output matches
+        if string and not preserve_whitespace and not string.translate(self.ASCII_SPACES):
+            return '\n' if '\n' in string else ' '
+        return string or ''
+
+    def text(self, document):
+        etree.strip_elements(document, 'script', 'style', with_tail=False)
+        preserved = {element for tag in document.iter('pre', 'textarea') for element in tag.iter()}
+
+        # walk the tree in document order - element text, its children and then its tail
+        strings = []
+        stack = [(document, False)]
+        while stack:
+            element, closed = stack.pop()
+            if closed:
+                strings.append(self._string(element.tail, element.getparent() in preserved))
+                continue
+            # comments and processing instructions are not text, their tails are
+            if isinstance(element.tag, str):
+                strings.append(self._string(element.text, element in preserved))
+            if element is not document:
+                stack.append((element, True))
+            stack.extend((child, False) for child in reversed(element))
+        return join_lines(''.join(strings))
+
+
+PARSERS = {parser.name: parser for parser in (SoupParser, LxmlParser)}
+
+
+def get_parser(name=None):
+    name = name or os.getenv('HTML_PARSER', SoupParser.name)
+    try:
+        return PARSERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown html parser '{name}', choose one of: {', '.join(PARSERS)}")
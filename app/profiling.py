@@ -0,0 +1,107 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class TaskProfile:
+    """
+    Time spent in phases of a task and its counters. Phases of concurrent coroutines of the task
+    (i.e. image downloads) overlap, so their times may add up to more than the wall time of the task.
+    """
+
+    def __init__(self, queued=None):
+        self.queued = queued
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.counts = {}
+        self.cprofile = None
+
+    def add(self, name, elapsed):
+        phase = self.phases.setdefault(name, {'time': 0.0, 'count': 0})
+        phase['time'] += elapsed
+        phase['count'] += 1
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self):
+        profile = {
+            'total': round(time.perf_counter() - self.started, 6),
+            'phases': {name: {'time': round(phase['time'], 6), 'count': phase['count']}
+                       for name, phase in self.phases.items()},
+            'counts': dict(self.counts),
+        }
+        if self.queued is not None:
+            profile['queued'] = round(self.queued, 6)
+        if self.cprofile is not None:
+            profile['cprofile'] = self.cprofile
+        return profile
+
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+@contextmanager
+def phase(name, histogram=None):
+    """ Time a phase into the histogram and into the profile of the running task """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if histogram is not None:
+            histogram.observe(elapsed)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add(name, elapsed)
+
+
+def count(name, value=1, counter=None):
+    """ Add to a counter of the profile of the running task (and to the metric counter) """
+    if counter is not None:
+        counter.inc(value)
+    profile = current_profile.get()
+    if profile is not None:
+        profile.count(name, value)
+
+
+async def count_bytes(chunks, counter=None):
+    async for chunk in chunks:
+        count('bytes', len(chunk), counter)
+        yield chunk
+
+
+def should_capture(requested):
+    """ Whether to run cProfile for a task - asked for on submit, or sampled with PROFILE_SAMPLE_RATE """
+    return requested or random.random() < float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+
+
+_capturing = False
+
+
+@contextmanager
+def capture(profile):
+    """ Run cProfile and keep its top functions (PROFILE_TOP) in the profile. It sees the whole thread,
+    so functions of other tasks running meanwhile are included. Only one capture runs at a time """
+    global _capturing
+    if _capturing:
+        profile.cprofile = 'skipped, other task was being profiled'
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    _capturing = True
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _capturing = False
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(int(os.getenv('PROFILE_TOP', 30)))
+        profile.cprofile = stream.getvalue()
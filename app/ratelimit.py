@@ -0,0 +1,141 @@
+import asyncio
+import datetime
+import email.utils
+import logging
+import os
+import threading
+import time
+
+from mongoengine.connection import get_db
+from pymongo.errors import DuplicateKeyError
+
+from app import db, metrics, utils
+
+
+class LocalBuckets:
+    """ Buckets of a single process, stand-in for MongoBuckets in tests and single worker setups """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, func):
+        with self._lock:
+            state, result = func(self._buckets.get(key), time.time())
+            self._buckets[key] = state
+            return result
+
+
+class MongoBuckets:
+    """ Buckets shared by all worker processes - state is swapped only if nobody else changed it meanwhile """
+
+    def __init__(self, collection_name='rate_limits'):
+        self.collection_name = collection_name
+
+    @property
+    def collection(self):
+        return get_db()[self.collection_name]
+
+    def update(self, key, func):
+        while True:
+            doc = self.collection.find_one({'_id': key}) or {}
+            state, result = func(doc.get('state'), time.time())
+            try:
+                # matches a missing document as well, concurrent insert of it fails on _id
+                updated = self.collection.update_one(
+                    {'_id': key, 'state': doc.get('state')}, {'$set': {'state': state}}, upsert=True
+                )
+            except DuplicateKeyError:
+                continue
+            if updated.matched_count or updated.upserted_id is not None:
+                return result
+
+
+class RateLimiter:
+    """
+    Token bucket per host - a host gets up to 'burst' requests at once and 'rate' requests per second after that.
+
+    Kept as the time the bucket is full again (GCRA), so a request reserves its turn with a single update
+    and sleeps until then. Retry-After of a host pushes turns of all following requests behind it.
+    """
+
+    def __init__(self, buckets=None, rate=None, burst=None):
+        self.buckets = buckets or LocalBuckets()
+        self.rate = rate if rate is not None else float(os.getenv('HOST_RATE_LIMIT', 2))
+        self.burst = burst or int(os.getenv('HOST_RATE_BURST', 5))
+
+    @property
+    def interval(self):
+        return 1 / self.rate
+
+    def _reserve(self, full_at, now):
+        full_at = max(full_at or now, now) + self.interval
+        return full_at, max(0.0, full_at - self.burst * self.interval - now)
+
+    def _pause(self, until, full_at, now):
+        # the first request after the pause goes at 'until', the rest at the rate
+        return max(full_at or now, until + (self.burst - 1) * self.interval), None
+
+    async def wait(self, host):
+        """ Wait for the turn of a request to the host """
+        if not self.rate:
+            return
+        delay = await db.run(self.buckets.update, host, self._reserve)
+        metrics.RATE_LIMIT_WAIT_SECONDS.observe(delay)
+        if delay:
+            metrics.THROTTLED_REQUESTS.labels(host).inc()
+            metrics.THROTTLED_SECONDS.labels(host).inc(delay)
+            await asyncio.sleep(delay)
+
+    async def pause(self, host, seconds):
+        """ Hold requests to the host for given seconds (Retry-After) """
+        if not self.rate:
+            return
+        logging.warning(f"Host {host} asked to retry after {seconds:.0f}s")
+        until = time.time() + seconds
+        await db.run(self.buckets.update, host, lambda full_at, now: self._pause(until, full_at, now))
+        metrics.RETRY_AFTER_PAUSES.labels(host).inc()
+
+
+def parse_retry_after(value):
+    """ Return seconds of Retry-After header (delay or http date), None if it is missing or malformed """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        seconds = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return min(max(seconds, 0.0), float(os.getenv('MAX_RETRY_AFTER', 300)))
+
+
+async def get(session, url, **kwargs):
+    """ Request the url when its host has its turn, take Retry-After of 429 and 503 responses """
+    limiter = get_rate_limiter()
+    host = utils.get_host(url)
+    await limiter.wait(host)
+    response = await session.get(url, **kwargs)
+    if response.status in (429, 503):
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            await limiter.pause(host, retry_after)
+    return response
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """ Return rate limiter shared by all requests of the worker process, HOST_RATE_LIMITS=local|mongo """
+    global _rate_limiter
+    if _rate_limiter is None:
+        buckets = os.getenv('HOST_RATE_LIMITS', 'mongo')
+        if buckets not in ('local', 'mongo'):
+            raise ValueError(f"Unknown HOST_RATE_LIMITS '{buckets}'")
+        _rate_limiter = RateLimiter(MongoBuckets() if buckets == 'mongo' else LocalBuckets())
+    return _rate_limiter
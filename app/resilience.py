@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiohttp
+
+
+# statuses of an overloaded or restarting server, worth asking again a bit later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    """ Requests to the host failed too many times in a row, it is not asked until its circuit closes again """
+
+
+def is_transient(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+def backoff_delay(attempt):
+    """ Exponential backoff with full jitter, so retries of many tasks hit by the same outage spread out """
+    base = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+    cap = float(os.getenv('HTTP_RETRY_BACKOFF_MAX', 10))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Circuit per host - opened after 'threshold' transient failures in a row, requests to the host fail fast
+    with CircuitOpenError then. After 'reset_timeout' seconds a single trial request is let through,
+    its success closes the circuit, its failure keeps it open for another 'reset_timeout'.
+    """
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold if threshold is not None else int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 5))
+        self.reset_timeout = reset_timeout or float(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+        self._failures = {}
+        self._opened = {}
+        self._trials = set()
+
+    def check(self, host):
+        """ Raise CircuitOpenError unless a request to the host may go now """
+        if host not in self._opened:
+            return
+        if host in self._trials or time.monotonic() - self._opened[host] < self.reset_timeout:
+            raise CircuitOpenError(f'Circuit of {host} is open')
+        self._trials.add(host)
+
+    def succeeded(self, host):
+        if host in self._opened:
+            logging.info(f"Circuit of {host} is closed")
+        self._failures.pop(host, None)
+        self._opened.pop(host, None)
+        self._trials.discard(host)
+
+    def failed(self, host):
+        if not self.threshold:
+            return
+        self._trials.discard(host)
+        self._failures[host] = self._failures.get(host, 0) + 1
+        if host in self._opened or self._failures[host] >= self.threshold:
+            if host not in self._opened:
+                logging.warning(f"Circuit of {host} is open after {self._failures[host]} failures")
+            self._opened[host] = time.monotonic()
+
+    def abandoned(self, host):
+        # a cancelled trial request, the next one gets the trial
+        self._trials.discard(host)
+
+    def state(self, host):
+        if host not in self._opened:
+            return 'closed'
+        if host in self._trials or time.monotonic() - self._opened[host] >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def stats(self):
+        return {host: {'failures': failures, 'state': self.state(host)} for host, failures in self._failures.items()}
+
+
+async def call(host, coro_func, *args, **kwargs):
+    """ Run a request to the host, retry it on transient errors (HTTP_RETRIES times), fail fast if its circuit
+    is open """
+    breaker = get_circuit_breaker()
+    retries = int(os.getenv('HTTP_RETRIES', 3))
+    attempt = 0
+    while True:
+        breaker.check(host)
+        try:
+            result = await coro_func(*args, **kwargs)
+        except asyncio.CancelledError:
+            breaker.abandoned(host)
+            raise
+        except Exception as e:
+            if not is_transient(e):
+                # the host answered, the request itself is wrong (404, too big image, ...)
+                breaker.succeeded(host)
+                raise
+            breaker.failed(host)
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"Request to {host} failed with {e!r}, retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+        else:
+            breaker.succeeded(host)
+            return result
+
+
+_circuit_breaker = None
+
+
+def get_circuit_breaker():
+    """ Return circuit breaker shared by all requests of the worker process """
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        _circuit_breaker = CircuitBreaker()
+    return _circuit_breaker
@@ -0,0 +1,108 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+
+from app import metrics
+
+
+class DownloadScheduler:
+    """
+    Limits number of concurrently running downloads - globally and per host.
+
+    Downloads waiting for a slot are queued per host and slots are handed out round-robin across hosts,
+    so hundreds of images from one (maybe slow) CDN do not hold back images from other hosts.
+    """
+
+    def __init__(self, max_concurrency=None, max_per_host=None):
+        self.max_concurrency = max_concurrency or int(os.getenv('DOWNLOAD_CONCURRENCY', 32))
+        self.max_per_host = max_per_host or int(os.getenv('DOWNLOAD_CONCURRENCY_PER_HOST', 6))
+        self._queues = OrderedDict()
+        self._host_in_flight = {}
+        self._in_flight = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _report(self):
+        metrics.DOWNLOADS_IN_FLIGHT.set(self.in_flight)
+        metrics.DOWNLOADS_QUEUED.set(self.queue_depth)
+
+    async def run(self, host, coro_func, *args, **kwargs):
+        await self._acquire(host)
+        try:
+            return await coro_func(*args, **kwargs)
+        finally:
+            self._release(host)
+
+    def _has_slot(self, host):
+        return self._in_flight < self.max_concurrency and self._host_in_flight.get(host, 0) < self.max_per_host
+
+    def _take(self, host):
+        self._in_flight += 1
+        self._host_in_flight[host] = self._host_in_flight.get(host, 0) + 1
+        self._report()
+
+    async def _acquire(self, host):
+        if host not in self._queues and self._has_slot(host):
+            self._take(host)
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._queues.setdefault(host, deque()).append(waiter)
+        self._report()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed to us just before the cancellation - give it to someone else
+                self._release(host)
+            elif waiter in self._queues.get(host, ()):
+                self._queues[host].remove(waiter)
+                if not self._queues[host]:
+                    del self._queues[host]
+                self._report()
+            raise
+
+    def _release(self, host):
+        self._in_flight -= 1
+        self._host_in_flight[host] -= 1
+        if not self._host_in_flight[host]:
+            del self._host_in_flight[host]
+        self._dispatch()
+        self._report()
+
+    def _dispatch(self):
+        while self._in_flight < self.max_concurrency:
+            # hosts are visited in order they were last served, so each one gets its turn
+            for host, queue in self._queues.items():
+                if self._host_in_flight.get(host, 0) < self.max_per_host:
+                    break
+            else:
+                return
+
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(host)
+            else:
+                del self._queues[host]
+            if waiter.done():
+                # cancelled while waiting
+                continue
+            self._take(host)
+            waiter.set_result(None)
+
+
+_scheduler = None
+
+
+def get_download_scheduler():
+    """ Return scheduler shared by all image downloads of the worker process """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = DownloadScheduler()
+    return _scheduler
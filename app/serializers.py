@@ -0,0 +1,101 @@
+import calendar
+import datetime
+import enum
+import json
+
+from bson import ObjectId
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+def _millis(value):
+    if value.utcoffset() is not None:
+        value = value - value.utcoffset()
+    return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+
+
+def _plain(obj):
+    # single documents are sent as flask-restplus did with MongoEngineObjectIdJSONEncoder -
+    # ids as strings, dates as HTTP dates
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.date):
+        return http_date(obj.utctimetuple())
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _extended(obj):
+    # lists are sent as bson.json_util did - {"$oid": ...} and {"$date": <milliseconds>}
+    if isinstance(obj, ObjectId):
+        return {'$oid': str(obj)}
+    if isinstance(obj, datetime.datetime):
+        return {'$date': _millis(obj)}
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _msgpack(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        # stored dates are naive utc
+        return msgpack.Timestamp.from_datetime(obj if obj.tzinfo else obj.replace(tzinfo=datetime.timezone.utc))
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    raise TypeError(f'Object of type {type(obj).__name__} is not MessagePack serializable')
+
+
+def dumps(doc, extended=False):
+    """ Encode raw document (or list of them) as JSON bytes, with orjson if it is installed """
+    default = _extended if extended else _plain
+    if orjson is not None:
+        # dates go to default as well, orjson would write them as ISO 8601
+        return orjson.dumps(doc, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(doc, default=default, separators=(',', ':')).encode()
+
+
+def packb(doc):
+    if msgpack is None:
+        raise RuntimeError("MessagePack requires msgpack package to be installed")
+    return msgpack.packb(doc, default=_msgpack)
+
+
+def mimetypes():
+    """ Return mimetypes responses can be sent in, JSON first as the default """
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def encode(doc, mimetype):
+    return packb(doc) if mimetype == MSGPACK else dumps(doc)
+
+
+def stream(docs, mimetype):
+    """ Encode iterable of raw documents as an array, one document at a time """
+    if mimetype == MSGPACK:
+        # array header needs the length, a page is read before it is sent
+        docs = list(docs)
+        yield msgpack.Packer().pack_array_header(len(docs))
+        for doc in docs:
+            yield packb(doc)
+        return
+
+    yield b'['
+    for i, doc in enumerate(docs):
+        yield (b',' if i else b'') + dumps(doc, extended=True)
+    yield b']'
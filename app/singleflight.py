@@ -0,0 +1,111 @@
+import asyncio
+import datetime
+import os
+import threading
+import time
+
+from mongoengine.connection import get_db
+from pymongo.errors import DuplicateKeyError
+
+from app import db, worker
+
+
+class LocalLeases:
+    """ Leases of a single process, stand-in for MongoLeases in tests and single worker setups """
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, owner, lease_time):
+        now = time.monotonic()
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease[1] > now:
+                return False
+            self._leases[key] = (owner, now + lease_time)
+            return True
+
+    def release(self, key, owner):
+        with self._lock:
+            if self._leases.get(key, (None,))[0] == owner:
+                del self._leases[key]
+
+
+class MongoLeases:
+    """ Leases shared by all worker processes, expired ones (of crashed workers) can be taken over """
+
+    def __init__(self, collection_name='leases'):
+        self.collection_name = collection_name
+
+    @property
+    def collection(self):
+        return get_db()[self.collection_name]
+
+    def acquire(self, key, owner, lease_time):
+        now = datetime.datetime.utcnow()
+        try:
+            self.collection.update_one(
+                {'_id': key, 'expires_at': {'$lte': now}},
+                {'$set': {'owner': owner, 'expires_at': now + datetime.timedelta(seconds=lease_time)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # not expired lease of other owner exists, so the upsert tried to insert the same _id
+            return False
+        return True
+
+    def release(self, key, owner):
+        self.collection.delete_one({'_id': key, 'owner': owner})
+
+
+class SingleFlight:
+    """
+    Runs a single call of a key at a time. Concurrent callers of the key in this process wait for the running call
+    and get its result (or exception), callers in other processes wait for the lease of the key.
+    """
+
+    def __init__(self, leases=None, lease_time=None, poll_interval=None, owner=None):
+        self.leases = leases or LocalLeases()
+        self.lease_time = lease_time or float(os.getenv('SINGLEFLIGHT_LEASE_TIME', 60))
+        self.poll_interval = poll_interval or float(os.getenv('SINGLEFLIGHT_POLL_INTERVAL', 0.2))
+        self.owner = owner or worker.get_worker_id()
+        self._calls = {}
+
+    async def run(self, key, coro_func, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(self._lead(key, coro_func, *args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._done(key, done))
+        # a cancelled caller does not cancel the call other callers wait for
+        return await asyncio.shield(call)
+
+    async def _lead(self, key, coro_func, *args, **kwargs):
+        while not await db.run(self.leases.acquire, key, self.owner, self.lease_time):
+            await asyncio.sleep(self.poll_interval)
+        try:
+            return await coro_func(*args, **kwargs)
+        finally:
+            await db.run(self.leases.release, key, self.owner)
+
+    def _done(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.cancelled():
+            # retrieved, so it is not logged as never retrieved when all callers were cancelled
+            call.exception()
+
+
+_singleflight = None
+
+
+def get_singleflight():
+    """ Return singleflight shared by tasks of the worker process, SINGLEFLIGHT_LEASES=local|mongo """
+    global _singleflight
+    if _singleflight is None:
+        leases = os.getenv('SINGLEFLIGHT_LEASES', 'mongo')
+        if leases not in ('local', 'mongo'):
+            raise ValueError(f"Unknown SINGLEFLIGHT_LEASES '{leases}'")
+        _singleflight = SingleFlight(MongoLeases() if leases == 'mongo' else LocalLeases())
+    return _singleflight
@@ -26,6 +26,23 @@ def get_image_dicts(exclude=None):
     return [{key: value for key, value in img.items() if key not in exclude} for img in fixture_images]
 
 
+async def chunks(*content):
+    for chunk in content:
+        yield chunk
+
+
+@pytest.fixture(autouse=True)
+def executors(mocker):
+    # mocked parse functions cannot be sent to a process pool, mongomock is not thread safe,
+    # pages are fetched by every task unless a test turns the reuse on, requests are not rate limited,
+    # retried nor cut off by circuits opened in other tests
+    mocker.patch.dict('os.environ', {
+        'PARSER_EXECUTOR': 'thread', 'DB_POOL_SIZE': '1', 'SINGLEFLIGHT_LEASES': 'local', 'SINGLEFLIGHT_TTL': '0',
+        'HOST_RATE_LIMITS': 'local', 'HOST_RATE_LIMIT': '0', 'HTTP_RETRIES': '0', 'CIRCUIT_BREAKER_THRESHOLD': '0',
+        'TASK_EVENTS': 'local'
+    })
+
+
 @pytest.fixture
 def mock_execute_images_task(mocker):
     return mocker.patch('app.celery_tasks.execute_images_task')
@@ -36,6 +53,16 @@ def mock_execute_text_task(mocker):
     return mocker.patch('app.celery_tasks.execute_text_task')
 
 
+@pytest.fixture
+def mock_execute_images_tasks(mocker):
+    return mocker.patch('app.celery_tasks.execute_images_tasks')
+
+
+@pytest.fixture
+def mock_execute_text_tasks(mocker):
+    return mocker.patch('app.celery_tasks.execute_text_tasks')
+
+
 @pytest.fixture
 def session_object_mock():
     mock_object = asynctest.MagicMock()
@@ -43,18 +70,15 @@ def session_object_mock():
     mock_object.get.return_value = CoroutineMock()
     mock_object.get.return_value.read = CoroutineMock()
     mock_object.get.return_value.read.return_value = b'ABCD'
+    mock_object.get.return_value.content_length = None
+    mock_object.get.return_value.status = 200
+    mock_object.get.return_value.headers = {}
+    mock_object.get.return_value.content.iter_chunked = asynctest.MagicMock(side_effect=lambda size: chunks(b'AB', b'CD'))
     mock_object.get.return_value.text = CoroutineMock()
-    mock_object.get.return_value.text.return_value = html_response()
+    mock_object.get.return_value.text.return_value = html_response().decode()
     yield mock_object
 
 
-@pytest.fixture
-def session_context_mock(session_object_mock):
-    mock_object = asynctest.MagicMock()
-    mock_object.__aenter__.return_value = session_object_mock
-    return mock_object
-
-
 @pytest.fixture
 def set_side_effect(mocker):
     def _set_side_effect(locals, obj_name_or_path, target, side_effect):
@@ -66,19 +90,32 @@ def set_side_effect(mocker):
 
 
 @pytest.fixture
-def mock_session_ctx(session_context_mock, mocker):
-    return mocker.patch('aiohttp.ClientSession', return_value=session_context_mock)
+def mock_session(session_object_mock, mocker):
+    return mocker.patch('app.worker.get_session', new=CoroutineMock(return_value=session_object_mock))
 
 
 @pytest.fixture
 def clean_db():
-    _models = ['TextTask', 'ImageTask', 'Image']
+    _models = ['TextTask', 'TextContent', 'ImageTask', 'Image', 'ImageTaskLink', 'Page']
     for model in _models:
         getattr(models, model).drop_collection()
 
 
 @pytest.fixture
-def test_app(mock_execute_images_task, mock_execute_text_task):
+def media_path(tmp_path, mocker):
+    mocker.patch.dict('os.environ', {'MEDIA_PATH': str(tmp_path)})
+    return tmp_path
+
+
+def stored_files(media_path):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), media_path).replace(os.sep, '/')
+        for root, dirs, files in os.walk(media_path) for name in files
+    )
+
+
+@pytest.fixture
+def test_app(mock_execute_images_task, mock_execute_text_task, mock_execute_images_tasks, mock_execute_text_tasks):
     app = create_app(testing=True)
     yield app
 
@@ -1,12 +1,19 @@
+import datetime
+import gzip
+import threading
+import time
+
+import msgpack
 import pytest
+from bson import ObjectId
 
-from app import models
+from app import models, notifications
 from app.tests.conftest import load_fixture_file
 from app.utils import mongo_dumps_loads
 
 
 @pytest.mark.parametrize('model, exclude, endpoint, fixture_file', [
-    (models.ImageTask, ['images'], 'images_tasks', 'ImageTask__01.json'),
+    (models.ImageTask, [], 'images_tasks', 'ImageTask__01.json'),
     (models.TextTask, [], 'text_tasks', 'TextTask__01.json'),
 ])
 def test_api_get_task(client, model, exclude, endpoint, fixture_file, clean_db):
@@ -29,6 +36,86 @@ def test_api_get_task(client, model, exclude, endpoint, fixture_file, clean_db):
     assert response.status_code == 200
     assert response.json == mongo_dumps_loads(tasks)
 
+    # fields of not migrated documents, which are not declared anymore, are left out
+    listed = response.json
+    model._get_collection().update_many({}, {'$set': {'text': 'A text', 'images': []}})
+    assert client.get(f'/api/{endpoint}/').json == listed
+    assert 'text' not in client.get(f'/api/{endpoint}/{tasks[0].pk}').json
+
+
+@pytest.mark.parametrize('model, endpoint', [
+    (models.ImageTask, 'images_tasks'),
+    (models.TextTask, 'text_tasks'),
+])
+def test_api_get_task_list_without_profile(client, clean_db, model, endpoint):
+    profile = {'total': 1.5, 'phases': {}, 'counts': {}, 'cprofile': 'ncalls tottime ...' * 1000}
+    task = model.objects.create(url='http://www.google.pl', profile=profile)
+
+    # heavy profile is left out of list pages, unless it is asked for
+    assert all('profile' not in listed for listed in client.get(f'/api/{endpoint}/').json)
+    assert client.get(f'/api/{endpoint}/?fields=url,profile').json[0]['profile'] == profile
+    assert client.get(f'/api/{endpoint}/{task.pk}').json['profile'] == profile
+
+
+@pytest.mark.parametrize('model, endpoint', [
+    (models.ImageTask, 'images_tasks'),
+    (models.TextTask, 'text_tasks'),
+])
+def test_api_get_task_list_pages(client, clean_db, model, endpoint):
+    for i in range(5):
+        model.objects.create(url=f'http://www.google.pl/{i}', status='success' if i % 2 else 'waiting')
+    tasks = model.objects.order_by('pk')
+
+    pages, url = [], f'/api/{endpoint}/?limit=2&fields=url,status'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append([task['url'] for task in response.json])
+        assert all(set(task) == {'_id', '_cls', 'url', 'status'} for task in response.json)
+        url = response.headers.get('Link', '').partition('>')[0].lstrip('<').replace('http://localhost', '')
+
+    assert pages == [[task.url for task in tasks[i:i + 2]] for i in (0, 2, 4)]
+
+    response = client.get(f'/api/{endpoint}/?status=success')
+    assert [task['url'] for task in response.json] == [task.url for task in tasks if task.status.value == 'success']
+    assert 'X-Next-Cursor' not in response.headers
+
+    response = client.get(f'/api/{endpoint}/?limit=1&after={tasks[3].pk}')
+    assert [task['url'] for task in response.json] == [tasks[4].url]
+
+    response = client.get(f'/api/{endpoint}/?created_to=2000-01-01T00:00:00')
+    assert response.json == []
+
+    # creation time is the one of _id
+    older = model.objects.create(id=ObjectId.from_datetime(datetime.datetime(2020, 7, 1, 12)), url='http://a.pl')
+    response = client.get(f'/api/{endpoint}/?created_from=2020-07-01T00:00:00&created_to=2020-07-02T00:00:00')
+    assert [task['url'] for task in response.json] == [older.url]
+    response = client.get(f'/api/{endpoint}/?created_to=2020-07-02T00:00:00&status=waiting')
+    assert [task['url'] for task in response.json] == [older.url]
+    assert client.get(f'/api/{endpoint}/?created_to=2020-07-02T00:00:00&status=success').json == []
+
+    for query in ('limit=0', 'after=invalid', 'status=unknown', 'fields=secret', 'created_from=yesterday'):
+        assert client.get(f'/api/{endpoint}/?{query}').status_code == 400
+
+
+def test_api_get_task_msgpack(client, clean_db):
+    load_fixture_file('TextTask__01.json')
+    tasks = models.TextTask.objects.order_by('pk')
+    headers = {'Accept': 'application/msgpack'}
+
+    response = client.get(f'/api/text_tasks/{tasks[0].pk}', headers=headers)
+    assert response.status_code == 200
+    assert response.content_type == 'application/msgpack'
+    assert 'Accept' in response.headers['Vary']
+    assert msgpack.unpackb(response.data)['_id'] == str(tasks[0].pk)
+
+    response = client.get('/api/text_tasks/?fields=url', headers=headers)
+    assert response.content_type == 'application/msgpack'
+    assert [task['url'] for task in msgpack.unpackb(response.data)] == [task.url for task in tasks]
+
+    # json stays the default
+    assert client.get('/api/text_tasks/', headers={'Accept': '*/*'}).content_type == 'application/json'
+
 
 @pytest.mark.parametrize('mock, model, endpoint, fixture_file', [
     ('mock_execute_images_task', models.ImageTask, 'images_tasks', 'ImageTask__01.json'),
@@ -60,11 +147,57 @@ def test_api_post_images_task(
     assert response.json['status'] == 'waiting'
     assert mock.delay.called
     assert model.objects.count() == initial_no_tasks + 1
+    assert not response.json['capture_profile']
+
+    response = client.post(f'/api/{endpoint}/', json={'url': url, 'profile': True})
+
+    assert response.json['capture_profile']
+
+    response = client.post(f'/api/{endpoint}/', json={'url': url, 'callback_url': 'http://hooks.pl/done'})
+    assert response.json['callback_url'] == 'http://hooks.pl/done'
+
+    response = client.post(f'/api/{endpoint}/', json={'url': url, 'callback_url': 'not an url'})
+    assert response.status_code == 400
+    assert response.json['message'].startswith('Invalid callback_url')
+
+
+@pytest.mark.parametrize('mock, model, endpoint', [
+    ('mock_execute_images_tasks', models.ImageTask, 'images_tasks'),
+    ('mock_execute_text_tasks', models.TextTask, 'text_tasks'),
+])
+def test_api_post_tasks_batch(
+        client, clean_db, mocker, mock_execute_text_tasks, mock_execute_images_tasks, mock, model, endpoint):
+
+    mock = {
+        'mock_execute_images_tasks': mock_execute_images_tasks,
+        'mock_execute_text_tasks': mock_execute_text_tasks,
+    }[mock]
+    mocker.patch.dict('os.environ', {'BATCH_CHUNK_SIZE': '2'})
+
+    response = client.post(f'/api/{endpoint}/batch', json={'url': 'http://www.google.pl'})
+    assert response.status_code == 400
+    assert response.json['message'] == "Request need to contain 'urls' list parameter"
+
+    response = client.post(f'/api/{endpoint}/batch', json={'urls': ['http://www.google.pl', 'not an url']})
+    assert response.status_code == 400
+    assert model.objects.count() == 0
+
+    urls = [f'http://www.google.pl/{i}' for i in range(5)]
+    response = client.post(f'/api/{endpoint}/batch', json={'urls': urls})
+
+    assert response.status_code == 201
+    assert [task['url'] for task in response.json] == urls
+    assert model.objects.count() == 5
+    assert [len(call[0][0]) for call in mock.delay.call_args_list] == [2, 2, 1]
+    assert sum((call[0][0] for call in mock.delay.call_args_list), []) == [task['_id'] for task in response.json]
 
 
 def test_api_get_text(client, clean_db):
     load_fixture_file('TextTask__01.json')
     tasks = models.TextTask.objects.all()
+    text = 'A text ' * 100
+    tasks[1].update(**models.TextTask.text_fields(models.TextContent.store(text)))
+    url = f'/api/text_tasks/{tasks[1].pk}/text'
 
     response = client.get('/api/text_tasks/invalid_id/text')
     assert response.status_code == 404
@@ -72,9 +205,28 @@ def test_api_get_text(client, clean_db):
     response = client.get(f'/api/text_tasks/{tasks[0].pk}/text')
     assert response.status_code == 404
 
-    response = client.get(f'/api/text_tasks/{tasks[1].pk}/text')
+    response = client.get(url)
     assert response.status_code == 200
-    assert response.json['text'] == tasks[1]['text']
+    assert response.json['text'] == text
+
+    response = client.get(url, headers={'Accept': 'text/plain'})
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.get_data(as_text=True) == text
+
+    response = client.get(url, headers={'Accept': 'text/plain', 'Range': 'bytes=7-13'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 7-13/{len(text)}'
+    assert response.get_data(as_text=True) == 'A text '
+
+    response = client.get(url, headers={'Accept': 'text/plain', 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    response = client.get(url, headers={'Accept': 'text/plain', 'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(response.data) < len(text)
+    assert gzip.decompress(response.data).decode() == text
 
 
 def test_api_get_images(client, clean_db):
@@ -83,14 +235,17 @@ def test_api_get_images(client, clean_db):
 
     images = models.Image.objects.all()
     image_tasks = models.ImageTask.objects.all()
-    image_tasks[0].update(images=images)
-    images.update(tasks=[image_tasks[0]])
+    models.ImageTaskLink.bulk_link([(image_tasks[0].id, image.id) for image in images])
 
     response = client.get('/api/images_tasks/invalid_id/images/invalid_id')
     assert response.status_code == 404
 
     response = client.get(f'/api/images_tasks/{image_tasks[0].pk}/images/')
     assert response.status_code == 200
+    assert response.json == mongo_dumps_loads(images)
+
+    response = client.get(f'/api/images_tasks/{image_tasks[1].pk}/images/')
+    assert response.json == []
 
     response = client.get(f"/api/images_tasks/{image_tasks[0].pk}/images/{images[0].pk}")
     assert response.status_code == 404
@@ -101,3 +256,82 @@ def test_api_get_images(client, clean_db):
 
     response = client.get(f"/api/images_tasks/{image_tasks[1].pk}/images/{images[0].pk}")
     assert response.status_code == 404
+
+
+def finish_later(task, status=models.StatusEnum.SUCCESS, delay=0.2):
+    """ Set status of the task as a worker does, while the request waits """
+    def _finish():
+        task.update(status=status)
+        notifications.get_pubsub().publish(notifications.status_event(task, status))
+    timer = threading.Timer(delay, _finish)
+    timer.start()
+    return timer
+
+
+@pytest.mark.parametrize('model, endpoint', [
+    (models.ImageTask, 'images_tasks'),
+    (models.TextTask, 'text_tasks'),
+])
+def test_api_wait_for_task(client, clean_db, model, endpoint):
+    finished = model.objects.create(url='http://www.google.pl', status='error')
+    waiting = model.objects.create(url='http://www.google.pl')
+
+    assert client.get(f'/api/{endpoint}/{finished.pk}/wait').json['status'] == 'error'
+    assert client.get(f'/api/{endpoint}/invalid_id/wait').status_code == 404
+    assert client.get(f'/api/{endpoint}/{waiting.pk}/wait?timeout=0').json['status'] == 'waiting'
+    assert client.get(f'/api/{endpoint}/{waiting.pk}/wait?timeout=3600').status_code == 400
+
+    timer = finish_later(waiting)
+    start = time.monotonic()
+    response = client.get(f'/api/{endpoint}/{waiting.pk}/wait?timeout=10')
+    timer.join()
+    assert response.json['status'] == 'success'
+    assert time.monotonic() - start < 5
+
+    other = model.objects.create(url='http://www.google.pl')
+    timer = finish_later(other)
+    response = client.get(f'/api/{endpoint}/wait?ids={finished.pk},{waiting.pk},{other.pk}&timeout=10')
+    timer.join()
+    assert [task['status'] for task in response.json] == ['error', 'success', 'success']
+
+    assert client.get(f'/api/{endpoint}/wait').status_code == 400
+    assert client.get(f'/api/{endpoint}/wait?ids=invalid').status_code == 400
+
+
+def test_api_task_events(client, clean_db):
+    finished = models.TextTask.objects.create(url='http://www.google.pl', status='success')
+    waiting = models.TextTask.objects.create(url='http://www.google.pl')
+
+    response = client.get(f'/api/text_tasks/{finished.pk}/events')
+    assert response.content_type.startswith('text/event-stream')
+    assert response.get_data(as_text=True) == (
+        f'event: status\ndata: {{"_id":"{finished.pk}","status":"success"}}\n\n'
+        'event: end\ndata: {}\n\n'
+    )
+    response.close()
+    assert client.get('/api/text_tasks/invalid_id/events').status_code == 404
+
+    timer = finish_later(waiting, models.StatusEnum.ERROR)
+    response = client.get(f'/api/text_tasks/events?ids={finished.pk},{waiting.pk}')
+    events = response.get_data(as_text=True).split('\n\n')[:-1]
+    response.close()
+    timer.join()
+    assert events == [
+        f'event: status\ndata: {{"_id":"{finished.pk}","status":"success"}}',
+        f'event: status\ndata: {{"_id":"{waiting.pk}","status":"waiting"}}',
+        f'event: status\ndata: {{"_id":"{waiting.pk}","status":"error"}}',
+        'event: end\ndata: {}',
+    ]
+    # subscriptions of closed streams are dropped
+    assert not notifications.get_pubsub()._subscriptions
+
+
+def test_api_task_events_keepalive(client, clean_db, mocker):
+    mocker.patch.dict('os.environ', {'SSE_KEEPALIVE': '0.05', 'SSE_MAX_DURATION': '0.2'})
+    waiting = models.TextTask.objects.create(url='http://www.google.pl')
+
+    data = client.get(f'/api/text_tasks/{waiting.pk}/events').get_data(as_text=True)
+
+    # the stream ends unfinished after SSE_MAX_DURATION, the client reconnects
+    assert ': keepalive\n\n' in data
+    assert 'event: end' not in data
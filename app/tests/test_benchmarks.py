@@ -0,0 +1,13 @@
+import importlib
+import pkgutil
+
+import pytest
+
+from app import benchmarks
+
+
+@pytest.mark.parametrize('name', [module.name for module in pkgutil.iter_modules(benchmarks.__path__)])
+def test_benchmark_imports(name):
+    # benchmarks are run by hand, this keeps them in step with the modules they measure
+    module = importlib.import_module(f'app.benchmarks.{name}')
+    assert callable(getattr(module, 'main', None)) or name == 'server'
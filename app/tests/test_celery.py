@@ -0,0 +1,24 @@
+import pytest
+
+from app import celery_tasks
+from app.celery_tasks import celery_app
+
+
+@pytest.mark.parametrize('task, queue, priority', [
+    (celery_tasks.execute_text_task, 'text', 6),
+    (celery_tasks.execute_text_tasks, 'text', 3),
+    (celery_tasks.execute_images_task, 'images', 6),
+    (celery_tasks.execute_images_tasks, 'images', 3),
+])
+def test_task_routes(task, queue, priority):
+    route = celery_app.amqp.router.route({}, task.name, (), {})
+
+    assert route['queue'].name == queue
+    assert route['queue'].queue_arguments == {'x-max-priority': celery_tasks.MAX_PRIORITY}
+    assert route['priority'] == priority
+
+
+def test_workers_reserve_only_running_task():
+    assert celery_app.conf.task_acks_late
+    assert celery_app.conf.task_reject_on_worker_lost
+    assert celery_app.conf.worker_prefetch_multiplier == 1
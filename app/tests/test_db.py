@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from app import db, models
+from app.tests.conftest import load_fixture_file
+from app.utils import run_with_asyncio
+
+
+def test_async_document_does_not_block_loop(test_app, clean_db, mocker):
+    load_fixture_file('Image__01.json')
+    image = models.Image.objects.first()
+    update = models.Image.update
+
+    def slow_update(self, **kwargs):
+        time.sleep(0.2)
+        return update(self, **kwargs)
+
+    mocker.patch.object(models.Image, 'update', slow_update)
+    ticks = []
+
+    async def _ticker():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    async def _run():
+        ticker = asyncio.ensure_future(_ticker())
+        await image.aupdate(name='Slow')
+        await db.run(image.reload)
+        ticker.cancel()
+
+    run_with_asyncio(_run)()
+
+    assert len(ticks) > 5
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+    assert image.name == 'Slow'
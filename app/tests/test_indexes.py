@@ -0,0 +1,125 @@
+import datetime
+import os
+
+import pytest
+from bson import ObjectId
+from mongoengine import connect, disconnect
+
+from app import models
+from app.api.endpoints import filter_tasks
+from app.manage import sync_indexes
+from app.models import StatusEnum
+
+
+# explain() is not supported by mongomock, plans are checked against a real server given with
+# TEST_MONGO_URI=mongodb://localhost:27017/test_indexes
+TEST_MONGO_URI = os.getenv('TEST_MONGO_URI')
+
+OID = ObjectId('5f1d7a1b2c3d4e5f6a7b8c9d')
+DAY = datetime.datetime(2020, 7, 1)
+
+# filters of task list pages
+LIST_FILTERS = {
+    'task list': {},
+    'tasks by status': {'status': StatusEnum.WAITING.value},
+    'tasks by date': {'created_from': DAY, 'created_to': DAY + datetime.timedelta(days=1)},
+    'tasks by status and date': {'status': StatusEnum.SUCCESS.value, 'created_from': DAY},
+}
+
+
+def task_list(args):
+    # page following a cursor, as paginated_response reads it
+    args = {'status': None, 'created_from': None, 'created_to': None, **args}
+    return lambda model: filter_tasks(model.objects, args).filter(pk__gt=OID).order_by('pk')
+
+
+# query shapes of the api and workers
+QUERIES = {
+    **{name: task_list(args) for name, args in LIST_FILTERS.items()},
+    'task': lambda model: model.objects(pk=OID),
+    'task batch': lambda model: model.objects(pk__in=[OID]),
+    'unfinished tasks': lambda model: model.objects(pk__in=[OID], status__nin=['success', 'error']),
+}
+TASK_QUERIES = [
+    pytest.param(model, query, id=f'{model.__name__} {name}')
+    for model in (models.ImageTask, models.TextTask) for name, query in QUERIES.items()
+]
+OTHER_QUERIES = [
+    pytest.param(models.ImageTaskLink, lambda model: model.objects(task=OID).only('image'), id='task links'),
+    pytest.param(models.ImageTaskLink, lambda model: model.objects(task=OID, image=OID), id='task link'),
+    pytest.param(models.Image, lambda model: model.objects(pk__in=[OID], pk__gt=OID).order_by('pk'), id='task images'),
+    pytest.param(models.Image, lambda model: model.objects(pk=OID, status=StatusEnum.SUCCESS), id='task image'),
+    pytest.param(models.Image, lambda model: model.objects(src__in=['http://a.pl/1.png']), id='images by src'),
+    pytest.param(models.Page, lambda model: model.objects(url='http://a.pl/'), id='page'),
+    pytest.param(models.TextContent, lambda model: model.objects(pk='ab12'), id='text'),
+]
+
+
+def plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+@pytest.fixture
+def mongo_db():
+    if not TEST_MONGO_URI:
+        pytest.skip('TEST_MONGO_URI is not set')
+    disconnect()
+    connect(host=TEST_MONGO_URI)
+    sync_indexes()
+    yield
+    for model in (
+            models.Page, models.ImageTask, models.TextTask, models.TextContent, models.Image, models.ImageTaskLink):
+        model.drop_collection()
+    disconnect()
+
+
+@pytest.mark.parametrize('model, query', TASK_QUERIES + OTHER_QUERIES)
+def test_query_has_declared_index(test_app, model, query):
+    queryset = query(model)
+    filtered = set(queryset._query) - {'_cls'}
+    pk = queryset._query.get('_id')
+    leading = [[field for field, _ in index if field != '_cls'][:1] for index in model.list_indexes()]
+
+    # _id lookups are fine, but an _id range would walk the whole collection in pages order
+    assert any(index and index[0] in filtered - {'_id'} for index in leading) \
+        or filtered <= {'_id'} or (pk is not None and not isinstance(pk, dict)) or '$in' in (pk or {})
+
+
+@pytest.mark.parametrize('model, args', [
+    pytest.param(model, args, id=f'{model.__name__} {name}')
+    for model in (models.ImageTask, models.TextTask) for name, args in LIST_FILTERS.items()
+])
+def test_task_list_has_index_in_page_order(test_app, model, args):
+    queryset = task_list(args)(model)
+    # _cls is the same for the whole collection of a task type
+    query = {field: value for field, value in queryset._query.items() if field != '_cls'}
+    equality = {field for field, value in query.items() if not isinstance(value, dict)}
+    ranges = set(query) - equality
+    sort = [field for field, _ in queryset._ordering]
+    indexes = [[field for field, _ in index if field != '_cls'] for index in model.list_indexes()]
+
+    # equality fields, then the sort - the index gives matching tasks in page order, ranges are its bounds
+    assert any(
+        set(index[:len(equality)]) == equality and index[len(equality):len(equality) + len(sort)] == sort
+        and ranges <= set(index)
+        for index in indexes
+    )
+
+
+@pytest.mark.parametrize('model, query', TASK_QUERIES + OTHER_QUERIES)
+def test_query_plan_does_not_scan_collection(mongo_db, model, query):
+    queryset = query(model)
+    stages = list(plan_stages(queryset.explain()['queryPlanner']['winningPlan']))
+
+    assert stages
+    assert 'COLLSCAN' not in stages
+    if queryset._ordering:
+        # pages are read in order of the index, not sorted in memory
+        assert 'SORT' not in stages
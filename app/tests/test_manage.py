@@ -0,0 +1,78 @@
+from app import models
+from app.manage import migrate_image_links, migrate_media, migrate_text, sync_indexes
+from app.tests.conftest import load_fixture_file, stored_files
+from app.utils import file_hash
+
+
+def test_migrate_media(test_app, clean_db, media_path):
+    load_fixture_file('Image__01.json')
+    for name, content in (('horse.png', b'HORSE'), ('horse-copy.png', b'HORSE'), ('duck.png', b'DUCK')):
+        with open(media_path / name, 'wb') as f:
+            f.write(content)
+    models.Image.objects(src='http://www.semantive.pl/duck.png').update(storage_url='/media/duck.png')
+
+    migrate_media()
+
+    files = stored_files(media_path)
+    assert len(files) == 2
+    assert all(name.count('/') == 2 for name in files)
+
+    images = models.Image.objects(storage_url__ne=None)
+    assert len(images) == 2
+    for image in images:
+        storage_name = image.storage_url.replace('/media/', '')
+        assert storage_name in files
+        assert file_hash(media_path / storage_name) == image.content_hash
+
+
+def test_sync_indexes(test_app, clean_db):
+    models.Image.ensure_indexes()
+    collection = models.Image._get_collection()
+    collection.create_index('name', name='name_1')
+    collection.drop_index('content_hash_1')
+
+    sync_indexes()
+
+    indexes = collection.index_information()
+    assert 'name_1' not in indexes
+    assert 'content_hash_1' in indexes
+    assert 'src_1' in indexes
+
+
+def test_migrate_image_links(test_app, clean_db):
+    load_fixture_file('ImageTask__01.json')
+    load_fixture_file('Image__01.json')
+    task, other_task = models.ImageTask.objects.all()
+    images = models.Image.objects.all()
+    models.Image._get_collection().update_many({}, {'$set': {'tasks': [task.id]}})
+    models.ImageTask._get_collection().update_one(
+        {'_id': other_task.id}, {'$set': {'images': [image.id for image in images[:2]]}}
+    )
+
+    migrate_image_links()
+    migrate_image_links()
+
+    assert sorted(image.id for image in task.linked_images()) == sorted(image.id for image in images)
+    assert sorted(image.id for image in other_task.linked_images()) == sorted(image.id for image in images[:2])
+    assert models.ImageTaskLink.objects.count() == 6
+    assert all('tasks' not in image for image in models.Image.objects.as_pymongo())
+    assert all('images' not in task for task in models.ImageTask.objects.as_pymongo())
+
+
+def test_migrate_text(test_app, clean_db):
+    load_fixture_file('TextTask__01.json')
+    task, other_task = models.TextTask.objects.all()
+    models.TextTask._get_collection().update_one({'_id': task.id}, {'$set': {'text': None}})
+    models.TextTask._get_collection().update_one({'_id': other_task.id}, {'$set': {'text': 'A text'}})
+    models.Page._get_collection().insert_one({'url': other_task.url, 'text': 'A text'})
+
+    migrate_text()
+    migrate_text()
+
+    assert task.reload().text_hash is None
+    assert other_task.reload().load_text() == 'A text'
+    assert other_task.text_preview == 'A text'
+    assert models.Page.objects.get(url=other_task.url).text_hash == other_task.text_hash
+    assert models.TextContent.objects.count() == 1
+    assert all('text' not in doc for doc in models.TextTask.objects.as_pymongo())
+    assert all('text' not in doc for doc in models.Page.objects.as_pymongo())
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from prometheus_client import REGISTRY
+
+from app import metrics, models
+from app.celery_tasks import execute_text_task
+from app.tests.conftest import load_fixture_file
+from app.utils import run_with_asyncio
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_endpoint(client, clean_db):
+    load_fixture_file('TextTask__01.json')
+    client.get('/api/text_tasks/')
+    before = sample(
+        'http_request_duration_seconds_count', endpoint='api.text_tasks_text_task_list', method='GET', status='200'
+    )
+
+    client.get('/api/text_tasks/')
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert b'tasks{status="waiting",type="TextTask"} 1.0' in response.data
+    assert b'tasks{status="success",type="ImageTask"} 0.0' in response.data
+    assert sample(
+        'http_request_duration_seconds_count', endpoint='api.text_tasks_text_task_list', method='GET', status='200'
+    ) == before + 1
+
+
+def test_task_phases(test_app, clean_db, mock_session):
+    load_fixture_file('TextTask__01.json')
+    task = models.TextTask.objects.first()
+    phases = ['page_fetch', 'parse', 'db']
+    before = [sample('task_phase_duration_seconds_count', phase=phase) for phase in phases]
+    page_bytes = sample('downloaded_bytes_total', kind='page')
+    finished = sample('tasks_finished_total', type='TextTask', status='success')
+
+    execute_text_task(task.to_json())
+
+    assert all(sample('task_phase_duration_seconds_count', phase=phase) > count for phase, count in zip(phases, before))
+    assert sample('downloaded_bytes_total', kind='page') > page_bytes
+    assert sample('tasks_finished_total', type='TextTask', status='success') == finished + 1
+    assert sample('task_queue_lag_seconds_count', type='TextTask') >= 1
+
+
+def test_track_loop_lag(mocker):
+    mocker.patch.dict('os.environ', {'LOOP_LAG_INTERVAL': '0.01'})
+    before = sample('event_loop_lag_seconds_bucket', le='0.025')
+    count = sample('event_loop_lag_seconds_count')
+
+    async def _blocking():
+        await asyncio.sleep(0.02)
+        # a blocking call stalls the loop, the sampler wakes up late
+        time.sleep(0.05)
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    assert run_with_asyncio(metrics.track_loop_lag(_blocking))() == 'done'
+
+    assert sample('event_loop_lag_seconds_count') > count
+    # the stalled sample is over 25 ms late
+    assert sample('event_loop_lag_seconds_count') - count > sample('event_loop_lag_seconds_bucket', le='0.025') - before
+
+
+def test_import_creates_multiprocess_dir(tmp_path):
+    # metric files are opened on import, before gunicorn or celery hooks run
+    path = tmp_path / 'metrics' / 'nested'
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    subprocess.run(
+        [sys.executable, '-c', 'import app.metrics'], cwd=root, check=True,
+        env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(path)}
+    )
+
+    assert os.listdir(path)
@@ -0,0 +1,153 @@
+import hashlib
+import hmac
+import itertools
+import json
+
+import aiohttp
+import asynctest
+import pytest
+from asynctest import CoroutineMock
+from bson import Timestamp
+
+from app import models, notifications
+from app.models import StatusEnum
+from app.tests.conftest import load_fixture_file
+from app.utils import run_with_asyncio
+
+
+def event(task, status):
+    return {'task': task, 'type': 'TextTask', 'status': status}
+
+
+def test_local_pubsub():
+    pubsub = notifications.LocalPubSub()
+    first = pubsub.subscribe(['a', 'b'])
+    second = pubsub.subscribe(['b'])
+
+    pubsub.publish(event('a', 'in progress'))
+    pubsub.publish(event('b', 'success'))
+    pubsub.publish(event('c', 'success'))
+
+    assert [first.get(0), first.get(0), first.get(0)] == [event('a', 'in progress'), event('b', 'success'), None]
+    assert [second.get(0), second.get(0)] == [event('b', 'success'), None]
+
+    first.close()
+    with second:
+        pubsub.publish(event('b', 'error'))
+    pubsub.publish(event('b', 'success'))
+    assert first.get(0) is None
+    assert second.get(0) == event('b', 'error')
+    assert second.get(0) is None
+
+
+@pytest.fixture
+def mongo_pubsub(test_app, mocker):
+    # mongomock has no capped collections, its cursors end instead of waiting for new events,
+    # nor does it set (or compare) timestamps as the server does - ordered numbers stand for them
+    mocker.patch.object(notifications.MongoPubSub, 'ensure_collection')
+    counter = itertools.count(1)
+    mocker.patch.object(notifications.MongoPubSub, 'stamp', side_effect=lambda event: {'ts': next(counter), **event})
+    pubsub = notifications.MongoPubSub(collection_name='test_task_events')
+    pubsub.collection.drop()
+    yield pubsub
+    pubsub.collection.drop()
+
+
+def test_mongo_pubsub(mongo_pubsub, mocker):
+    start = mocker.patch.object(notifications.MongoPubSub, 'start')
+    pubsub = mongo_pubsub
+
+    pubsub.publish(event('a', 'in progress'))
+    after = pubsub.last_ts()
+    pubsub.publish(event('a', 'success'))
+
+    with pubsub.subscribe(['a']) as subscription:
+        assert start.called
+        for stored in pubsub.read(after):
+            pubsub.dispatch(stored)
+        received = subscription.get(0)
+        assert {key: received[key] for key in ('task', 'status')} == {'task': 'a', 'status': 'success'}
+        assert subscription.get(0) is None
+
+    assert len(list(pubsub.read(None))) == 2
+
+
+def test_mongo_pubsub_start_position(mongo_pubsub, mocker):
+    tail = mocker.patch.object(notifications.MongoPubSub, '_tail')
+    pubsub = mongo_pubsub
+    pubsub.publish(event('a', 'in progress'))
+
+    # taken when subscribe returns, not when the tailer thread gets to run
+    with pubsub.subscribe(['a']):
+        pubsub.publish(event('a', 'success'))
+        assert tail.called
+        assert [stored['status'] for stored in pubsub.read(pubsub._after)] == ['success']
+
+
+def test_mongo_pubsub_stamp():
+    stamped = notifications.MongoPubSub().stamp(event('a', 'success'))
+    # empty timestamp, one of the first two fields (_id is added before it)
+    assert list(stamped)[0] == 'ts' and stamped['ts'] == Timestamp(0, 0)
+
+
+def test_get_pubsub(mocker):
+    mocker.patch.object(notifications, '_pubsub', None)
+    mocker.patch.dict('os.environ', {'TASK_EVENTS': 'mongo'})
+    assert isinstance(notifications.get_pubsub(), notifications.MongoPubSub)
+
+    mocker.patch.object(notifications, '_pubsub', None)
+    mocker.patch.dict('os.environ', {'TASK_EVENTS': 'redis'})
+    with pytest.raises(ValueError):
+        notifications.get_pubsub()
+
+
+@pytest.fixture
+def post_session():
+    session = asynctest.MagicMock()
+    session.post = CoroutineMock(return_value=asynctest.MagicMock())
+    return session
+
+
+def test_send_webhook(mocker, post_session):
+    mocker.patch.dict('os.environ', {'WEBHOOK_SECRET': 'secret'})
+    doc = {'_id': 'a', 'status': 'success'}
+
+    run_with_asyncio(notifications.send_webhook)(post_session, 'http://hooks.pl/done', doc)
+
+    (url,), kwargs = post_session.post.call_args
+    assert url == 'http://hooks.pl/done'
+    assert json.loads(kwargs['data']) == doc
+    signature = hmac.new(b'secret', kwargs['data'], hashlib.sha256).hexdigest()
+    assert kwargs['headers']['X-Signature'] == f'sha256={signature}'
+    assert post_session.post.return_value.raise_for_status.called
+
+
+def test_task_status_events(test_app, clean_db, mock_session):
+    load_fixture_file('TextTask__01.json')
+    task = models.TextTask.objects.first()
+
+    with notifications.get_pubsub().subscribe([task.pk]) as subscription:
+        run_with_asyncio(task.run)()
+        statuses = [subscription.get(0) for _ in range(3)]
+
+    assert statuses == [
+        event(str(task.pk), 'in progress'), event(str(task.pk), 'success'), None
+    ]
+
+
+def test_task_callback(test_app, clean_db, mock_session, session_object_mock, post_session):
+    task = models.TextTask.objects.create(url='http://www.google.pl', callback_url='http://hooks.pl/done')
+    session_object_mock.post = post_session.post
+
+    run_with_asyncio(task.run)()
+
+    posted = json.loads(post_session.post.call_args[1]['data'])
+    assert posted['_id'] == str(task.pk)
+    assert posted['status'] == StatusEnum.SUCCESS.value
+    assert posted['profile']['total'] > 0
+
+    # a failed delivery does not fail the task
+    post_session.post.side_effect = aiohttp.ClientConnectionError
+    task = models.TextTask.objects.create(url='http://www.google.pl', callback_url='http://hooks.pl/done')
+    run_with_asyncio(task.run)()
+    assert task.reload().status == StatusEnum.SUCCESS
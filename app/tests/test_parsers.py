@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+
+import pytest
+
+from app import parsers, utils
+from app.tests.conftest import FIXTURES_PATH, html_response
+from app.utils import (
+    ParsingException, extract_from_html, get_images_from_html, get_text_from_html, run_parser, run_with_asyncio
+)
+
+
+TEXT = """Testing — aiohttp 3.6.2 documentation
+Testing¶
+Testing aiohttp web servers¶
+aiohttp provides plugin for pytest making writing web server tests
+extremely easy, it also provides test framework agnostic
+utilities for testing
+with other frameworks such as unittest.
+Before starting to write your tests, you may also be interested on
+reading how to write testable
+services that interact
+with the loop.
+For using pytest plugin please install pytest-aiohttp library:
+$ pip install pytest-aiohttp"""
+
+IMAGES = [
+    {'src': '_static/aiohttp-icon-128x128.png', 'name': 'Logo'},
+    {'src': 'https://travis-ci.com/aio-libs/aiohttp.svg?branch=master', 'name': 'Travis CI status'},
+    {'src': 'https://codecov.io/github/aio-libs/aiohttp/coverage.svg?branch=master', 'name': 'Code coverage status'},
+    {'src': 'https://badge.fury.io/py/aiohttp.svg', 'name': 'Latest PyPI package version'},
+    {'src': 'https://badges.gitter.im/Join%20Chat.svg', 'name': 'Chat on Gitter'},
+]
+
+
+@pytest.fixture(params=list(parsers.PARSERS))
+def html_parser(request, mocker):
+    mocker.patch.dict('os.environ', {'HTML_PARSER': request.param})
+    return request.param
+
+
+def test_parse_fixture(html_parser):
+    html = html_response().decode()
+
+    assert get_text_from_html(html) == TEXT
+    assert get_images_from_html(html) == IMAGES
+    assert extract_from_html(html) == {'text': TEXT, 'images': IMAGES}
+
+
+@pytest.mark.parametrize('html', [
+    '',
+    'plain text',
+    '<p>a<!-- comment -->b<br>c</p>\n\n<pre>  \n  x</pre><div>   </div><span> </span>t<textarea>  </textarea>',
+    '<p>&nbsp;&amp;</p><script>var a = "<p>";</script>tail<style>p {}</style><img alt="no src"><img src="a.png">',
+])
+def test_parsers_give_same_results(html):
+    results = [parser().extract(html) for parser in parsers.PARSERS.values()]
+
+    assert all(result == results[0] for result in results)
+
+
+def test_parsers_give_same_results_for_xhtml():
+    # starts with an xml declaration of its encoding
+    with open(os.path.join(FIXTURES_PATH, 'xhtml.html'), encoding='utf-8') as f:
+        html = f.read()
+
+    results = [parser().extract(html) for parser in parsers.PARSERS.values()]
+
+    assert results[0]['images'] == [{'src': '/img/logo.png', 'name': 'Logo'}, {'src': 'photo.jpg', 'name': None}]
+    assert 'Pierwszy akapit' in results[0]['text']
+    assert all(result == results[0] for result in results)
+
+
+def test_parsing_exception(html_parser):
+    with pytest.raises(ParsingException):
+        get_text_from_html(None)
+
+
+def test_unknown_parser(mocker):
+    mocker.patch.dict('os.environ', {'HTML_PARSER': 'regex'})
+
+    with pytest.raises(ValueError):
+        get_text_from_html('<p>a</p>')
+
+
+def _crash(html):
+    os._exit(1)
+
+
+@pytest.mark.parametrize('executor', ['process', 'thread', 'inline'])
+def test_run_parser(mocker, executor):
+    mocker.patch.dict('os.environ', {'PARSER_EXECUTOR': executor, 'PARSER_POOL_SIZE': '1'})
+
+    assert run_with_asyncio(run_parser)(get_text_from_html, html_response().decode()) == TEXT
+    with pytest.raises(ParsingException):
+        run_with_asyncio(run_parser)(get_text_from_html, None)
+
+    utils.shutdown_parser_executors()
+
+
+def test_run_parser_broken_process_pool(mocker):
+    mocker.patch.dict('os.environ', {'PARSER_EXECUTOR': 'process', 'PARSER_POOL_SIZE': '1'})
+    executor = utils.get_parser_executor()
+
+    with pytest.raises(ParsingException):
+        run_with_asyncio(run_parser)(_crash, '<p>a</p>')
+
+    assert utils.get_parser_executor() is not executor
+    assert run_with_asyncio(run_parser)(get_text_from_html, '<p>a</p>') == 'a'
+    utils.shutdown_parser_executors()
+
+
+def _parse_in_daemon(results):
+    os.environ.update({'PARSER_EXECUTOR': 'process', 'PARSER_POOL_SIZE': '1'})
+    try:
+        results.put(run_with_asyncio(run_parser)(get_text_from_html, '<p>a</p>'))
+    except Exception as e:
+        results.put(repr(e))
+    finally:
+        utils.shutdown_parser_executors()
+
+
+def test_run_parser_in_daemon_process():
+    # as in a child of celery prefork pool, which cannot start processes of a pool
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_parse_in_daemon, args=(results,), daemon=True)
+    process.start()
+    process.join(30)
+
+    assert results.get(timeout=1) == 'a'
+
+
+def test_run_parser_executor_failure(mocker):
+    executor = mocker.patch('app.utils.get_parser_executor').return_value
+    executor.submit.side_effect = AssertionError('daemonic processes are not allowed to have children')
+
+    with pytest.raises(ParsingException):
+        run_with_asyncio(run_parser)(get_text_from_html, '<p>a</p>')
+
+
+def test_parser_pool_size(mocker):
+    mocker.patch('os.cpu_count', return_value=8)
+    mocker.patch.dict('os.environ', {'PARSER_POOL_SIZE': '0', 'WORKER_CONCURRENCY': '4'})
+    assert utils.get_parser_pool_size() == 2
+
+    mocker.patch.dict('os.environ', {'WORKER_CONCURRENCY': '16'})
+    assert utils.get_parser_pool_size() == 1
+
+    mocker.patch.dict('os.environ', {'PARSER_POOL_SIZE': '3'})
+    assert utils.get_parser_pool_size() == 3
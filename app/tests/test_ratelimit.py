@@ -0,0 +1,105 @@
+import datetime
+import email.utils
+
+import pytest
+from asynctest import CoroutineMock
+from prometheus_client import REGISTRY
+
+from app import ratelimit
+from app.ratelimit import LocalBuckets, MongoBuckets, RateLimiter, parse_retry_after
+from app.utils import run_with_asyncio
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def sleep(mocker):
+    return mocker.patch('app.ratelimit.asyncio.sleep', new=CoroutineMock())
+
+
+@pytest.mark.parametrize('buckets', [LocalBuckets(), MongoBuckets()], ids=['local', 'mongo'])
+def test_rate_limiter_paces_requests_of_workers(test_app, sleep, buckets):
+    buckets.update('a.pl', lambda state, now: (None, None))
+    # two worker processes sharing the buckets
+    workers = [RateLimiter(buckets, rate=10, burst=2) for _ in range(2)]
+    before = [
+        sample('host_throttled_requests_total', host='a.pl'), sample('host_throttled_seconds_total', host='a.pl'),
+        sample('host_throttled_requests_total', host='b.pl'), sample('host_rate_limit_wait_seconds_count'),
+    ]
+
+    async def _run():
+        for i in range(6):
+            await workers[i % 2].wait('a.pl')
+        await workers[0].wait('b.pl')
+
+    run_with_asyncio(_run)()
+
+    delays = [call[0][0] for call in sleep.call_args_list]
+    assert delays == pytest.approx([0.1, 0.2, 0.3, 0.4], abs=0.05)
+    assert sample('host_throttled_requests_total', host='a.pl') - before[0] == 4
+    assert sample('host_throttled_seconds_total', host='a.pl') - before[1] == pytest.approx(1.0, abs=0.1)
+    assert sample('host_throttled_requests_total', host='b.pl') == before[2]
+    assert sample('host_rate_limit_wait_seconds_count') - before[3] == 7
+
+
+def test_rate_limiter_pause(sleep):
+    limiter = RateLimiter(LocalBuckets(), rate=10, burst=2)
+    before = sample('host_retry_after_pauses_total', host='a.pl')
+
+    async def _run():
+        await limiter.pause('a.pl', 30)
+        for _ in range(2):
+            await limiter.wait('a.pl')
+
+    run_with_asyncio(_run)()
+
+    delays = [call[0][0] for call in sleep.call_args_list]
+    assert delays == pytest.approx([30, 30.1], abs=0.05)
+    assert sample('host_retry_after_pauses_total', host='a.pl') == before + 1
+
+
+def test_rate_limiter_disabled(sleep):
+    limiter = RateLimiter(LocalBuckets(), rate=0)
+    before = sample('host_rate_limit_wait_seconds_count')
+
+    run_with_asyncio(limiter.wait)('a.pl')
+    run_with_asyncio(limiter.pause)('a.pl', 30)
+
+    assert not sleep.called
+    assert sample('host_rate_limit_wait_seconds_count') == before
+
+
+def test_get_takes_retry_after(sleep, mocker):
+    mocker.patch.object(ratelimit, '_rate_limiter', RateLimiter(LocalBuckets(), rate=10, burst=1))
+    before = sample('host_retry_after_pauses_total', host='a.pl')
+    session = mocker.MagicMock()
+    session.get = CoroutineMock()
+    session.get.return_value.status = 429
+    session.get.return_value.headers = {'Retry-After': '5'}
+
+    response = run_with_asyncio(ratelimit.get)(session, 'http://A.pl/page', headers={'If-None-Match': '"1"'})
+
+    assert response is session.get.return_value
+    session.get.assert_called_once_with('http://A.pl/page', headers={'If-None-Match': '"1"'})
+    assert sample('host_retry_after_pauses_total', host='a.pl') == before + 1
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('120', 120),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0),
+    ('86400', 300),
+    ('soon', None),
+    (None, None),
+])
+def test_parse_retry_after(value, seconds):
+    result = parse_retry_after(value)
+
+    assert result == seconds
+
+
+def test_parse_retry_after_date():
+    date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
+
+    assert parse_retry_after(email.utils.format_datetime(date)) == pytest.approx(60, abs=2)
@@ -0,0 +1,104 @@
+import aiohttp
+import pytest
+from asynctest import CoroutineMock
+
+from app import resilience
+from app.resilience import CircuitBreaker, CircuitOpenError, backoff_delay, is_transient
+from app.utils import run_with_asyncio
+
+
+@pytest.fixture
+def sleep(mocker):
+    return mocker.patch('app.resilience.asyncio.sleep', new=CoroutineMock())
+
+
+@pytest.fixture
+def breaker(mocker):
+    return mocker.patch.object(resilience, '_circuit_breaker', CircuitBreaker(threshold=3, reset_timeout=30))
+
+
+def response_error(status):
+    return aiohttp.ClientResponseError(None, (), status=status)
+
+
+@pytest.mark.parametrize('error, transient', [
+    (aiohttp.ClientConnectionError(), True),
+    (aiohttp.ServerTimeoutError(), True),
+    (aiohttp.ClientPayloadError(), True),
+    (response_error(503), True),
+    (response_error(429), True),
+    (response_error(404), False),
+    (CircuitOpenError(), False),
+    (UnicodeError(), False),
+])
+def test_is_transient(error, transient):
+    assert is_transient(error) == transient
+
+
+def test_backoff_delay(mocker):
+    mocker.patch.dict('os.environ', {'HTTP_RETRY_BACKOFF': '0.5', 'HTTP_RETRY_BACKOFF_MAX': '3'})
+
+    delays = [[backoff_delay(attempt) for _ in range(50)] for attempt in range(5)]
+
+    assert [max(attempt_delays) <= limit for attempt_delays, limit in zip(delays, [0.5, 1, 2, 3, 3])] == [True] * 5
+    assert len(set(delays[0])) > 1
+
+
+@pytest.mark.parametrize('errors, retries, calls, raises', [
+    ([aiohttp.ClientConnectionError(), response_error(502)], '2', 3, None),
+    ([aiohttp.ClientConnectionError()] * 3, '2', 3, aiohttp.ClientConnectionError),
+    ([response_error(404)], '2', 1, aiohttp.ClientResponseError),
+], ids=['recovered', 'retries exhausted', 'not transient'])
+def test_call_retries_transient_errors(mocker, sleep, breaker, errors, retries, calls, raises):
+    mocker.patch.dict('os.environ', {'HTTP_RETRIES': retries})
+    request = CoroutineMock(side_effect=errors + ['page'])
+
+    if raises:
+        with pytest.raises(raises):
+            run_with_asyncio(resilience.call)('a.pl', request, 'http://a.pl')
+    else:
+        assert run_with_asyncio(resilience.call)('a.pl', request, 'http://a.pl') == 'page'
+
+    assert request.call_count == calls
+    # no sleep after the last attempt
+    assert sleep.call_count == calls - 1
+
+
+def test_circuit_breaker(mocker):
+    now = mocker.patch('app.resilience.time.monotonic', return_value=100)
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+
+    breaker.failed('a.pl')
+    breaker.check('a.pl')
+    breaker.failed('a.pl')
+    assert breaker.state('a.pl') == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.check('a.pl')
+    # other hosts are not affected
+    breaker.check('b.pl')
+
+    # a single trial request after the reset timeout, its failure opens the circuit again
+    now.return_value = 130
+    breaker.check('a.pl')
+    with pytest.raises(CircuitOpenError):
+        breaker.check('a.pl')
+    breaker.failed('a.pl')
+    with pytest.raises(CircuitOpenError):
+        breaker.check('a.pl')
+
+    now.return_value = 160
+    breaker.check('a.pl')
+    breaker.succeeded('a.pl')
+    breaker.check('a.pl')
+    assert breaker.stats() == {}
+
+
+def test_call_fails_fast_on_open_circuit(mocker, sleep, breaker):
+    mocker.patch.dict('os.environ', {'HTTP_RETRIES': '5'})
+    request = CoroutineMock(side_effect=aiohttp.ClientConnectionError())
+
+    with pytest.raises(CircuitOpenError):
+        run_with_asyncio(resilience.call)('a.pl', request)
+
+    assert request.call_count == 3
+    assert breaker.stats() == {'a.pl': {'failures': 3, 'state': 'open'}}
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.scheduler import DownloadScheduler
+from app.utils import run_with_asyncio
+
+
+async def _download(scheduler, host, started, release):
+    async def _job():
+        started.append(host)
+        await release.wait()
+    await scheduler.run(host, _job)
+
+
+def test_scheduler_limits_and_round_robin():
+    scheduler = DownloadScheduler(max_concurrency=3, max_per_host=2)
+    started = []
+
+    async def _run():
+        release = asyncio.Event()
+        jobs = [
+            asyncio.ensure_future(_download(scheduler, host, started, release))
+            for host in ['cdn'] * 5 + ['a', 'b']
+        ]
+        await asyncio.sleep(0)
+
+        assert started == ['cdn', 'cdn', 'a']
+        assert scheduler.in_flight == 3
+        assert scheduler.queue_depth == 4
+        assert REGISTRY.get_sample_value('image_downloads_in_flight') == 3
+        assert REGISTRY.get_sample_value('image_downloads_queued') == 4
+
+        release.set()
+        await asyncio.gather(*jobs)
+
+    run_with_asyncio(_run)()
+
+    # waiting hosts are served in turns, 'b' does not wait for the whole 'cdn' queue
+    assert started.index('b') < len(started) - 1
+    assert scheduler.in_flight == 0
+    assert scheduler.queue_depth == 0
+    assert REGISTRY.get_sample_value('image_downloads_in_flight') == 0
+    assert REGISTRY.get_sample_value('image_downloads_queued') == 0
+
+
+def test_scheduler_releases_slot_on_error_and_cancel():
+    scheduler = DownloadScheduler(max_concurrency=1, max_per_host=1)
+    started = []
+
+    async def _fail():
+        raise ValueError
+
+    async def _run():
+        with pytest.raises(ValueError):
+            await scheduler.run('a', _fail)
+
+        release = asyncio.Event()
+        first = asyncio.ensure_future(_download(scheduler, 'a', started, release))
+        waiting = asyncio.ensure_future(_download(scheduler, 'a', started, release))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+
+        waiting.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 0
+        assert REGISTRY.get_sample_value('image_downloads_queued') == 0
+
+        release.set()
+        await first
+        await _download(scheduler, 'c', started, release)
+
+    run_with_asyncio(_run)()
+
+    assert started == ['a', 'c']
+    assert scheduler.in_flight == 0
@@ -0,0 +1,71 @@
+import datetime
+import json
+
+import msgpack
+import pytest
+from bson import ObjectId, json_util
+from flask import json as flask_json
+
+from app import serializers
+from app.models import StatusEnum
+from app.utils import MongoEngineObjectIdJSONEncoder
+
+
+DOC = {
+    '_id': ObjectId('5e5a1b2c3d4e5f6a7b8c9d0e'),
+    '_cls': 'ImageTask',
+    'url': 'http://www.google.pl',
+    'status': StatusEnum.SUCCESS,
+    'date_created': datetime.datetime(2020, 2, 29, 12, 30, 15, 123456),
+    'profile': {'total': 1.25, 'phases': {'db': {'time': 0.01, 'count': 3}}, 'counts': {}},
+    'capture_profile': False,
+}
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def backend(request, mocker):
+    if request.param == 'json':
+        mocker.patch('app.serializers.orjson', None)
+    return request.param
+
+
+def test_dumps_matches_former_encoders(backend):
+    # stored documents hold values of enums
+    raw = {**DOC, 'status': DOC['status'].value}
+    for doc, expected in ((DOC, raw), ([DOC], [raw])):
+        assert json.loads(serializers.dumps(doc)) == json.loads(
+            flask_json.dumps(expected, cls=MongoEngineObjectIdJSONEncoder)
+        )
+
+    assert json.loads(serializers.dumps(DOC, extended=True)) == json.loads(json_util.dumps(raw))
+
+
+def test_dumps_unknown_type(backend):
+    with pytest.raises(TypeError):
+        serializers.dumps({'value': object()})
+
+
+def test_packb():
+    assert msgpack.unpackb(serializers.packb(DOC), timestamp=3) == {
+        **DOC, '_id': str(DOC['_id']), 'status': 'success',
+        'date_created': DOC['date_created'].replace(tzinfo=datetime.timezone.utc),
+    }
+
+
+@pytest.mark.parametrize('mimetype', [serializers.JSON, serializers.MSGPACK])
+def test_stream(backend, mimetype):
+    docs = [DOC, {**DOC, '_id': ObjectId()}]
+    data = b''.join(serializers.stream(iter(docs), mimetype))
+
+    if mimetype == serializers.JSON:
+        assert json.loads(data) == json.loads(json_util.dumps([{**doc, 'status': 'success'} for doc in docs]))
+    else:
+        assert [doc['_id'] for doc in msgpack.unpackb(data)] == [str(doc['_id']) for doc in docs]
+
+    assert b''.join(serializers.stream(iter([]), mimetype)) in (b'[]', b'\x90')
+
+
+def test_mimetypes(mocker):
+    assert serializers.mimetypes() == [serializers.JSON, serializers.MSGPACK]
+    mocker.patch('app.serializers.msgpack', None)
+    assert serializers.mimetypes() == [serializers.JSON]
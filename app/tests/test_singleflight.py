@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import LocalLeases, MongoLeases, SingleFlight
+from app.utils import run_with_asyncio
+
+
+def test_singleflight_shares_call():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def _fetch(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return f'{url} parsed'
+
+    async def _run():
+        return await asyncio.gather(
+            *(singleflight.run(url, _fetch, url) for url in ['http://a.pl'] * 3 + ['http://b.pl'])
+        )
+
+    assert run_with_asyncio(_run)() == ['http://a.pl parsed'] * 3 + ['http://b.pl parsed']
+    assert calls == ['http://a.pl', 'http://b.pl']
+
+    # finished calls are not reused
+    run_with_asyncio(_run)()
+    assert len(calls) == 4
+
+
+def test_singleflight_shares_exception_and_survives_cancel():
+    singleflight = SingleFlight()
+    release = asyncio.Event()
+
+    async def _fail():
+        await release.wait()
+        raise ValueError
+
+    async def _run():
+        first = asyncio.ensure_future(singleflight.run('key', _fail))
+        second = asyncio.ensure_future(singleflight.run('key', _fail))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        with pytest.raises(ValueError):
+            await second
+
+    run_with_asyncio(_run)()
+
+
+def test_singleflight_waits_for_lease_of_other_worker():
+    leases = LocalLeases()
+    workers = [SingleFlight(leases, poll_interval=0.01, owner=f'worker-{i}') for i in range(2)]
+    running = []
+
+    async def _fetch(worker):
+        running.append(worker)
+        await asyncio.sleep(0.03)
+        assert running == [worker]
+        running.remove(worker)
+        return worker
+
+    async def _run():
+        return await asyncio.gather(*(singleflight.run('key', _fetch, i) for i, singleflight in enumerate(workers)))
+
+    assert run_with_asyncio(_run)() == [0, 1]
+
+
+@pytest.mark.parametrize('leases', [LocalLeases(), MongoLeases()], ids=['local', 'mongo'])
+def test_leases(test_app, leases):
+    assert leases.acquire('key', 'worker-1', 60)
+    assert not leases.acquire('key', 'worker-2', 60)
+
+    # only owner releases its lease
+    leases.release('key', 'worker-2')
+    assert not leases.acquire('key', 'worker-2', 60)
+    leases.release('key', 'worker-1')
+    assert leases.acquire('key', 'worker-2', 0)
+
+    # lease of a crashed worker expires
+    assert leases.acquire('key', 'worker-1', 60)
+    leases.release('key', 'worker-1')
@@ -1,11 +1,15 @@
+import asyncio
+
 import aiohttp
 import pytest
+from asynctest import CoroutineMock
+from pymongo.errors import BulkWriteError
 
 from app import models
-from app.celery_tasks import execute_text_task, execute_images_task
+from app.celery_tasks import execute_text_task, execute_images_task, execute_text_tasks
 from app.models import StatusEnum
 from app.tests.conftest import load_fixture_file, get_image_dicts
-from app.utils import run_with_asyncio, ParsingException
+from app.utils import run_with_asyncio, ParsingException, StorageLimitExceeded
 
 
 @pytest.mark.parametrize(
@@ -14,12 +18,12 @@ from app.utils import run_with_asyncio, ParsingException
         ('session_object_mock', None, 'get', StatusEnum.SUCCESS),
         ('session_object_mock', aiohttp.ClientError, 'get', StatusEnum.ERROR),
         ('session_object_mock', UnicodeError, 'get.return_value.text', StatusEnum.ERROR),
-        ('app.utils.get_text_from_html', ParsingException, '', StatusEnum.ERROR),
+        ('app.utils.extract_from_html', ParsingException, '', StatusEnum.ERROR),
     ],
     ids=['successful', 'load page exception', 'page content decode error', 'parsing exception']
 )
 def test_execute_text_task(
-        test_app, clean_db, session_object_mock, mock_session_ctx, set_side_effect, target,
+        test_app, clean_db, session_object_mock, mock_session, set_side_effect, target,
         side_effect, side_effect_target, status):
 
     load_fixture_file('TextTask__01.json')
@@ -48,17 +52,125 @@ $ pip install pytest-aiohttp"""
         execute_text_task(task.to_json())
     task.reload()
 
-    assert task.text == (text if not side_effect else None)
+    assert task.load_text() == (text if not side_effect else None)
+    assert task.text_preview == (text[:200] if not side_effect else None)
+    assert task.text_size == (len(text.encode()) if not side_effect else None)
     assert task.status == status
 
 
+def test_execute_text_tasks_batch(test_app, clean_db, session_object_mock, mock_session, mocker):
+    load_fixture_file('TextTask__01.json')
+    tasks = models.TextTask.objects.all()
+
+    execute_text_tasks([str(task.pk) for task in tasks])
+
+    for task in tasks:
+        task.reload()
+        assert task.status == StatusEnum.SUCCESS
+        assert task.text_preview.startswith('Testing — aiohttp 3.6.2 documentation')
+
+    # both tasks share the stored text
+    assert models.TextContent.objects.count() == 1
+
+    # a failing task does not stop the rest of the chunk, but the batch is reported as failed
+    models.Page.drop_collection()
+    mocker.patch.object(
+        models.utils, 'extract_from_html', side_effect=[ParsingException, {'text': 'A text', 'images': []}]
+    )
+    with pytest.raises(models.TaskException):
+        execute_text_tasks([str(task.pk) for task in tasks])
+
+    assert sorted(task.reload().status.value for task in tasks) == ['error', 'success']
+
+
+def test_execute_text_tasks_share_page_fetch(test_app, clean_db, session_object_mock, mock_session, mocker):
+    mocker.patch.dict('os.environ', {'SINGLEFLIGHT_TTL': '60'})
+    for i in range(3):
+        models.TextTask.objects.create(url='http://www.google.pl', status='waiting')
+    tasks = models.TextTask.objects.all()
+
+    execute_text_tasks([str(task.pk) for task in tasks])
+
+    # tasks of the same url running together fetch and parse the page once
+    assert session_object_mock.get.call_count == 1
+    assert len({task.reload().text_hash for task in tasks}) == 1
+    assert all(task.status == StatusEnum.SUCCESS for task in tasks)
+
+    # and a task submitted again shortly after reuses the result
+    execute_text_task(tasks[0].to_json())
+    assert session_object_mock.get.call_count == 1
+
+    # failure is reported by all of them
+    models.Page.drop_collection()
+    session_object_mock.get.side_effect = aiohttp.ClientError
+    with pytest.raises(models.TaskException):
+        execute_text_tasks([str(task.pk) for task in tasks])
+    assert session_object_mock.get.call_count == 2
+    assert all(task.reload().status == StatusEnum.ERROR for task in tasks)
+
+
+@pytest.mark.parametrize('status, body', [
+    (304, ''),
+    (200, None),
+], ids=['not modified', 'same body'])
+def test_execute_text_task_reuses_cached_page(
+        test_app, clean_db, session_object_mock, mock_session, mocker, status, body):
+
+    load_fixture_file('TextTask__01.json')
+    task, other_task = models.TextTask.objects.all()
+    other_task.update(url=task.url)
+    response = session_object_mock.get.return_value
+    response.headers = {'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+    execute_text_task(task.to_json())
+
+    extract_from_html = mocker.patch.object(models.utils, 'extract_from_html')
+    response.status = status
+    if body is not None:
+        response.text.return_value = body
+    execute_text_task(other_task.to_json())
+
+    assert session_object_mock.get.call_args[1]['headers'] == {
+        'If-None-Match': '"abc"', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'
+    }
+    assert not extract_from_html.called
+    assert other_task.reload().status == StatusEnum.SUCCESS
+    assert other_task.text_hash == task.reload().text_hash
+
+    # changed page is parsed again, cached images of the former version are not reused
+    response.status = 200
+    response.text.return_value = '<html><body>Changed</body></html>'
+    extract_from_html.return_value = {'text': 'Changed', 'images': [{'src': 'new.png', 'name': None}]}
+    execute_text_task(other_task.to_json())
+
+    assert other_task.reload().load_text() == 'Changed'
+    assert models.Page.objects.get(url=task.url).images == [{'src': 'new.png', 'name': None}]
+
+
+def test_tasks_of_both_types_share_page_parse(test_app, clean_db, session_object_mock, mock_session, mocker):
+    mocker.patch.dict('os.environ', {'SINGLEFLIGHT_TTL': '60'})
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(return_value=('ab12', '/media/file.png')))
+    extract_from_html = mocker.spy(models.utils, 'extract_from_html')
+    image_task = models.ImageTask.objects.create(url='http://www.google.pl')
+    text_task = models.TextTask.objects.create(url='http://www.google.pl')
+
+    execute_images_task(image_task.to_json())
+    execute_text_task(text_task.to_json())
+
+    # the page parsed for images gave the text as well
+    assert extract_from_html.call_count == 1
+    assert text_task.reload().status == StatusEnum.SUCCESS
+    assert text_task.text_preview.startswith('Testing — aiohttp 3.6.2 documentation')
+    assert len(image_task.reload().linked_images()) > 0
+
+
 @pytest.mark.parametrize(
     'target, side_effect, side_effect_target, status',
     [
         ('session_object_mock', None, 'get', StatusEnum.SUCCESS),
         ('session_object_mock', aiohttp.ClientError, 'get', StatusEnum.ERROR),
         ('session_object_mock', UnicodeError, 'get.return_value.text', StatusEnum.ERROR),
-        ('app.utils.get_images_from_html', ParsingException, '', StatusEnum.ERROR),
+        ('app.utils.extract_from_html', ParsingException, '', StatusEnum.ERROR),
     ],
     ids=['successful', 'load page exception', 'page content decode error', 'parsing exception']
 )
@@ -69,9 +181,9 @@ def test_task_get_images(
     load_fixture_file('ImageTask__01.json')
     task = models.ImageTask.objects.first()
 
-    _html_images = get_image_dicts(exclude=('status', 'storage_url', 'tasks'))
+    _html_images = get_image_dicts(exclude=('status', 'storage_url'))
     
-    mocker.patch.object(models.utils, 'get_images_from_html', return_value=_html_images)
+    mocker.patch.object(models.utils, 'extract_from_html', return_value={'text': '', 'images': _html_images})
     set_side_effect(locals(), target, side_effect_target, side_effect)
 
     if side_effect:
@@ -79,13 +191,82 @@ def test_task_get_images(
             run_with_asyncio(task.get_images)(session_object_mock)
     else:
         run_with_asyncio(task.get_images)(session_object_mock)
-    task.reload()
+    images = task.linked_images()
 
     if side_effect:
-        assert len(task.images) == 0
+        assert len(images) == 0
     else:
-        assert len(task.images) == len(_html_images)
-        assert set(img.src for img in task.images) == set(img['src'] for img in _html_images)
+        assert len(images) == len(_html_images)
+        assert set(img.src for img in images) == set(img['src'] for img in _html_images)
+
+
+def test_task_get_images_dedupes_and_links_existing(test_app, clean_db, mocker, session_object_mock):
+    load_fixture_file('ImageTask__01.json')
+    load_fixture_file('Image__01.json')
+    task, other_task = models.ImageTask.objects.all()
+
+    _html_images = get_image_dicts(exclude=('status', 'storage_url'))
+    _html_images += [{'src': 'http://www.semantive.pl/cat.png', 'name': 'Cat'}, *_html_images[:2]]
+    mocker.patch.object(models.utils, 'extract_from_html', return_value={'text': '', 'images': _html_images})
+
+    run_with_asyncio(other_task.get_images)(session_object_mock)
+    run_with_asyncio(task.get_images)(session_object_mock)
+
+    images = task.linked_images()
+    assert sorted(img.src for img in images) == sorted(img['src'] for img in _html_images[:5])
+    assert models.Image.objects.count() == 5
+    assert models.Image.objects.get(src='http://www.semantive.pl/cat.png').name == 'Cat'
+    assert models.Image.objects.get(src='http://www.onet.pl/files/horse.png').status == StatusEnum.SUCCESS
+    assert models.ImageTaskLink.objects.count() == 10
+    for img in images:
+        assert sorted(link.task.id for link in models.ImageTaskLink.objects(image=img)) == [task.id, other_task.id]
+
+    # linking again does not write to images nor duplicate links
+    run_with_asyncio(task.get_images)(session_object_mock)
+    assert models.ImageTaskLink.objects.count() == 10
+    assert all('tasks' not in img for img in models.Image.objects.as_pymongo())
+
+
+def test_task_get_images_skips_bad_images(test_app, clean_db, mocker, session_object_mock):
+    load_fixture_file('ImageTask__01.json')
+    task = models.ImageTask.objects.first()
+
+    _html_images = get_image_dicts(exclude=('status', 'storage_url'))
+    mocker.patch.object(models.utils, 'extract_from_html', return_value={'text': '', 'images': [
+        {'src': 'http://www.semantive.pl/cat.png', 'name': 'Cat ' * 100},
+        {'src': 'data:image/png;base64,iVBORw0KGgo=', 'name': 'inline'},
+        {'src': 'javascript:void(0)', 'name': None},
+        {'src': 'http://www.semantive.pl/a cat.png', 'name': 'not a valid url'},
+        *_html_images,
+    ]})
+
+    run_with_asyncio(task.get_images)(session_object_mock)
+
+    images = task.linked_images()
+    assert sorted(img.src for img in images) == sorted(
+        ['http://www.semantive.pl/cat.png'] + [img['src'] for img in _html_images]
+    )
+    assert models.Image.objects.get(src='http://www.semantive.pl/cat.png').name == ('Cat ' * 100)[:128]
+
+
+def test_image_bulk_upsert_retries_lost_insert_race(test_app, clean_db, mocker):
+    src = 'http://www.semantive.pl/cat.png'
+
+    collection = models.Image._get_collection()
+    bulk_write = collection.bulk_write
+
+    def racing_bulk_write(requests, **kwargs):
+        if not models.Image.objects(src=src):
+            # other worker inserts the same src before our upsert lands
+            models.Image.objects.create(src=src)
+            raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}]})
+        return bulk_write(requests, **kwargs)
+
+    mocker.patch.object(collection, 'bulk_write', side_effect=racing_bulk_write)
+    ids = models.Image.bulk_upsert({src: None})
+
+    assert collection.bulk_write.call_count == 2
+    assert ids == [models.Image.objects.get(src=src).id]
 
 
 @pytest.mark.parametrize(
@@ -94,9 +275,8 @@ def test_task_get_images(
         ('session_object_mock', None, 'get', StatusEnum.SUCCESS),
         ('session_object_mock', aiohttp.ClientError, 'get', StatusEnum.ERROR),
         ('app.utils.write_to_storage', OSError, '', StatusEnum.ERROR),
-        ('app.utils.write_to_storage', FileExistsError, '', StatusEnum.SUCCESS),
     ],
-    ids=['successful', 'download failed', 'cannot open file to save image', 'image exists in storage']
+    ids=['successful', 'download failed', 'cannot open file to save image']
 )
 def test_image_download_image(
         test_app, clean_db, mocker, session_object_mock, target, set_side_effect,
@@ -106,24 +286,47 @@ def test_image_download_image(
     load_fixture_file('Image__01.json')
 
     storage_url = '/media/file.png'
-    mocker.patch.object(models.utils, 'write_to_storage')
-    mocker.patch.object(models.utils, 'get_storage_path_and_url', return_value=('x', storage_url))
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(return_value=('ab12', storage_url)))
     set_side_effect(locals(), target, side_effect_target, side_effect)
 
     task = models.ImageTask.objects.first()
     image = models.Image.objects.first()
-    
-    raises = side_effect and side_effect is not FileExistsError
+    assert image.claim('worker-1', 60)
+
+    raises = bool(side_effect)
 
     if raises:
         with pytest.raises(side_effect):
-            run_with_asyncio(image.download_image)(task, session_object_mock)
+            run_with_asyncio(image.download_image)(task, session_object_mock, 'worker-1')
     else:
-        run_with_asyncio(image.download_image)(task, session_object_mock)
+        run_with_asyncio(image.download_image)(task, session_object_mock, 'worker-1')
     image.reload()
     
     assert image.status == status
     assert image.storage_url == (None if raises else storage_url)
+    assert image.content_hash == (None if raises else 'ab12')
+
+
+def test_image_download_image_too_big(test_app, clean_db, mocker, session_object_mock):
+    load_fixture_file('ImageTask__01.json')
+    load_fixture_file('Image__01.json')
+
+    write_to_storage = mocker.patch.object(models.utils, 'write_to_storage', new_callable=CoroutineMock)
+    mocker.patch.object(models.utils, 'get_max_image_size', return_value=3)
+    session_object_mock.get.return_value.content_length = 4
+
+    task = models.ImageTask.objects.first()
+    image = models.Image.objects.first()
+    assert image.claim('worker-1', 60)
+
+    with pytest.raises(StorageLimitExceeded):
+        run_with_asyncio(image.download_image)(task, session_object_mock, 'worker-1')
+    image.reload()
+
+    assert not write_to_storage.called
+    assert session_object_mock.get.return_value.close.called
+    assert image.status == StatusEnum.ERROR
+    assert image.storage_url is None
 
 
 @pytest.mark.parametrize(
@@ -132,9 +335,8 @@ def test_image_download_image(
         ('session_object_mock', None, 'get', StatusEnum.SUCCESS, StatusEnum.SUCCESS),
         ('session_object_mock', aiohttp.ClientError, 'get', StatusEnum.ERROR, StatusEnum.ERROR),
         ('app.utils.write_to_storage', OSError, '', StatusEnum.ERROR, StatusEnum.ERROR),
-        ('app.utils.write_to_storage', FileExistsError, '', StatusEnum.SUCCESS, StatusEnum.SUCCESS),
     ],
-    ids=['successful', 'download failed', 'cannot open file to save image', 'image exists in storage']
+    ids=['successful', 'download failed', 'cannot open file to save image']
 )
 def test_task_download_images(
         test_app, clean_db, session_object_mock, mocker, set_side_effect,
@@ -147,14 +349,13 @@ def test_task_download_images(
 
     initial_statuses = {img.id: img.status for img in images}
 
-    task.update(images=images)
+    models.ImageTaskLink.bulk_link([(task.id, img.id) for img in images])
 
     storage_url = '/media/file.png'
-    mocker.patch.object(models.utils, 'write_to_storage')
-    mocker.patch.object(models.utils, 'get_storage_path_and_url', return_value=('x', storage_url))
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(return_value=('ab12', storage_url)))
     set_side_effect(locals(), target, side_effect_target, side_effect)
 
-    raises = side_effect and side_effect is not FileExistsError
+    raises = bool(side_effect)
 
     if raises:
         with pytest.raises(Exception):
@@ -165,10 +366,89 @@ def test_task_download_images(
 
     assert task.status == task_status
 
-    for img in task.images:
-        assert img.status == \
-            image_status if initial_statuses[img.id] in [StatusEnum.WAITING, StatusEnum.ERROR] \
-            else initial_statuses[img.id]
+    # the in progress image has no lease - it was left by a crashed worker, so it is downloaded as well
+    for img in task.linked_images():
+        assert img.status == (image_status if initial_statuses[img.id] != StatusEnum.SUCCESS else StatusEnum.SUCCESS)
+        assert img.lease_owner is None
+
+
+def test_image_claim(test_app, clean_db):
+    load_fixture_file('Image__01.json')
+    waiting, failed, done, in_progress = models.Image.objects.order_by('pk')
+
+    assert waiting.claim('worker-1', 60)
+    assert waiting.status == StatusEnum.IN_PROGRESS
+    assert not models.Image.objects.get(pk=waiting.pk).claim('worker-2', 60)
+    assert failed.claim('worker-2', 60)
+    assert not done.claim('worker-2', 60)
+    assert in_progress.claim('worker-2', 60)
+
+    # lease of a stalled or crashed worker expires and is taken over
+    assert waiting.renew('worker-1', 0)
+    assert models.Image.objects.get(pk=waiting.pk).claim('worker-2', 60)
+    assert not waiting.renew('worker-1', 60)
+    assert waiting.renew('worker-2', 60)
+
+
+def test_image_finish_after_lease_taken_over(test_app, clean_db):
+    image = models.Image.objects.create(src='http://www.semantive.pl/cat.png')
+    assert image.claim('worker-1', 0)
+    assert models.Image.objects.get(pk=image.pk).claim('worker-2', 60)
+
+    # the stalled worker does not overwrite the download in progress, nor drop its lease
+    assert not run_with_asyncio(image.finish)('worker-1', status=StatusEnum.ERROR)
+    image.reload()
+    assert image.status == StatusEnum.IN_PROGRESS
+    assert image.lease_owner == 'worker-2'
+
+    assert run_with_asyncio(image.finish)('worker-2', storage_url='/media/cat.png', status=StatusEnum.SUCCESS)
+    image.reload()
+    assert image.status == StatusEnum.SUCCESS
+    assert image.lease_owner is None and image.lease_expires is None
+
+
+def test_task_download_images_waits_for_other_worker(test_app, clean_db, session_object_mock, mocker):
+    mocker.patch.dict('os.environ', {'IMAGE_POLL_INTERVAL': '0.01'})
+    load_fixture_file('ImageTask__01.json')
+    task = models.ImageTask.objects.first()
+    image = models.Image.objects.create(src='http://www.semantive.pl/cat.png')
+    models.ImageTaskLink.bulk_link([(task.id, image.id)])
+    assert image.claim('other-worker', 60)
+
+    async def _other_worker():
+        await asyncio.sleep(0.05)
+        assert models.ImageTask.objects.get(pk=task.pk).status != StatusEnum.SUCCESS
+        await image.finish('other-worker', storage_url='/media/cat.png', status=StatusEnum.SUCCESS)
+
+    async def _run():
+        await asyncio.gather(task.download_images(session_object_mock), _other_worker())
+
+    run_with_asyncio(_run)()
+
+    assert not session_object_mock.get.called
+    assert task.reload().status == StatusEnum.SUCCESS
+
+
+def test_image_fetch_renews_lease(test_app, clean_db, session_object_mock, mocker):
+    mocker.patch.dict('os.environ', {'IMAGE_LEASE_TIME': '0.06'})
+    load_fixture_file('ImageTask__01.json')
+    task = models.ImageTask.objects.first()
+    image = models.Image.objects.create(src='http://www.semantive.pl/cat.png')
+    leases = []
+
+    async def _slow_write(*args):
+        for _ in range(3):
+            await asyncio.sleep(0.05)
+            leases.append(models.Image.objects.get(pk=image.pk).lease_expires)
+        return 'ab12', '/media/cat.png'
+
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(side_effect=_slow_write))
+    run_with_asyncio(image.fetch)(task, session_object_mock)
+
+    # kept being extended, though the download took longer than the lease
+    assert leases == sorted(set(leases))
+    assert image.reload().status == StatusEnum.SUCCESS
+    assert image.lease_owner is None
 
 
 @pytest.mark.parametrize(
@@ -177,10 +457,10 @@ def test_task_download_images(
         ('session_object_mock', None, 'get', StatusEnum.SUCCESS, StatusEnum.SUCCESS, 4),
         ('session_object_mock', aiohttp.ClientError, 'get', StatusEnum.ERROR, StatusEnum.ERROR, 0),
         ('session_object_mock', UnicodeError, 'get.return_value.text', StatusEnum.ERROR, StatusEnum.ERROR, 0),
-        ('app.utils.get_images_from_html', ParsingException, '', StatusEnum.ERROR, StatusEnum.ERROR, 0),
-        ('session_object_mock', UnicodeError, 'get.return_value.read', StatusEnum.ERROR, StatusEnum.ERROR, 4),
+        ('app.utils.extract_from_html', ParsingException, '', StatusEnum.ERROR, StatusEnum.ERROR, 0),
+        ('session_object_mock', aiohttp.ClientPayloadError, 'get.return_value.content.iter_chunked',
+         StatusEnum.ERROR, StatusEnum.ERROR, 4),
         ('app.utils.write_to_storage', OSError, '', StatusEnum.ERROR, StatusEnum.ERROR, 4),
-        ('app.utils.write_to_storage', FileExistsError, '', StatusEnum.SUCCESS, StatusEnum.SUCCESS, 4),
     ],
     ids=[
         'successful',
@@ -189,25 +469,23 @@ def test_task_download_images(
         'parsing exception',
         'image download failed',
         'cannot open file to save image',
-        'image exists in storage'
     ]
 )
 def test_execute_images_task(
-        test_app, clean_db, mock_session_ctx, session_object_mock, mocker, set_side_effect,
+        test_app, clean_db, mock_session, session_object_mock, mocker, set_side_effect,
         target, side_effect, side_effect_target, task_status, image_status, no_img):
 
     load_fixture_file('ImageTask__01.json')
     tasks = models.ImageTask.objects.all()
 
     task = tasks[0]
-    _html_images = get_image_dicts(exclude=('status', 'storage_url', 'tasks'))
+    _html_images = get_image_dicts(exclude=('status', 'storage_url'))
 
-    mocker.patch.object(models.utils, 'get_images_from_html', return_value=_html_images)
-    mocker.patch.object(models.utils, 'write_to_storage')
-    mocker.patch.object(models.utils, 'get_media_path', return_value='/media')
+    mocker.patch.object(models.utils, 'extract_from_html', return_value={'text': '', 'images': _html_images})
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(return_value=('ab12', '/media/file.png')))
     set_side_effect(locals(), target, side_effect_target, side_effect)
 
-    raises = side_effect and side_effect is not FileExistsError
+    raises = bool(side_effect)
 
     if raises:
         with pytest.raises((side_effect, models.TaskException)):
@@ -217,6 +495,57 @@ def test_execute_images_task(
     task.reload()
 
     assert task.status == task_status
-    assert len(task.images) == no_img
-    for img in task.images:
+    images = task.linked_images()
+    assert len(images) == no_img
+    for img in images:
         assert img.status == image_status
+
+
+def test_task_deadline(test_app, clean_db, session_object_mock, mocker):
+    mocker.patch.dict('os.environ', {'TASK_DEADLINE': '0.05'})
+    load_fixture_file('ImageTask__01.json')
+    task = models.ImageTask.objects.first()
+    image = models.Image.objects.create(src='http://www.semantive.pl/cat.png')
+    models.ImageTaskLink.bulk_link([(task.id, image.id)])
+
+    async def _stalled_write(*args):
+        await asyncio.sleep(10)
+
+    mocker.patch.object(models.ImageTask, 'get_images', new=CoroutineMock())
+    mocker.patch('app.worker.get_session', new=CoroutineMock(return_value=session_object_mock))
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(side_effect=_stalled_write))
+
+    with pytest.raises(models.TaskException):
+        run_with_asyncio(task.run)()
+
+    # download is given up at once, not when its lease expires
+    assert task.reload().status == StatusEnum.ERROR
+    assert image.reload().status == StatusEnum.ERROR
+    assert image.lease_owner is None
+
+
+def test_execute_images_task_profile(test_app, clean_db, mock_session, mocker):
+    load_fixture_file('ImageTask__01.json')
+    task = models.ImageTask.objects.first()
+    _html_images = get_image_dicts(exclude=('status', 'storage_url'))
+    mocker.patch.object(models.utils, 'extract_from_html', return_value={'text': '', 'images': _html_images})
+    mocker.patch.object(models.utils, 'write_to_storage', new=CoroutineMock(return_value=('ab12', '/media/file.png')))
+
+    execute_images_task(task.to_json())
+    profile = task.reload().profile
+
+    assert set(profile['phases']) == {'page', 'page_fetch', 'parse', 'db', 'image_download'}
+    assert profile['phases']['image_download']['count'] == 4
+    assert profile['counts']['images_downloaded'] == 4
+    assert profile['counts']['bytes'] > 0
+    assert profile['total'] >= profile['phases']['page']['time'] > 0
+    assert profile['queued'] >= 0
+    assert 'cprofile' not in profile
+
+    # images are downloaded already, cProfile is asked for on submit
+    task.update(capture_profile=True)
+    execute_images_task(task.reload().to_json())
+    profile = task.reload().profile
+
+    assert profile['counts'] == {'bytes': mocker.ANY, 'images_skipped': 4}
+    assert 'function calls' in profile['cprofile']
@@ -0,0 +1,65 @@
+import gzip
+import hashlib
+import os
+import stat
+
+import pytest
+
+from app.tests.conftest import chunks, stored_files
+from app.utils import (
+    StorageLimitExceeded, check_content_length, compress_text, decompress_text, get_storage_ext, iter_decompressed,
+    run_with_asyncio, write_to_storage
+)
+
+
+def test_write_to_storage(media_path):
+    content_hash = hashlib.sha256(b'ABCD').hexdigest()
+    storage_name = f'{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.png'
+
+    result = run_with_asyncio(write_to_storage)(chunks(b'AB', b'CD'), 4, '.png')
+
+    assert result == (content_hash, f'/media/{storage_name}')
+    with open(media_path / storage_name, 'rb') as f:
+        assert f.read() == b'ABCD'
+    # readable by nginx as files created with open()
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(os.stat(media_path / storage_name).st_mode) == 0o666 & ~umask
+
+    # same bytes from other url are stored once
+    assert run_with_asyncio(write_to_storage)(chunks(b'A', b'BCD'), 4, '.png') == result
+    assert stored_files(media_path) == [storage_name]
+
+
+def test_write_to_storage_size_limit(media_path):
+    with pytest.raises(StorageLimitExceeded):
+        run_with_asyncio(write_to_storage)(chunks(b'AB', b'CD', b'EF'), 5, '.png')
+
+    assert stored_files(media_path) == []
+
+    check_content_length(None, 5)
+    check_content_length(5, 5)
+    with pytest.raises(StorageLimitExceeded):
+        check_content_length(6, 5)
+
+
+@pytest.mark.parametrize('src, ext', [
+    ('http://www.onet.pl/files/horse.PNG', '.png'),
+    ('http://www.onet.pl/files/horse.png?v=123.456', '.png'),
+    ('http://www.onet.pl/files/horse', ''),
+    ('http://www.onet.pl/files/horse.png&amp;x=/../..', ''),
+])
+def test_get_storage_ext(src, ext):
+    assert get_storage_ext(src) == ext
+
+
+def test_compress_text():
+    text = 'Zażółć gęślą jaźń\n' * 1000
+
+    data = compress_text(text)
+
+    assert len(data) < len(text)
+    assert data == compress_text(text)
+    assert gzip.decompress(data).decode() == text
+    assert decompress_text(data) == text
+    assert len(list(iter_decompressed(data, chunk_size=16))) > 1
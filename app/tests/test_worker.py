@@ -0,0 +1,31 @@
+import asyncio
+
+from app import worker
+
+
+def test_worker_process_session_lifecycle():
+    previous_loop = asyncio.get_event_loop()
+    try:
+        worker.init_worker_process()
+        loop = asyncio.get_event_loop()
+        assert loop is not previous_loop
+
+        session = loop.run_until_complete(worker.get_session())
+        assert loop.run_until_complete(worker.get_session()) is session
+        assert session.connector.limit == worker.get_session_config()['limit']
+
+        worker.shutdown_worker_process()
+        worker.shutdown_worker_process()
+
+        assert session.closed
+        assert loop.is_closed()
+    finally:
+        asyncio.set_event_loop(previous_loop)
+
+
+def test_session_timeout(mocker):
+    mocker.patch.dict('os.environ', {'HTTP_TOTAL_TIMEOUT': '60', 'HTTP_CONNECT_TIMEOUT': '5', 'HTTP_READ_TIMEOUT': '20'})
+
+    timeout = worker.get_timeout()
+
+    assert (timeout.total, timeout.connect, timeout.sock_read) == (60, 5, 20)
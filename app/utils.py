@@ -1,60 +1,242 @@
 import asyncio
 import hashlib
+import logging
+import multiprocessing
 import os
+import re
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
+from pickle import PicklingError
+from urllib.parse import urlsplit
 
-from bs4 import BeautifulSoup
 from bson import ObjectId
 from flask import json
 from flask_mongoengine import BaseQuerySet
 from flask_mongoengine.json import MongoEngineJSONEncoder
 from uri import URI
 
+from app import metrics, parsers, profiling
+
 
 class ParsingException(Exception):
     pass
 
 
+class StorageLimitExceeded(Exception):
+    pass
+
+
 def get_media_path():
     media_path = os.getenv('MEDIA_PATH')
     os.makedirs(media_path, exist_ok=True)
     return media_path
 
 
-def get_text_from_html(html):
-    try:
-        soup = BeautifulSoup(html, 'html.parser')
+def get_max_image_size():
+    return int(os.getenv('MAX_IMAGE_SIZE', 20 * 1024 * 1024))
+
 
-        # kill all script and style elements (from stack overflow)
-        for tag in soup(["script", "style"]):
-            tag.decompose()  # rip it out
-        return '\n'.join(line for line in soup.get_text().splitlines() if line)
-    except (AssertionError, AttributeError, LookupError, TypeError, ValueError) as e:
+def get_download_chunk_size():
+    return int(os.getenv('DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+
+
+def get_text_preview_size():
+    return int(os.getenv('TEXT_PREVIEW_SIZE', 200))
+
+
+PARSING_ERRORS = (AssertionError, AttributeError, LookupError, TypeError, ValueError)
+
+
+def _parse_html(method, html):
+    parser = parsers.get_parser()
+    try:
+        return getattr(parser, method)(html)
+    except PARSING_ERRORS + parser.errors as e:
         raise ParsingException from e
 
 
+def get_text_from_html(html):
+    return _parse_html('get_text', html)
+
+
 def get_images_from_html(html):
+    return _parse_html('get_images', html)
+
+
+def extract_from_html(html):
+    """ Return {'text': ..., 'images': [...]} of the html parsed once """
+    return _parse_html('extract', html)
+
+
+_parser_executors = {}
+
+
+def is_daemon_process():
+    """ Whether the process is daemonic - children of celery prefork pool are, they cannot start processes """
+    if multiprocessing.current_process().daemon:
+        return True
+    try:
+        import billiard.process
+    except ImportError:
+        return False
+    return bool(billiard.process.current_process().daemon)
+
+
+def get_parser_pool_size():
+    """ PARSER_POOL_SIZE, or cores shared by the processes of the worker (WORKER_CONCURRENCY) if it is 0 """
+    size = int(os.getenv('PARSER_POOL_SIZE', 0))
+    if size:
+        return size
+    return max(1, (os.cpu_count() or 1) // int(os.getenv('WORKER_CONCURRENCY', 1)))
+
+
+def get_parser_executor():
+    # 'thread' - parsers releasing the GIL (lxml) keep the loop responsive, 'process' - parsing never holds
+    # the GIL of the loop, needs celery solo or threads pool, 'inline' - parse in the loop
+    kind = os.getenv('PARSER_EXECUTOR', 'thread')
+    if kind == 'inline':
+        return None
+    if kind == 'process' and is_daemon_process():
+        if 'thread' not in _parser_executors:
+            logging.warning(
+                "PARSER_EXECUTOR=process cannot be used in a daemonic process (celery prefork pool), parsing in threads"
+            )
+        kind = 'thread'
+    if kind not in _parser_executors:
+        executor_class = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}[kind]
+        _parser_executors[kind] = executor_class(max_workers=get_parser_pool_size())
+    return _parser_executors[kind]
+
+
+def shutdown_parser_executors():
+    while _parser_executors:
+        _parser_executors.popitem()[1].shutdown()
+
+
+async def run_parser(parse_func, html):
+    """ Run parse function in the parser executor, so network I/O of other coroutines keeps flowing """
+    executor = get_parser_executor()
+    if executor is None:
+        with profiling.phase('parse', metrics.PARSE):
+            return parse_func(html)
+
+    # cancelling the coroutine cancels a parse, which has not started yet - a running one is let to finish
+    # and its result is dropped
     try:
-        soup = BeautifulSoup(html, 'html.parser')
-        return [{'src': img['src'], 'name': img.get('alt')} for img in soup.find_all('img') if img.get('src')]
-    except (AssertionError, AttributeError, LookupError, TypeError, ValueError) as e:
+        with profiling.phase('parse', metrics.PARSE):
+            return await asyncio.get_event_loop().run_in_executor(executor, parse_func, html)
+    except BrokenProcessPool as e:
+        # parsing process died (i.e. killed on memory limit), next parse gets a new pool
+        for kind, broken in list(_parser_executors.items()):
+            if broken is executor:
+                del _parser_executors[kind]
+        raise ParsingException('Parsing process terminated abruptly') from e
+    except PicklingError as e:
         raise ParsingException from e
+    except ParsingException:
+        raise
+    except Exception as e:
+        # the executor itself failed (i.e. could not start its processes), the task must not stay in progress
+        raise ParsingException(f'Parser executor failed: {e!r}') from e
+
 
+def get_storage_ext(src_url):
+    ext = os.path.splitext(urlsplit(src_url).path)[-1].lower()
+    return ext if re.match(r'^\.[a-z0-9]{1,5}$', ext) else ''
 
-def get_storage_path_and_url(src_url):
-    # generate name unique per src_url, to prevent saving image twice -
-    # FileExistsError is handled properly later on
 
-    ext = os.path.splitext(src_url)[-1]
-    storage_name = f"{hashlib.md5(src_url.encode()).hexdigest()}{ext}"
-    storage_path = os.path.join(get_media_path(), storage_name)
+def get_storage_path_and_url(content_hash, ext):
+    # files are named by hash of their content, so the same bytes (served from different urls) are stored once,
+    # and sharded into two levels of subdirectories to keep directories small - ab/cd/abcd...ef.png
+    storage_name = f'{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{ext}'
+    storage_path = os.path.join(get_media_path(), *storage_name.split('/'))
     storage_url = f'/media/{storage_name}'
     return storage_path, storage_url
 
 
-def write_to_storage(storage_path, content):
-    with open(storage_path, mode='xb') as f:
-        f.write(content)
+def link_to_storage(path, content_hash, ext):
+    """ Hard link the file into content addressed storage, return its url """
+    storage_path, storage_url = get_storage_path_and_url(content_hash, ext)
+    os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+    try:
+        os.link(path, storage_path)
+    except FileExistsError:
+        # same content is stored already
+        pass
+    return storage_url
+
+
+def check_content_length(content_length, max_size):
+    # abort before reading the body, if the server tells us it is too big
+    if content_length is not None and content_length > max_size:
+        raise StorageLimitExceeded(f'Content-Length {content_length} exceeds limit of {max_size} bytes')
+
+
+def get_file_mode():
+    """ Return mode a file created with open() would get - umask can be read only by setting it """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# stored files are served by nginx (other user), while mkstemp creates them readable by the owner only
+FILE_MODE = get_file_mode()
+
+
+async def write_to_storage(chunks, max_size, ext):
+    """ Stream chunks to content addressed storage, return (content hash, storage url) """
+    # stream into a temporary file, so only one chunk is kept in memory and nobody sees partially written file -
+    # it is linked into place once complete
+    fd, tmp_path = tempfile.mkstemp(dir=get_media_path(), prefix='.', suffix='.part')
+    try:
+        size = 0
+        content_hash = hashlib.sha256()
+        with open(fd, mode='wb') as f:
+            os.fchmod(f.fileno(), FILE_MODE)
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise StorageLimitExceeded(f'Content exceeds limit of {max_size} bytes')
+                content_hash.update(chunk)
+                f.write(chunk)
+        content_hash = content_hash.hexdigest()
+        return content_hash, link_to_storage(tmp_path, content_hash, ext)
+    finally:
+        os.unlink(tmp_path)
+
+
+def file_hash(path, chunk_size=64 * 1024):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+# gzip wrapper, so stored text can be sent as it is with 'Content-Encoding: gzip'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compress_text(text):
+    """ Gzip utf-8 encoded text, without a timestamp so the same text gives the same bytes """
+    compressor = zlib.compressobj(int(os.getenv('TEXT_COMPRESSION_LEVEL', 6)), zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(text.encode()) + compressor.flush()
+
+
+def iter_decompressed(data, chunk_size=64 * 1024):
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    for start in range(0, len(data), chunk_size):
+        chunk = decompressor.decompress(data[start:start + chunk_size])
+        if chunk:
+            yield chunk
+    yield decompressor.flush()
+
+
+def decompress_text(data):
+    return b''.join(iter_decompressed(data)).decode()
 
 
 def run_with_asyncio(async_func):
@@ -71,6 +253,10 @@ def get_url_from_src(src, task_url):
     return str(base / src)
 
 
+def get_host(url):
+    return urlsplit(url).netloc.lower()
+
+
 class MongoEngineObjectIdJSONEncoder(MongoEngineJSONEncoder):
     """
     A JSONEncoder which provides serialization of MongoEngine
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import socket
+import uuid
+
+import aiohttp
+
+from app import db, utils
+
+
+_session = None
+_worker_id = None
+
+
+def get_session_config():
+    return {
+        'limit': int(os.getenv('HTTP_POOL_SIZE', 100)),
+        'limit_per_host': int(os.getenv('HTTP_POOL_SIZE_PER_HOST', 10)),
+        'ttl_dns_cache': int(os.getenv('HTTP_DNS_CACHE_TTL', 300)),
+        'keepalive_timeout': int(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30)),
+    }
+
+
+def get_timeout():
+    # a stalled server must not hold a download slot (and the task) for minutes
+    return aiohttp.ClientTimeout(
+        total=float(os.getenv('HTTP_TOTAL_TIMEOUT', 120)),
+        connect=float(os.getenv('HTTP_CONNECT_TIMEOUT', 10)),
+        sock_read=float(os.getenv('HTTP_READ_TIMEOUT', 30)),
+    )
+
+
+async def get_session():
+    """ Return client session shared by all tasks of the worker process -
+    keeps alive connections, DNS cache and TLS sessions between tasks """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(**get_session_config()), timeout=get_timeout()
+        )
+    return _session
+
+
+def get_worker_id():
+    """ Return id of the worker process, which owns leases it takes """
+    global _worker_id
+    # forked processes must not inherit the id of the parent
+    if _worker_id is None or _worker_id[0] != os.getpid():
+        _worker_id = (os.getpid(), f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}')
+    return _worker_id[1]
+
+
+def init_worker_process(**kwargs):
+    # each (forked) worker process runs all its tasks in its own, long-lived event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def shutdown_worker_process(**kwargs):
+    global _session
+    loop = asyncio.get_event_loop()
+    if loop.is_closed():
+        return
+    if _session is not None and not _session.closed:
+        loop.run_until_complete(_session.close())
+    _session = None
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+    utils.shutdown_parser_executors()
+    db.shutdown_db_executor()